@@ -1,11 +1,30 @@
+import hashlib
+import io
+import json
 import logging
+import os
+import queue
 import re
+import threading
+import time
+from datetime import datetime, timezone
 
 from dotenv import load_dotenv
-from flask import Flask, abort, render_template, request
+from flask import (Flask, Response, abort, g, jsonify, render_template,
+                   request, url_for)
 from markupsafe import escape
+from werkzeug.http import is_resource_modified
 
-from main import AddressDetails
+import autocomplete
+import batch
+import cache
+import journal
+import metrics
+import reference_data
+import resilience
+import spatial
+import zip_index
+from main import AddressNotFound, lookup, watch_progress
 
 load_dotenv()
 
@@ -14,31 +33,94 @@ app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", 1024 * 1024))  # 1 MB
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+API_MAX_AGE = int(os.getenv("API_MAX_AGE", 24 * 3600))  # 1 day
+AUTOCOMPLETE_MAX_AGE = int(os.getenv("AUTOCOMPLETE_MAX_AGE", 300))  # 5 min
+# POST /lookup returns the result page at once and fills it in over SSE
+STREAM_RESULTS = os.getenv("STREAM_RESULTS", "0") == "1"
+
 @app.before_request
 def limit_payload():
-    if request.content_length and request.content_length > 1024 * 10:  # 10 KB
+    limit = BATCH_MAX_BYTES if request.endpoint == "batch_lookup" else 1024 * 10  # 10 KB
+    if request.content_length and request.content_length > limit:
         abort(413, "Request too large")
 
+@app.before_request
+def start_spans():
+    g.started = time.time()
+    g.spans = metrics.start_spans()
+    g.counts = metrics.start_counts()
+
+@app.after_request
+def add_server_timing(response):
+    spans = g.get('spans')
+    if spans:
+        response.headers['Server-Timing'] = metrics.server_timing(spans)
+    return response
+
+@app.after_request
+def write_journal(response):
+    if g.get('journal'):
+        journal.record(request.endpoint, started=g.started,
+                       spans=g.get('spans'), counts=g.get('counts'),
+                       status=response.status_code, **g.journal)
+    return response
+
+def journaled_lookup(street: str, zip: str) -> dict:
+    """lookup, noted for the journal record written after the request."""
+    g.journal = {"street": street, "zip": zip}
+    try:
+        g.journal["result"] = lookup(street, zip)
+    except Exception as e:
+        g.journal["error"] = e
+        raise
+    return g.journal["result"]
+
+def clean_form(form) -> tuple:
+    """
+    Escape and validate the lookup form.
+    Returns (street, zip); raises ValueError with a message for the user.
+    """
+    street = form.get('streetAddress', '').strip()
+    street_safe = escape(street)
+    if len(street_safe) > 200:
+        raise ValueError("Street address is too long")
+
+    zip = form.get('ZIPCode', '').strip()
+    zip_safe = escape(zip)
+    if not re.match(r"^\d{5}(-\d{4})?$", zip_safe):
+        raise ValueError("Invalid ZIP code")
+
+    return street_safe, zip_safe
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def result_shell(form) -> str:
+    """
+    The result page without a result, filled in by /lookup/events.
+    Raises ValueError like clean_form.
+    """
+    street_safe, zip_safe = clean_form(form)
+    events_url = url_for('lookup_events',
+                         streetAddress=form.get('streetAddress', ''),
+                         ZIPCode=form.get('ZIPCode', ''))
+    return render_template('result.html', params=[street_safe, zip_safe],
+                           result={}, stream=True, events_url=events_url)
+
 @app.route('/lookup', methods=['POST'])
 def lookup_address():
     try:
-        # Get form data
-        street = request.form.get('streetAddress', '').strip()
-        street_safe = escape(street)
-        if len(street_safe) > 200:
-            abort(400, "Street address is too long")
+        if STREAM_RESULTS:
+            return result_shell(request.form)
 
-        zip = request.form.get('ZIPCode', '').strip()
-        zip_safe = escape(zip)
-        if not re.match(r"^\d{5}(-\d{4})?$", zip_safe):
-            abort(400, "Invalid ZIP code")
+        # Get form data
+        street_safe, zip_safe = clean_form(request.form)
 
         # Call the main function
-        result = AddressDetails().address_lookup(street_safe, zip_safe)
+        result = journaled_lookup(street_safe, zip_safe)
 
         # fix params = params
         return render_template('result.html', params=[street_safe, zip_safe], result=result)
@@ -47,5 +129,194 @@ def lookup_address():
         logger.exception("An error occurred.")
         return render_template('error.html', error="Address not found."), 500
 
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def event_stream(form):
+    """
+    Server-sent events of one lookup: "address" and "county" as those stages
+    finish, then "result" (the display_data() dict) or "lookup_error".
+    The lookup runs in its own thread so stages can be sent while it waits.
+    """
+    try:
+        street_safe, zip_safe = clean_form(form)
+    except ValueError as e:
+        yield sse("lookup_error", {"error": str(e)})
+        return
+
+    events: queue.Queue = queue.Queue()
+
+    def run():
+        started = time.time()
+        outcome: dict = {}
+        with watch_progress(lambda stage, fields: events.put((stage, fields))), \
+                metrics.collect_spans() as spans, \
+                metrics.collect_counts() as counts:
+            try:
+                outcome["result"] = lookup(street_safe, zip_safe)
+            except Exception as e:
+                logger.exception("An error occurred.")
+                outcome["error"] = e
+        journal.record('lookup_events', street=street_safe, zip=zip_safe,
+                       started=started, spans=spans, counts=counts,
+                       status=200, **outcome)
+        if "result" in outcome:
+            events.put(("result", outcome["result"]))
+        else:
+            events.put(("lookup_error", {"error": "Address not found."}))
+
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        event, data = events.get()
+        yield sse(event, data)
+        if event in ("result", "lookup_error"):
+            return
+
+@app.route('/lookup/events')
+def lookup_events():
+    """
+    GET /lookup/events?streetAddress=...&ZIPCode=... as text/event-stream,
+    for the page result_shell renders.
+    """
+    return Response(event_stream(request.args), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+@app.route('/batch', methods=['POST'])
+def batch_lookup():
+    """
+    Look up a CSV of street/ZIP pairs (multipart field "file" or a text/csv
+    body). Results are streamed back as CSV rows as they complete.
+    """
+    upload = request.files.get('file')
+    data = upload.read() if upload else request.get_data()
+
+    try:
+        rows = batch.read_rows(io.StringIO(data.decode('utf-8-sig')))
+    except (UnicodeDecodeError, ValueError) as e:
+        abort(400, str(e))
+
+    results = batch.run_batch(rows, BATCH_CONCURRENCY)
+    return Response(batch.csv_chunks(results), mimetype='text/csv',
+                    headers={'Content-Disposition':
+                             'attachment; filename=results.csv'})
+
+def lookup_validators(street: str, zip: str) -> tuple:
+    """
+    (ETag, Last-Modified) of a lookup answer. Both change when the reference
+    tables, the local snapshots or the ZIP index change. Without snapshots
+    the answer comes from ArcGIS, which can change at any time, so they roll
+    over every API_MAX_AGE seconds instead.
+    """
+    data_version = spatial.version()
+    mtime = max(t.mtime or 0 for t in reference_data.TABLES)
+    if data_version is None:
+        period = int(time.time() // API_MAX_AGE)
+        data_version = f"arcgis-{period}"
+        mtime = max(mtime, period * API_MAX_AGE)
+    else:
+        mtime = max(mtime, spatial.engine().mtime)
+
+    index = zip_index.index()
+    if index is not None:
+        mtime = max(mtime, index.mtime)
+
+    tag = "|".join([cache.address_key(street, zip), reference_data.version(),
+                    data_version, zip_index.version() or ""])
+    return (hashlib.sha1(tag.encode()).hexdigest(),
+            datetime.fromtimestamp(int(mtime), timezone.utc))
+
+def api_error(status: int, message: str) -> Response:
+    response = jsonify(error=message)
+    response.status_code = status
+    response.cache_control.no_store = True
+    return response
+
+@app.route('/api/v1/lookup')
+def api_lookup():
+    """
+    JSON lookup: GET /api/v1/lookup?street=4444+Weber+Rd&zip=63123
+    Returns the display_data() dict. Answers are cacheable for API_MAX_AGE
+    seconds and conditional requests (If-None-Match, If-Modified-Since) are
+    answered with 304 without running the lookup.
+    """
+    street = request.args.get('street', '').strip()
+    zip = request.args.get('zip', '').strip()
+    error = batch.validate(street, zip)
+    if error:
+        return api_error(400, error)
+
+    etag, last_modified = lookup_validators(street, zip)
+    if not is_resource_modified(request.environ, etag=etag,
+                                last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        try:
+            result = journaled_lookup(street, zip)
+        except (resilience.CircuitOpen, resilience.DeadlineExceeded):
+            logger.exception("Lookup service unavailable.")
+            return api_error(503, "Lookup service unavailable")
+        except Exception as e:
+            if isinstance(e, AddressNotFound):
+                return api_error(404, "Address not found.")
+            logger.exception("An error occurred.")
+            return api_error(502, "Lookup failed")
+
+        response = jsonify(result)
+        if result.get("stale"):
+            # answered from old cache entries, don't let it be reused
+            response.cache_control.no_cache = True
+            return response
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = API_MAX_AGE
+    return response
+
+@app.route('/api/v1/autocomplete')
+def api_autocomplete():
+    """
+    Street suggestions from the local street index:
+    GET /api/v1/autocomplete?street=4444+web&zip=63123
+    Returns {"suggestions": ["4444 WEBER RD", ...]}, empty without an index.
+    Suggestions are cacheable for AUTOCOMPLETE_MAX_AGE seconds; the ETag is
+    the index version, so after that they are revalidated with a 304 until
+    the index is rebuilt.
+    """
+    street = request.args.get('street', '')[:200]
+    zip = request.args.get('zip', '').strip()
+    if not re.match(batch.ZIP_PATTERN, zip):
+        return api_error(400, "Invalid ZIP code")
+
+    index = autocomplete.index()
+    etag = hashlib.sha1(
+        (index.version if index is not None else "").encode()).hexdigest()
+    if not is_resource_modified(request.environ, etag=etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(suggestions=autocomplete.suggest(street, zip))
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = AUTOCOMPLETE_MAX_AGE
+    return response
+
+@app.route('/health')
+def health():
+    """
+    Circuit breaker state of each upstream this worker has called.
+    Each gunicorn worker keeps its own breakers.
+    """
+    breakers = resilience.breaker_states()
+    status = "degraded" if any(b["state"] != "closed"
+                               for b in breakers.values()) else "ok"
+    return jsonify(status=status, pid=os.getpid(), upstreams=breakers)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics of all workers (see metrics.py)."""
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,172 @@
+"""
+ASGI entry point for the async serving mode.
+
+POST /lookup runs the asyncio pipeline in async_lookup.py, so one worker can
+hold hundreds of lookups while they wait on upstream APIs; so does
+GET /lookup/events, the server-sent events of the streaming result page
+(STREAM_RESULTS). Every other route, including POST /lookup when streaming,
+is served by the Flask app (run in a thread pool).
+
+Run with:
+    uvicorn asgi:app --workers 4
+or with gunicorn:
+    GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn --config gunicorn.conf.py asgi:app
+"""
+import asyncio
+import logging
+import time
+from urllib.parse import parse_qsl
+
+from a2wsgi import WSGIMiddleware
+
+import app as flask_module
+import async_lookup
+import journal
+import main
+import metrics
+from app import app as flask_app
+from app import clean_form, sse
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_BYTES: int = 1024 * 10  # 10 KB, same as the Flask app
+
+flask_asgi = WSGIMiddleware(flask_app)
+
+
+async def read_body(receive) -> bytes | None:
+    """Read the request body, or None if it is larger than MAX_BODY_BYTES."""
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY_BYTES:
+            return None
+        if not message.get("more_body"):
+            return body
+
+
+async def send_html(send, status: int, html: str,
+                    spans: list | None = None) -> None:
+    headers = [(b"content-type", b"text/html; charset=utf-8")]
+    if spans:
+        headers.append((b"server-timing",
+                        metrics.server_timing(spans).encode("latin-1")))
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": headers,
+    })
+    await send({"type": "http.response.body", "body": html.encode("utf-8")})
+
+
+async def lookup(scope, receive, send) -> None:
+    """Async version of app.lookup_address."""
+    body = await read_body(receive)
+    if body is None:
+        await send_html(send, 413, "Request too large")
+        return
+
+    templates = flask_app.jinja_env
+    started = time.time()
+    noted: dict | None = None
+    with metrics.collect_spans() as spans, metrics.collect_counts() as counts:
+        try:
+            form = dict(parse_qsl(body.decode("utf-8")))
+            street_safe, zip_safe = clean_form(form)
+
+            noted = {"street": street_safe, "zip": zip_safe}
+            noted["result"] = await async_lookup.lookup(street_safe, zip_safe)
+
+            html = templates.get_template("result.html").render(
+                params=[street_safe, zip_safe], result=noted["result"])
+            status = 200
+
+        except Exception as e:
+            logger.exception("An error occurred.")
+            if noted is not None and "result" not in noted:
+                noted["error"] = e
+            html = templates.get_template("error.html").render(
+                error="Address not found.")
+            status = 500
+
+    await send_html(send, status, html, spans)
+    if noted is not None:
+        journal.record("lookup_address", started=started, spans=spans,
+                       counts=counts, status=status, **noted)
+
+
+async def lookup_events(scope, receive, send) -> None:
+    """Async version of app.lookup_events."""
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def run() -> None:
+        started = time.time()
+        with main.watch_progress(
+                lambda stage, fields: events.put_nowait((stage, fields))), \
+                metrics.collect_spans() as spans, \
+                metrics.collect_counts() as counts:
+            try:
+                street_safe, zip_safe = clean_form(
+                    dict(parse_qsl(scope["query_string"].decode("latin-1"))))
+            except ValueError as e:
+                events.put_nowait(("lookup_error", {"error": str(e)}))
+                return
+            try:
+                result = await async_lookup.lookup(street_safe, zip_safe)
+            except Exception as e:
+                logger.exception("An error occurred.")
+                journal.record("lookup_events", street=street_safe,
+                               zip=zip_safe, started=started, spans=spans,
+                               counts=counts, status=200, error=e)
+                events.put_nowait(("lookup_error",
+                                   {"error": "Address not found."}))
+            else:
+                journal.record("lookup_events", street=street_safe,
+                               zip=zip_safe, started=started, spans=spans,
+                               counts=counts, status=200, result=result)
+                events.put_nowait(("result", result))
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                    (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no")],
+    })
+    task = asyncio.create_task(run())
+    try:
+        while True:
+            event, data = await events.get()
+            done = event in ("result", "lookup_error")
+            await send({"type": "http.response.body",
+                        "body": sse(event, data).encode("utf-8"),
+                        "more_body": not done})
+            if done:
+                return
+    finally:
+        task.cancel()
+
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            main.warm_up()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_lookup.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif (scope["type"] == "http" and scope["path"] == "/lookup"
+            and scope["method"] == "POST" and not flask_module.STREAM_RESULTS):
+        await lookup(scope, receive, send)
+    elif scope["type"] == "http" and scope["path"] == "/lookup/events":
+        await lookup_events(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
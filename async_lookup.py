@@ -0,0 +1,365 @@
+"""
+Asyncio version of the lookup pipeline.
+
+Same steps and answers as main.AddressDetails.address_lookup, but the
+upstream calls use non-blocking httpx clients, so one worker can hold
+hundreds of lookups in flight while they wait on Google and ArcGIS. The
+request parameters, response parsing, caches, local snapshots and
+eligibility rules are shared with main.py, and so are the rate limits
+(RATE_LIMIT_*) and cross-worker coalescing (SINGLE_FLIGHT_SHARED). The
+caches are SQLite files, so they are read and written in worker threads
+(asyncio.to_thread): a slow or locked query never stalls the event loop.
+
+Needs the packages in requirements-async.txt. Used by asgi.py.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+
+import cache
+import clients
+import grid
+import main
+import metrics
+import recording
+import resilience
+import singleflight
+import spatial
+import zip_index
+from main import AddressDetails
+from resilience import retry
+
+logger = logging.getLogger(__name__)
+
+# httpx logs every request url at INFO, which includes the Google API key
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+RETRY_EXCEPTIONS: tuple = (httpx.TimeoutException, httpx.NetworkError)
+TIMEOUT = httpx.Timeout(10, connect=3)
+
+# connections per upstream; keep-alive pool size comes from clients.py
+MAX_CONNECTIONS: int = int(os.getenv("ASYNC_MAX_CONNECTIONS", 100))
+
+# upstream name -> (event loop, httpx.AsyncClient)
+_clients: dict = {}
+
+
+class RecordingTransport(httpx.AsyncHTTPTransport):
+    """Async version of recording.RecordingAdapter."""
+
+    async def handle_async_request(self, request):
+        start = time.perf_counter()
+        response = await super().handle_async_request(request)
+        await response.aread()
+        recording.store().put(
+            recording.request_key(request.method, str(request.url)),
+            response.status_code, response.content.decode("utf-8", "replace"),
+            time.perf_counter() - start)
+        return response
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """Async version of recording.ReplayAdapter."""
+
+    async def handle_async_request(self, request):
+        key = recording.request_key(request.method, str(request.url))
+        entry = recording.store().get(key)
+        if entry is None:
+            raise httpx.ConnectError(f"No recorded response for {key}",
+                                     request=request)
+        if recording.REPLAY_LATENCY:
+            await asyncio.sleep(entry["elapsed"])
+        return httpx.Response(entry["status"],
+                              content=recording.body_text(entry).encode(),
+                              headers={"Content-Type": "application/json"},
+                              request=request)
+
+
+def client(name: str) -> httpx.AsyncClient:
+    """Pooled AsyncClient for an upstream, one per event loop."""
+    loop = asyncio.get_running_loop()
+    entry = _clients.get(name)
+    if entry is None or entry[0] is not loop:
+        limits = httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=clients.pool_maxsize(name))
+        transport = None
+        if recording.MODE == "record":
+            transport = RecordingTransport(limits=limits)
+        elif recording.MODE == "replay":
+            transport = ReplayTransport()
+        entry = (loop, httpx.AsyncClient(limits=limits, timeout=TIMEOUT,
+                                         transport=transport))
+        _clients[name] = entry
+    return entry[1]
+
+
+async def close() -> None:
+    """Close the clients of the running event loop."""
+    loop = asyncio.get_running_loop()
+    for name, (client_loop, async_client) in list(_clients.items()):
+        if client_loop is loop:
+            await async_client.aclose()
+            del _clients[name]
+
+
+async def _get(name: str, url: str, params: dict) -> dict:
+    connect, read = resilience.timeout(3, 10)
+    response = await client(name).get(
+        url, params=params, timeout=httpx.Timeout(read, connect=connect))
+    if response.is_error:
+        # not raise_for_status(): its message has the url with the key
+        raise httpx.HTTPStatusError(f"{response.status_code} from {name}",
+                                    request=response.request,
+                                    response=response)
+    return response.json()
+
+
+@retry(max_attempts=3, delay=1, backoff=2, exceptions=RETRY_EXCEPTIONS,
+       retry_statuses=main.GOOGLE_RETRY_STATUSES)
+@clients.throttled("google")
+@resilience.circuit("google", RETRY_EXCEPTIONS)
+async def goog_geocode(address: str, zip: str) -> tuple:
+    """
+    Same as main.goog_geocode, calling the Geocoding web service directly.
+    Returns: (lng, lat, formatted_address, zip, city, state)
+    """
+    try:
+        data: dict = await _get(
+            "google", clients.url("google") + "/maps/api/geocode/json",
+            {"address": address + " " + zip,
+             "key": os.getenv("GOOGLE_MAPS_API_KEY")})
+        results: list = main.geocode_results(data)
+
+    except Exception as e:
+        logger.info(f"Google Geocoder API call was unsuccessful. Error: {e}")
+        raise
+
+    return main.parse_geocode(results)
+
+
+@metrics.timed("geocode")
+async def geocode(address: str, zip: str) -> tuple:
+    """Same as main.geocode: goog_geocode behind the shared cache."""
+    key: str = cache.address_key(address, zip)
+
+    cached: list | None = await asyncio.to_thread(cache.GEOCODE.get, key)
+    metrics.inc("cache_requests_total", cache=cache.GEOCODE.namespace,
+                result="miss" if cached is None else "hit")
+    if cached is not None:
+        return main.Geocode.from_cache(cached)
+
+    try:
+        result: tuple = await goog_geocode(address, zip)
+    except resilience.CircuitOpen:
+        stale: list | None = await asyncio.to_thread(cache.GEOCODE.get_stale,
+                                                     key)
+        if stale is None:
+            raise
+        resilience.mark_stale(cache.GEOCODE.namespace)
+        return main.Geocode.from_cache(stale)
+
+    if None not in result:
+        await asyncio.to_thread(cache.GEOCODE.set, key,
+                                main.Geocode.cache_entry(result))
+    return result
+
+
+async def _cell_cached(cell_cache: cache.CellCache, fetch, lng: float,
+                       lat: float):
+    value = await asyncio.to_thread(cell_cache.get, lng, lat, cache.MISSING)
+    if value is cache.MISSING:
+        try:
+            value = await fetch(lng, lat)
+        except resilience.CircuitOpen as e:
+            return await asyncio.to_thread(cache.stale_answer, cell_cache,
+                                           lng, lat, e)
+        await asyncio.to_thread(cell_cache.record, lng, lat, value)
+    return value
+
+
+@retry(max_attempts=3, delay=1, backoff=2, exceptions=RETRY_EXCEPTIONS,
+       retry_statuses=main.ARCGIS_RETRY_STATUSES)
+@clients.throttled("counties")
+@resilience.circuit("counties", RETRY_EXCEPTIONS)
+async def _arcgis_county(lng: float, lat: float) -> str:
+    return main.parse_county(await _get(
+        "counties", clients.url("counties") + "/query",
+        main.point_query_params(lng, lat, "NAME")))
+
+
+@retry(max_attempts=3, delay=1, backoff=2, exceptions=RETRY_EXCEPTIONS,
+       retry_statuses=main.ARCGIS_RETRY_STATUSES)
+@clients.throttled("slc")
+@resilience.circuit("slc", RETRY_EXCEPTIONS)
+async def _slc_library_district(lng: float, lat: float) -> str:
+    return main.parse_library_district(await _get(
+        "slc", clients.url("slc") + "/query",
+        main.point_query_params(lng, lat, "LIBRARY_DISTRICT")))
+
+
+@retry(max_attempts=3, delay=1, backoff=2, exceptions=RETRY_EXCEPTIONS,
+       retry_statuses=main.ARCGIS_RETRY_STATUSES)
+@clients.throttled("jeffco")
+@resilience.circuit("jeffco", RETRY_EXCEPTIONS)
+async def _jeffco_school_district(lng: float, lat: float) -> str | None:
+    return main.parse_school_district(await _get(
+        "jeffco", clients.url("jeffco") + "/query",
+        main.point_query_params(lng, lat, "*")))
+
+
+async def arcgis_county(lng: float, lat: float) -> str:
+    """Same as main.arcgis_county."""
+    return await _cell_cached(cache.COUNTIES, _arcgis_county, lng, lat)
+
+
+async def slc_library_district(lng: float, lat: float) -> str:
+    """Same as main.slc_library_district."""
+    return await _cell_cached(cache.SLC, _slc_library_district, lng, lat)
+
+
+async def jeffco_school_district(lng: float, lat: float) -> str | None:
+    """Same as main.jeffco_school_district."""
+    return await _cell_cached(cache.JEFFCO, _jeffco_school_district, lng, lat)
+
+
+@metrics.timed("county")
+async def find_county(lng: float, lat: float) -> str:
+    """Same as main.find_county."""
+    engine = spatial.engine()
+    county = engine.county(lng, lat) if engine is not None else None
+    return county if county is not None else await arcgis_county(lng, lat)
+
+
+@metrics.timed("library")
+async def find_library_district(lng: float, lat: float) -> str:
+    """Same as main.find_library_district."""
+    engine = spatial.engine()
+    library = engine.library_district(lng, lat) if engine is not None else None
+    return (library if library is not None
+            else await slc_library_district(lng, lat))
+
+
+@metrics.timed("school")
+async def find_school_district(lng: float, lat: float) -> str | None:
+    """Same as main.find_school_district."""
+    engine = spatial.engine()
+    school = engine.school_district(lng, lat) if engine is not None else None
+    return (school if school is not None
+            else await jeffco_school_district(lng, lat))
+
+
+async def address_lookup(address: str, zip: str,
+                         fan_out: bool | None = None) -> dict:
+    """
+    Same as AddressDetails().address_lookup.
+    With `fan_out` (default: LOOKUP_FAN_OUT) the three ArcGIS queries run as
+    concurrent tasks, and the ones the rules don't need are cancelled.
+    """
+    # tasks copy the context, so they share the lookup's deadline
+    with resilience.budget():
+        return await _address_lookup(address, zip, fan_out)
+
+
+async def lookup(address: str, zip: str) -> dict:
+    """
+    Same as main.lookup: identical lookups running at the same time on this
+    event loop (and with SINGLE_FLIGHT_SHARED in other workers) share one
+    pipeline. ZIPs the ZIP index resolves, and addresses recently found not
+    to exist, are answered without any upstream call.
+    """
+    async def run() -> dict:
+        if singleflight.SHARED:
+            return await singleflight.SHARED_LOOKUPS.do_async(
+                key, address_lookup, address, zip)
+        return await address_lookup(address, zip)
+
+    indexed: dict | None = zip_index.resolve(zip)
+    if indexed is not None:
+        metrics.inc("lookups_total", outcome="zip_index")
+        return indexed
+
+    key: str = cache.address_key(address, zip)
+    if await asyncio.to_thread(main.known_not_found, key):
+        metrics.inc("lookups_total", outcome="not_found")
+        raise main.AddressNotFound()
+
+    with metrics.in_flight("lookups_in_flight"), metrics.span("lookup"):
+        try:
+            if not singleflight.ENABLED:
+                result = await address_lookup(address, zip)
+            else:
+                result = dict(await singleflight.ASYNC_LOOKUPS.do(key, run))
+        except Exception as e:
+            await asyncio.to_thread(main.remember_not_found, key, e)
+            metrics.inc("lookups_total", outcome=main.lookup_outcome(e))
+            raise
+    metrics.inc("lookups_total",
+                outcome="stale" if result.get("stale") else "ok")
+    return result
+
+
+async def _address_lookup(address: str, zip: str,
+                          fan_out: bool | None) -> dict:
+    details = AddressDetails()
+
+    result: tuple = await geocode(address, zip)
+    lng, lat, details.address, zip, city, state = result
+    if None in [lng, lat, details.address, zip, city, state]:
+        raise Exception("Google geocoder failed to find all address details")
+    main.report_progress("address", address=details.address)
+
+    if fan_out is None:
+        fan_out = main.FAN_OUT
+
+    library: str | None = None
+    school: str | None = None
+
+    # interior cells of the eligibility grid need no query at all
+    answers: tuple | None = grid.answers(lng, lat)
+    if answers is not None:
+        details.county, library, school = answers
+        return details.apply_rules(lng, lat, city, state,
+                                   library_fetch=lambda lng, lat: library,
+                                   school_fetch=lambda lng, lat: school)
+
+    google: str | None = getattr(result, "county", None)
+    details.county = await asyncio.to_thread(main.county_hint, lng, lat,
+                                             google)
+
+    if details.county is None and fan_out and spatial.engine() is None:
+        tasks: dict = {
+            "county": asyncio.create_task(find_county(lng, lat)),
+            "library": asyncio.create_task(find_library_district(lng, lat)),
+            "school": asyncio.create_task(find_school_district(lng, lat)),
+        }
+        try:
+            details.county = await tasks["county"]
+            main.check_county_hint(lng, lat, google, details.county)
+            if details.county.lower() == "st. louis county":
+                library = await tasks["library"]
+            elif details.county.lower() == "jefferson county":
+                school = await tasks["school"]
+        finally:
+            for task in tasks.values():
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # mark failures of unneeded queries as handled
+                    task.exception()
+    else:
+        if details.county is None:
+            details.county = await find_county(lng, lat)
+            main.check_county_hint(lng, lat, google, details.county)
+        if details.county.lower() == "st. louis county":
+            library = await find_library_district(lng, lat)
+        elif details.county.lower() == "jefferson county":
+            school = await find_school_district(lng, lat)
+
+    # the rules only ask for the district of the county they reach
+    return details.apply_rules(lng, lat, city, state,
+                               library_fetch=lambda lng, lat: library,
+                               school_fetch=lambda lng, lat: school)
@@ -0,0 +1,195 @@
+"""
+Street name autocomplete.
+
+Typos in the street address are the most common cause of "Address not
+found.", and each one still costs a Google call (and its retries). The
+lookup form suggests street names from a local index of the streets in
+each ZIP of the service area instead, so staff can pick a valid street
+before anything is geocoded.
+
+The index is built offline from a CSV of addresses (street and ZIP columns,
+like the ones /batch takes), e.g. a county address point export:
+    python autocomplete.py build addresses.csv -o data/streets.json
+
+Each worker loads it once. Per ZIP it keeps the street names in a sorted
+list of search keys, so a suggestion is one binary search plus a short scan.
+A street like "S LINDBERGH BLVD" is also found by typing "LINDBERGH".
+
+Settings:
+    STREET_INDEX_PATH   index file (default data/streets.json, "" to turn off)
+"""
+import argparse
+import bisect
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR: str = os.path.dirname(os.path.abspath(__file__))
+INDEX_PATH: str = os.getenv("STREET_INDEX_PATH",
+                            os.path.join(BASE_DIR, "data", "streets.json"))
+
+MAX_SUGGESTIONS: int = 10
+# leading house number, e.g. "4444", "12A", "100-102"
+HOUSE_NUMBER = re.compile(r"^\s*(\d+[A-Z]?(?:-\d+)?)\s+(.*)$", re.IGNORECASE)
+# trailing unit, e.g. "APT 2", "UNIT B", "# 3"
+UNIT = re.compile(r"\s+(?:APT|UNIT|STE|SUITE|#)\s*\S*$", re.IGNORECASE)
+DIRECTIONS: tuple = ("N", "S", "E", "W", "NE", "NW", "SE", "SW")
+
+
+def fold(text: str) -> str:
+    """Search key: upper case, single spaces, no periods."""
+    return " ".join(text.replace(".", "").upper().split())
+
+
+def split_street(street: str) -> tuple:
+    """
+    ("4444", "WEBER RD") for "4444 Weber Rd Apt 2"; the house number is ""
+    when there is none.
+    """
+    street = UNIT.sub("", street.strip())
+    match = HOUSE_NUMBER.match(street)
+    if match is None:
+        return "", fold(street)
+    return match.group(1).upper(), fold(match.group(2))
+
+
+class StreetIndex:
+    """ZIP -> sorted (key, street name) pairs."""
+
+    def __init__(self, zips: dict, version: str = ""):
+        self.version = version
+        self.keys: dict = {}
+        self.names: dict = {}
+        for zip, streets in zips.items():
+            pairs = sorted({(key, name) for name in streets
+                            for key in search_keys(name)})
+            self.keys[zip] = [key for key, _ in pairs]
+            self.names[zip] = [name for _, name in pairs]
+
+    @classmethod
+    def load(cls, path: str = INDEX_PATH) -> "StreetIndex":
+        with open(path, encoding="utf-8") as f:
+            data: dict = json.load(f)
+        index = cls(data["zips"], data.get("version", ""))
+        logger.info("Loaded the streets of %s ZIPs from %s", len(index.keys),
+                    path)
+        return index
+
+    def streets(self, zip: str, prefix: str,
+                limit: int = MAX_SUGGESTIONS) -> list:
+        """Street names in `zip` starting with `prefix` (folded)."""
+        keys: list | None = self.keys.get(zip[:5])
+        if keys is None:
+            return []
+        prefix = fold(prefix)
+        names: list = self.names[zip[:5]]
+        found: list = []
+        for i in range(bisect.bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix) or len(found) >= limit:
+                break
+            if names[i] not in found:
+                found.append(names[i])
+        return found
+
+    def suggest(self, street: str, zip: str,
+                limit: int = MAX_SUGGESTIONS) -> list:
+        """
+        Completions of what was typed in the street field, keeping the
+        house number: "4444 web" -> ["4444 WEBER RD", ...].
+        """
+        number, prefix = split_street(street)
+        if not prefix:
+            return []
+        return [f"{number} {name}" if number else name
+                for name in self.streets(zip, prefix, limit)]
+
+
+def search_keys(name: str) -> tuple:
+    """The name, and the name without a leading direction."""
+    first, _, rest = name.partition(" ")
+    if rest and first in DIRECTIONS:
+        return name, rest
+    return (name,)
+
+
+_index: StreetIndex | None = None
+_loaded: bool = False
+_lock = threading.Lock()
+
+
+def index() -> StreetIndex | None:
+    """The per-process index, loaded on first use; None without a file."""
+    global _index, _loaded
+    if _loaded:
+        return _index
+
+    with _lock:
+        if not _loaded:
+            if INDEX_PATH and os.path.exists(INDEX_PATH):
+                try:
+                    _index = StreetIndex.load(INDEX_PATH)
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning("Street index not loaded: %s", e)
+            _loaded = True
+    return _index
+
+
+def suggest(street: str, zip: str, limit: int = MAX_SUGGESTIONS) -> list:
+    """StreetIndex.suggest of the loaded index; [] without one."""
+    i = index()
+    return [] if i is None else i.suggest(street, zip, limit)
+
+
+def build(rows, min_count: int = 1) -> dict:
+    """
+    Index file contents from (street, zip) rows: the street names seen at
+    least `min_count` times in each ZIP.
+    """
+    counts: dict = {}
+    for street, zip in rows:
+        _, name = split_street(street)
+        if name and re.match(r"^\d{5}", zip):
+            key = (zip[:5], name)
+            counts[key] = counts.get(key, 0) + 1
+
+    zips: dict = {}
+    for (zip, name), count in sorted(counts.items()):
+        if count >= min_count:
+            zips.setdefault(zip, []).append(name)
+    logger.info("%s streets in %s ZIPs", sum(map(len, zips.values())),
+                len(zips))
+    return {"version": time.strftime("%Y%m%d%H%M%S"), "zips": zips}
+
+
+def write(data: dict, path: str = INDEX_PATH) -> None:
+    """Write the index file atomically."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Street name index")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("input", help="CSV of addresses (street and ZIP "
+                                      "columns)")
+    parser.add_argument("-o", "--out", default=INDEX_PATH)
+    parser.add_argument("--min-count", type=int, default=1,
+                        help="addresses a street needs to be listed")
+    args = parser.parse_args()
+
+    import batch
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.input, newline="", encoding="utf-8-sig") as f:
+        write(build(batch.read_rows(f), args.min_count), args.out)
+    sys.exit(0)
@@ -0,0 +1,175 @@
+"""
+Batch address lookups.
+
+Reads a CSV of street/ZIP pairs, runs main.lookup for each
+row with bounded concurrency and yields the results as they complete, so
+output can be streamed instead of buffered. Used by the /batch endpoint in
+app.py and from the command line:
+
+    python batch.py addresses.csv -o results.csv --concurrency 4 --rate google=10
+
+The input needs a header with a street column (street, streetAddress or
+address) and a ZIP column (zip, ZIPCode or zip_code).
+"""
+import argparse
+import csv
+import io
+import logging
+import re
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import clients
+from main import AddressNotFound, lookup
+
+logger = logging.getLogger(__name__)
+
+ZIP_PATTERN: str = r"^\d{5}(-\d{4})?$"
+MAX_STREET_LENGTH: int = 200
+
+STREET_COLUMNS: tuple = ("street", "streetaddress", "address", "street_address")
+ZIP_COLUMNS: tuple = ("zip", "zipcode", "zip_code", "postal_code")
+
+OUTPUT_COLUMNS: list = ["row", "street", "zip", "address", "county",
+                        "library", "school", "geo_code", "patron_code", "stale",
+                        "zip_index", "error"]
+
+
+def read_rows(lines) -> iter:
+    """
+    Returns an iterator of (street, zip) pairs read lazily from CSV lines.
+    Raises ValueError right away if the header has no street or ZIP column.
+    """
+    reader = csv.reader(lines)
+    header = [h.strip().lower() for h in next(reader, [])]
+
+    street_col = next((header.index(c) for c in STREET_COLUMNS if c in header),
+                      None)
+    zip_col = next((header.index(c) for c in ZIP_COLUMNS if c in header), None)
+    if street_col is None or zip_col is None:
+        raise ValueError("CSV header needs a street and a ZIP column")
+
+    def rows():
+        for row in reader:
+            if not any(cell.strip() for cell in row):
+                continue
+            street = row[street_col].strip() if street_col < len(row) else ""
+            zip = row[zip_col].strip() if zip_col < len(row) else ""
+            yield street, zip
+
+    return rows()
+
+
+def validate(street: str, zip: str) -> str | None:
+    """Returns an error message for invalid input, otherwise None."""
+    if not street:
+        return "Street address is missing"
+    if len(street) > MAX_STREET_LENGTH:
+        return "Street address is too long"
+    if not re.match(ZIP_PATTERN, zip):
+        return "Invalid ZIP code"
+    return None
+
+
+def lookup_row(index: int, street: str, zip: str) -> dict:
+    """Look up one row; errors are reported in the "error" column."""
+    row: dict = {"row": index, "street": street, "zip": zip}
+
+    error = validate(street, zip)
+    if error:
+        row["error"] = error
+        return row
+
+    try:
+        row.update(lookup(street, zip))
+    except Exception as e:
+        logger.warning("Batch row %s failed: %s", index, e)
+        row["error"] = ("Address not found." if isinstance(e, AddressNotFound)
+                        else "Lookup failed")
+    return row
+
+
+def run_batch(rows, concurrency: int = 4) -> iter:
+    """
+    Look up (street, zip) pairs with at most `concurrency` in flight.
+    Rows are read lazily and results are yielded in completion order;
+    each result carries its 1-based input "row" number.
+    """
+    rows = iter(rows)
+    with ThreadPoolExecutor(max_workers=concurrency,
+                            thread_name_prefix="batch") as executor:
+        pending: set = set()
+        index = 0
+        exhausted = False
+
+        while pending or not exhausted:
+            while not exhausted and len(pending) < concurrency:
+                try:
+                    street, zip = next(rows)
+                except StopIteration:
+                    exhausted = True
+                    break
+                index += 1
+                pending.add(executor.submit(lookup_row, index, street, zip))
+
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def csv_chunks(results) -> iter:
+    """Yields CSV text: the header, then one chunk per result."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=OUTPUT_COLUMNS,
+                            extrasaction="ignore")
+    writer.writeheader()
+    yield buffer.getvalue()
+
+    for result in results:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(result)
+        yield buffer.getvalue()
+
+
+def write_csv(results, out) -> None:
+    """Write results to a file object, flushing after every row."""
+    for chunk in csv_chunks(results):
+        out.write(chunk)
+        out.flush()
+
+
+def parse_rate(value: str) -> tuple:
+    """Parse "google=10" into ("google", 10.0)."""
+    name, _, rate = value.partition("=")
+    if name not in clients.UPSTREAMS or not rate:
+        raise argparse.ArgumentTypeError(
+            f"expected <upstream>=<per second> with upstream one of "
+            f"{', '.join(clients.UPSTREAMS)}")
+    return name, float(rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch address lookups")
+    parser.add_argument("input", help="CSV file ('-' for stdin)")
+    parser.add_argument("-o", "--output", help="CSV file (default: stdout)")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="lookups in flight at once (default: 4)")
+    parser.add_argument("--rate", type=parse_rate, action="append", default=[],
+                        metavar="UPSTREAM=N",
+                        help="max calls per second to an upstream (repeatable)")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    for name, rate in args.rate:
+        clients.set_rate_limit(name, rate)
+
+    infile = sys.stdin if args.input == "-" else open(args.input, newline="")
+    outfile = (sys.stdout if not args.output
+               else open(args.output, "w", newline=""))
+    with infile, outfile:
+        write_csv(run_batch(read_rows(infile), args.concurrency), outfile)
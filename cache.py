@@ -0,0 +1,538 @@
+"""
+Caches for upstream answers.
+
+LRUCache is a small in-process cache with a TTL. SQLiteStore is an on-disk
+key/value store in WAL mode, so all gunicorn workers can read and write it at
+the same time and its contents survive worker recycling and restarts.
+TieredCache puts an LRUCache in front of a SQLiteStore. CellCache keys
+spatial answers on the geohash cell around a point instead of the exact
+coordinates.
+
+A cache must never break a lookup: storage errors are logged and treated as
+misses. Expired entries stay on disk for CACHE_STALE_TTL more seconds, so
+they can still be served (marked stale) while an upstream's circuit breaker
+is open.
+
+Settings:
+    CACHE_PATH          SQLite file shared by the workers ("" for memory only)
+    CACHE_STALE_TTL     seconds expired entries are kept for fallback
+                        (default 30 days)
+    GEOCODE_CACHE_TTL   seconds a geocode result is kept (default 30 days)
+    GEOCODE_CACHE_SIZE  entries kept in each worker's LRU (default 2048)
+    NOT_FOUND_CACHE_TTL seconds an address that wasn't found is answered
+                        "Address not found." without a lookup (default 600,
+                        0 turns it off)
+    ARCGIS_CACHE_TTL    seconds an ArcGIS answer is kept (default 7 days)
+    ARCGIS_CACHE_PRECISION  geohash length of a cache cell (default 7,
+                        about 150 m)
+"""
+import functools
+import json
+import logging
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import grid
+import metrics
+import resilience
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR: str = os.path.dirname(os.path.abspath(__file__))
+CACHE_PATH: str = os.getenv("CACHE_PATH",
+                            os.path.join(BASE_DIR, "cache", "lookups.sqlite3"))
+STALE_TTL: float = float(os.getenv("CACHE_STALE_TTL", 30 * 24 * 3600))
+
+MISSING = object()
+
+
+def address_key(address: str, zip: str) -> str:
+    """
+    Normalized street address + ZIP used as a cache key.
+    Example: ("4444 Weber Rd.", "63123") -> "4444 WEBER RD|63123"
+    """
+    street = re.sub(r"[.,#']", " ", str(address)).upper()
+    return " ".join(street.split()) + "|" + str(zip).strip()
+
+
+GEOHASH_BASE32: str = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(lng: float, lat: float, precision: int) -> str:
+    """
+    Standard geohash of a point.
+    Example: (-90.298, 38.551, 7) -> "9yzg31z"
+    """
+    lng_range = [-180.0, 180.0]
+    lat_range = [-90.0, 90.0]
+    chars: list = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        rng, value = (lng_range, lng) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with a per-entry TTL."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key, MISSING)
+            if entry is not MISSING:
+                expires, value = entry
+                if expires > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl: float | None = None) -> None:
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteStore:
+    """
+    Key/value store in a SQLite file shared across processes.
+    Values are stored as JSON. Each process and thread opens its own
+    connection.
+    """
+
+    def __init__(self, path: str, namespace: str, ttl: float):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            "expires REAL NOT NULL, PRIMARY KEY (namespace, key))")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str, default=None, stale: bool = False):
+        """Value of `key`; with `stale`, expired values are returned too."""
+        try:
+            row = self._connect().execute(
+                "SELECT value FROM cache "
+                "WHERE namespace = ? AND key = ? AND expires > ?",
+                (self.namespace, key,
+                 time.time() - STALE_TTL if stale else time.time())).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Cache read failed (%s): %s", self.path, e)
+            return default
+        return default if row is None else json.loads(row[0])
+
+    def set(self, key: str, value, ttl: float | None = None) -> None:
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        try:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value), expires))
+            # purge expired rows now and then instead of on every write
+            if random.random() < 0.01:
+                conn.execute("DELETE FROM cache WHERE expires <= ?",
+                             (now - STALE_TTL,))
+        except sqlite3.Error as e:
+            logger.warning("Cache write failed (%s): %s", self.path, e)
+
+    def add(self, key: str, value, ttl: float | None = None) -> bool:
+        """
+        Set `key` only if it has no live value. Returns whether it was set
+        (also True if the store can't be used, so callers go ahead).
+        """
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        try:
+            conn = self._connect()
+            conn.execute(
+                "DELETE FROM cache "
+                "WHERE namespace = ? AND key = ? AND expires <= ?",
+                (self.namespace, key, now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO cache VALUES (?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value), expires))
+        except sqlite3.Error as e:
+            logger.warning("Cache write failed (%s): %s", self.path, e)
+            return True
+        return cursor.rowcount == 1
+
+    def update(self, key: str, fn, ttl: float | None = None):
+        """
+        Replace the value of `key` with fn(value), atomically across
+        processes (value is None without a live one; fn returns None to keep
+        it). Returns the value afterwards, None if the store can't be used.
+        """
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT value FROM cache "
+                    "WHERE namespace = ? AND key = ? AND expires > ?",
+                    (self.namespace, key, now)).fetchone()
+                value = None if row is None else json.loads(row[0])
+                new = fn(value)
+                if new is not None:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                        (self.namespace, key, json.dumps(new),
+                         now + (self.ttl if ttl is None else ttl)))
+                    value = new
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logger.warning("Cache write failed (%s): %s", self.path, e)
+            return None
+        return value
+
+    def delete(self, key: str) -> None:
+        try:
+            self._connect().execute(
+                "DELETE FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key))
+        except sqlite3.Error as e:
+            logger.warning("Cache delete failed (%s): %s", self.path, e)
+
+
+class TieredCache:
+    """
+    In-process LRU in front of an optional shared SQLiteStore.
+    `lru_ttl` bounds how long a worker keeps its copy of an entry that
+    another worker may have changed (default: `ttl`).
+    """
+
+    def __init__(self, namespace: str, ttl: float, maxsize: int = 1024,
+                 path: str | None = CACHE_PATH, lru_ttl: float | None = None):
+        self.namespace = namespace
+        self.lru = LRUCache(maxsize=maxsize,
+                            ttl=ttl if lru_ttl is None else min(ttl, lru_ttl))
+        self.store = SQLiteStore(path, namespace, ttl) if path else None
+
+    def get(self, key: str, default=None):
+        value = self.lru.get(key, MISSING)
+        if value is not MISSING:
+            return value
+        if self.store is not None:
+            value = self.store.get(key, MISSING)
+            if value is not MISSING:
+                # hit in the shared store, keep a copy in this worker
+                self.lru.set(key, value, self.lru.ttl)
+                return value
+        return default
+
+    def get_stale(self, key: str, default=None):
+        """Like get, but falls back to an expired value in the store."""
+        value = self.lru.get(key, MISSING)
+        if value is not MISSING:
+            return value
+        if self.store is not None:
+            return self.store.get(key, default, stale=True)
+        return default
+
+    def set(self, key: str, value, ttl: float | None = None) -> None:
+        self.lru.set(key, value,
+                     self.lru.ttl if ttl is None else min(ttl, self.lru.ttl))
+        if self.store is not None:
+            self.store.set(key, value, ttl)
+
+    def delete(self, key: str) -> None:
+        self.lru.delete(key)
+        if self.store is not None:
+            self.store.delete(key)
+
+
+class CellCache:
+    """
+    Caches a spatial answer (county, district) per geohash cell.
+
+    Neighbouring points share an answer unless their cell straddles a
+    boundary, so a cell only serves its answer after `confirmations`
+    different points in it produced the same one. When two points in a cell
+    disagree, the cell is marked mixed and answers are kept for the finer
+    cells inside it, down to `max_precision`; below that the cache is
+    bypassed. A cell also doesn't answer for a point with a line known next
+    to it (a boundary cell of the eligibility grid, or a neighbouring cell
+    that is mixed or has another answer): only the point's `max_precision`
+    cell does. A small share of hits (`verify_rate`) is re-queried so cells
+    that turn out to straddle a line are found and refined.
+    """
+
+    def __init__(self, namespace: str, ttl: float, precision: int = 7,
+                 max_precision: int = 9, confirmations: int = 2,
+                 verify_rate: float = 0.02, maxsize: int = 4096,
+                 path: str | None = CACHE_PATH):
+        self.namespace = namespace
+        self.precision = precision
+        self.max_precision = max(precision, max_precision)
+        self.confirmations = confirmations
+        self.verify_rate = verify_rate
+        # other workers may mark a cell mixed, so local copies are short-lived
+        self.cells = TieredCache(namespace, ttl=ttl, maxsize=maxsize, path=path,
+                                 lru_ttl=300)
+        self.hits = 0
+        self.misses = 0
+
+    def _keys(self, lng: float, lat: float):
+        full = geohash(lng, lat, self.max_precision)
+        return [full[:p] for p in range(self.precision, self.max_precision + 1)]
+
+    def get(self, lng: float, lat: float, default=None):
+        entry = self._entry(lng, lat)
+        if (entry is not None and entry["points"] >= self.confirmations
+                and random.random() >= self.verify_rate):
+            self.hits += 1
+            metrics.inc("cache_requests_total", cache=self.namespace,
+                        result="hit")
+            return entry["value"]
+        self.misses += 1
+        metrics.inc("cache_requests_total", cache=self.namespace,
+                    result="miss")
+        return default
+
+    def _entry(self, lng: float, lat: float) -> dict | None:
+        """The entry of the cell that may answer for the point."""
+        keys = self._keys(lng, lat)
+        for key in keys:
+            entry = self.cells.get(key)
+            if entry is None:
+                return None
+            if entry.get("mixed"):
+                # the cell straddles a boundary, try the finer cell
+                continue
+            if key == keys[-1] or not self._near_line(
+                    lng, lat, entry["value"], len(key)):
+                return entry
+            # the cell may reach across the line: only the finest one answers
+            entry = self.cells.get(keys[-1])
+            return None if entry is None or entry.get("mixed") else entry
+        return None
+
+    def _near_line(self, lng: float, lat: float, value,
+                   precision: int) -> bool:
+        """
+        Whether a line is known next to the point: the eligibility grid has
+        a boundary cell there, or a geohash cell around the point's cell is
+        mixed or has an answer other than `value`.
+        """
+        g = grid.grid()
+        if g is not None and g.code(lng, lat) == grid.BOUNDARY:
+            return True
+        # one cell over in each direction
+        d_lng = 360 / 2 ** math.ceil(precision * 5 / 2)
+        d_lat = 180 / 2 ** (precision * 5 // 2)
+        for dx in (-d_lng, 0.0, d_lng):
+            for dy in (-d_lat, 0.0, d_lat):
+                if dx == dy == 0.0:
+                    continue
+                entry = self.cells.get_stale(
+                    geohash(lng + dx, lat + dy, precision))
+                if entry is not None and (entry.get("mixed")
+                                          or entry["value"] != value):
+                    return True
+        return False
+
+    def last_known(self, lng: float, lat: float, default=None):
+        """
+        Any answer recorded for the point's cell, even unconfirmed or
+        expired. Used while the upstream is unavailable.
+        """
+        for key in self._keys(lng, lat):
+            entry = self.cells.get_stale(key)
+            if entry is None:
+                break
+            if not entry.get("mixed"):
+                return entry["value"]
+        return default
+
+    def boundary_near(self, lng: float, lat: float, value,
+                      margin: float) -> bool:
+        """
+        Whether a boundary is known within about `margin` meters of the
+        point: a cell around it straddles one, or has an answer other
+        than `value`.
+        """
+        d_lat = margin / 111_320
+        d_lng = d_lat / max(math.cos(math.radians(lat)), 0.01)
+        keys = {geohash(lng + dx, lat + dy, self.precision)
+                for dx in (-d_lng, 0.0, d_lng) for dy in (-d_lat, 0.0, d_lat)}
+        for key in keys:
+            entry = self.cells.get_stale(key)
+            if entry is not None and (entry.get("mixed")
+                                      or entry["value"] != value):
+                return True
+        return False
+
+    def record(self, lng: float, lat: float, value) -> None:
+        """Store a fresh answer for the point."""
+        point = [round(lng, 6), round(lat, 6)]
+        keys = self._keys(lng, lat)
+        for key in keys:
+            entry = self._count(key, value, point)
+            if entry is None or not entry.get("mixed"):
+                break
+        else:
+            return
+        # near a line only the finest cell answers, see get
+        if key != keys[-1] and self._near_line(lng, lat, value, len(key)):
+            self._count(keys[-1], value, point)
+
+    def _count(self, key: str, value, point: list) -> dict | None:
+        """
+        Count the point's answer in the cell and return the cell's entry.
+        A mixed cell stays mixed. The shared store is updated atomically,
+        so workers can't undo each other's counts or mixed marks.
+        """
+        def count(entry: dict | None) -> dict | None:
+            if entry is None:
+                return {"value": value, "points": 1, "last": point}
+            if entry.get("mixed"):
+                return None
+            if entry["value"] == value:
+                if entry["last"] == point:
+                    return None
+                return {"value": value, "points": entry["points"] + 1,
+                        "last": point}
+            logger.info("Cache cell %s straddles a boundary (%r, %r)",
+                        key, entry["value"], value)
+            return {"mixed": True}
+
+        store = self.cells.store
+        if store is not None:
+            entry = store.update(key, count)
+        else:
+            entry = self.cells.lru.get(key)
+            entry = count(entry) or entry
+        if entry is not None:
+            self.cells.lru.set(key, entry, self.cells.lru.ttl)
+        return entry
+
+
+def cell_cached(cell_cache: CellCache):
+    """
+    Decorator for func(lng, lat) that caches answers with a CellCache.
+    While the upstream's circuit is open the last known answer is returned
+    and the lookup is marked stale.
+    """
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(lng: float, lat: float):
+            value = cell_cache.get(lng, lat, MISSING)
+            if value is not MISSING:
+                return value
+            try:
+                value = func(lng, lat)
+            except resilience.CircuitOpen as e:
+                return stale_answer(cell_cache, lng, lat, e)
+            cell_cache.record(lng, lat, value)
+            return value
+
+        wrapper.cache = cell_cache
+        return wrapper
+
+    return decorator
+
+
+def stale_answer(cell_cache: CellCache, lng: float, lat: float,
+                 error: Exception):
+    """
+    Last known answer for the point, marking the lookup stale.
+    Raises `error` (the CircuitOpen) when there is none.
+    """
+    value = cell_cache.last_known(lng, lat, MISSING)
+    if value is MISSING:
+        raise error
+    resilience.mark_stale(cell_cache.namespace)
+    return value
+
+
+# normalized address + ZIP -> goog_geocode result
+GEOCODE = TieredCache(
+    "geocode",
+    ttl=float(os.getenv("GEOCODE_CACHE_TTL", 30 * 24 * 3600)),
+    maxsize=int(os.getenv("GEOCODE_CACHE_SIZE", 2048)))
+
+# normalized address + ZIP -> True for addresses that don't exist or are
+# outside all counties; short, so fixed addresses aren't refused for long
+NOT_FOUND_TTL: float = float(os.getenv("NOT_FOUND_CACHE_TTL", 600))
+NOT_FOUND = TieredCache("not_found", ttl=NOT_FOUND_TTL, maxsize=1024)
+
+ARCGIS_CACHE_TTL: float = float(os.getenv("ARCGIS_CACHE_TTL", 7 * 24 * 3600))
+ARCGIS_CACHE_PRECISION: int = int(os.getenv("ARCGIS_CACHE_PRECISION", 7))
+
+# geohash cell -> answer of one ArcGIS layer
+COUNTIES = CellCache("cell:counties", ttl=ARCGIS_CACHE_TTL,
+                     precision=ARCGIS_CACHE_PRECISION,
+                     max_precision=ARCGIS_CACHE_PRECISION + 2)
+SLC = CellCache("cell:slc", ttl=ARCGIS_CACHE_TTL,
+                precision=ARCGIS_CACHE_PRECISION,
+                max_precision=ARCGIS_CACHE_PRECISION + 2)
+JEFFCO = CellCache("cell:jeffco", ttl=ARCGIS_CACHE_TTL,
+                   precision=ARCGIS_CACHE_PRECISION,
+                   max_precision=ARCGIS_CACHE_PRECISION + 2)
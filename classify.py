@@ -0,0 +1,246 @@
+"""
+Vectorized classification of already-geocoded points.
+
+For cleanup jobs over large files of geocoded patron records. classify()
+finds the county, St. Louis County library district and Jefferson County
+school district of whole arrays of points at once, against the local
+snapshots (spatial.py). decide() then runs the eligibility rules of
+AddressDetails.apply_rules once per distinct combination of answers.
+
+Each feature's candidate points come from its bounding box (points are
+sorted by longitude once). The candidates are sorted by latitude and tested
+in bands, each band against only the ring edges that cross it, with the same
+even-odd rule as spatial.ring_contains.
+
+Needs NumPy (pip install -r requirements-classify.txt) and local snapshots
+(python spatial.py build). Points outside the snapshots get an error
+instead of an ArcGIS query.
+
+Example:
+    python classify.py patrons.csv -o classified.csv
+"""
+import argparse
+import csv
+import functools
+import logging
+import sys
+import time
+
+import numpy as np
+
+import spatial
+from main import AddressDetails
+
+logger = logging.getLogger(__name__)
+
+# points tested together against the edges crossing their band
+BAND_SIZE: int = 128
+# largest points x edges matrix of one band
+MAX_CELLS: int = 1 << 21
+
+LNG_COLUMNS: tuple = ("lng", "lon", "longitude", "x")
+LAT_COLUMNS: tuple = ("lat", "latitude", "y")
+OUTPUT_COLUMNS: list = ["county", "library", "school", "geo_code",
+                        "patron_code", "error"]
+
+
+class PreparedLayer:
+    """A spatial.Layer as NumPy arrays: bounding boxes and edges."""
+
+    def __init__(self, layer: spatial.Layer):
+        self.values: list = [f.value for f in layer.features]
+        self.bboxes = np.array([f.bbox for f in layer.features],
+                               dtype=float).reshape(-1, 4)
+        # per feature: edges (xi, yi, xj, yj) ordered by lower y, their
+        # lower and upper y
+        self.edges: list = []
+        for feature in layer.features:
+            parts: list = []
+            for ring in feature.rings:
+                xy = np.asarray(ring, dtype=float).reshape(-1, 2)
+                # j is the previous point, as in ring_contains
+                parts.append(np.hstack([xy, np.roll(xy, 1, axis=0)]))
+            edges = np.vstack(parts)
+            # horizontal edges never cross the ray
+            edges = edges[edges[:, 1] != edges[:, 3]]
+            low = np.minimum(edges[:, 1], edges[:, 3])
+            order = np.argsort(low, kind="stable")
+            self.edges.append((edges[order], low[order],
+                               np.maximum(edges[:, 1], edges[:, 3])[order]))
+
+
+@functools.lru_cache(maxsize=8)
+def prepare(layer: spatial.Layer) -> PreparedLayer:
+    return PreparedLayer(layer)
+
+
+def contains(edges: tuple, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Even-odd test of points (x, y) against one feature's edges."""
+    edge_rows, low, high = edges
+    inside = np.zeros(len(x), dtype=bool)
+    order = np.argsort(y, kind="stable")
+    start = 0
+    while start < len(order):
+        size = BAND_SIZE
+        while True:
+            band = order[start:start + size]
+            y0, y1 = y[band[0]], y[band[-1]]
+            # edges whose y-range meets the band: low <= y1 and high > y0
+            n = np.searchsorted(low, y1, side="right")
+            crossing = edge_rows[:n][high[:n] > y0]
+            if size <= 16 or len(band) * len(crossing) <= MAX_CELLS:
+                break
+            size //= 2
+        start += len(band)
+        if not len(crossing):
+            continue
+
+        xi, yi, xj, yj = (crossing[:, k] for k in range(4))
+        bx = x[band][:, None]
+        by = y[band][:, None]
+        # no division by zero: horizontal edges were dropped
+        hits = ((yi > by) != (yj > by)) & (
+            bx < (xj - xi) * (by - yi) / (yj - yi) + xi)
+        inside[band] = np.count_nonzero(hits, axis=1) % 2 == 1
+    return inside
+
+
+def locate(layer: spatial.Layer, lngs: np.ndarray,
+           lats: np.ndarray) -> np.ndarray:
+    """
+    Attribute value of the feature containing each point (None outside
+    them all); the first feature wins, as in Layer.locate.
+    """
+    prepared = prepare(layer)
+    result = np.full(len(lngs), None, dtype=object)
+    unassigned = np.ones(len(lngs), dtype=bool)
+    by_lng = np.argsort(lngs, kind="stable")
+    sorted_lngs = lngs[by_lng]
+
+    for i, (minx, miny, maxx, maxy) in enumerate(prepared.bboxes):
+        lo = np.searchsorted(sorted_lngs, minx, side="left")
+        hi = np.searchsorted(sorted_lngs, maxx, side="right")
+        candidates = by_lng[lo:hi]
+        candidates = candidates[unassigned[candidates]
+                                & (lats[candidates] >= miny)
+                                & (lats[candidates] <= maxy)]
+        if not len(candidates):
+            continue
+        hit = candidates[contains(prepared.edges[i], lngs[candidates],
+                                  lats[candidates])]
+        result[hit] = prepared.values[i]
+        unassigned[hit] = False
+    return result
+
+
+def classify(lngs, lats, engine: spatial.SpatialEngine | None = None) -> dict:
+    """
+    County, library district and school district of every point, in the
+    shapes of SpatialEngine.county / library_district / school_district.
+    Returns {"county": array, "library": array, "school": array} (object
+    arrays, None where a snapshot doesn't cover the point).
+    """
+    engine = engine or spatial.engine()
+    if engine is None:
+        raise RuntimeError("classify needs local snapshots "
+                           "(python spatial.py build)")
+    lngs = np.asarray(lngs, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+
+    result: dict = {}
+    for key, layer in (("county", "counties"), ("library", "slc"),
+                       ("school", "jeffco")):
+        if layer in engine.layers:
+            result[key] = locate(engine.layers[layer], lngs, lats)
+        else:
+            result[key] = np.full(len(lngs), None, dtype=object)
+
+    titled: dict = {}
+    result["county"] = np.array(
+        [None if c is None else titled.setdefault(c, c.title())
+         for c in result["county"]], dtype=object)
+    return result
+
+
+def rules(county: str | None, library: str | None, school: str | None,
+          washington: bool) -> dict:
+    """AddressDetails.apply_rules for one combination of answers."""
+    if county is None:
+        return {"error": "Outside the local snapshots"}
+    details = AddressDetails()
+    details.county = county
+    city, state = ("WASHINGTON", "MO") if washington else ("", "")
+    try:
+        return details.apply_rules(
+            None, None, city, state,
+            library_fetch=lambda lng, lat: library,
+            school_fetch=lambda lng, lat: school)
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def decide(counties, libraries, schools, cities=None, states=None) -> list:
+    """
+    Eligibility of every point: display_data() dicts without an address,
+    or {"error": ...}. The rules run once per distinct combination, so rows
+    with the same answers share one dict.
+    """
+    n = len(counties)
+    cities = cities if cities is not None else [""] * n
+    states = states if states is not None else [""] * n
+    outcomes: dict = {}
+    results: list = []
+    for combination in zip(counties, libraries, schools,
+                           (str(c).upper() == "WASHINGTON"
+                            and str(s).upper() == "MO"
+                            for c, s in zip(cities, states))):
+        outcome = outcomes.get(combination)
+        if outcome is None:
+            outcome = outcomes[combination] = rules(*combination)
+        results.append(outcome)
+    return results
+
+
+def _column(header: list, names: tuple) -> int | None:
+    folded = [h.strip().lower() for h in header]
+    return next((folded.index(n) for n in names if n in folded), None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify geocoded points")
+    parser.add_argument("input", help="CSV with lng/lat columns (and "
+                                      "optionally city and state)")
+    parser.add_argument("-o", "--output", help="output CSV (default stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.input, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [row for row in reader if row]
+
+    lng_col, lat_col = _column(header, LNG_COLUMNS), _column(header,
+                                                             LAT_COLUMNS)
+    if lng_col is None or lat_col is None:
+        sys.exit("CSV header needs a longitude and a latitude column")
+    city_col, state_col = (_column(header, ("city",)),
+                           _column(header, ("state",)))
+
+    start = time.perf_counter()
+    points = classify([float(r[lng_col]) for r in rows],
+                      [float(r[lat_col]) for r in rows])
+    outcomes = decide(
+        points["county"], points["library"], points["school"],
+        [r[city_col] for r in rows] if city_col is not None else None,
+        [r[state_col] for r in rows] if state_col is not None else None)
+    elapsed = time.perf_counter() - start
+
+    out = open(args.output, "w", newline="", encoding="utf-8") \
+        if args.output else sys.stdout
+    writer = csv.writer(out)
+    writer.writerow(header + OUTPUT_COLUMNS)
+    for row, outcome in zip(rows, outcomes):
+        writer.writerow(row + [outcome.get(c, "") for c in OUTPUT_COLUMNS])
+    if args.output:
+        out.close()
+    logger.info("%s points classified in %.2f s", len(rows), elapsed)
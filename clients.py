@@ -0,0 +1,224 @@
+"""
+Long-lived HTTP clients for the upstream services.
+
+Each upstream gets one requests.Session per worker process with a keep-alive
+connection pool, so repeat lookups reuse TCP+TLS connections instead of
+handshaking on every call. The registry is dropped in a forked child
+(gunicorn preload_app), because connections opened in the master must not be
+shared between workers.
+
+Upstream calls can also be rate limited per worker (token bucket), which the
+batch tools use to stay within quotas. With UPSTREAM_MODE=record or replay
+the sessions record or replay upstream responses (see recording.py).
+
+Upstream URLs, pool sizes and rate limits can be overridden with environment
+variables:
+    <NAME>_URL              e.g. ARCGIS_COUNTIES_URL, GOOGLE_MAPS_URL
+    HTTP_POOL_MAXSIZE       connections kept per upstream (default 10)
+    HTTP_POOL_MAXSIZE_<NAME>  per-upstream override, e.g. HTTP_POOL_MAXSIZE_SLC
+    RATE_LIMIT_<NAME>       max calls per second, e.g. RATE_LIMIT_GOOGLE=10
+"""
+import asyncio
+import functools
+import inspect
+import os
+import threading
+import time
+
+import requests
+
+import recording
+import resilience
+
+# upstream name -> (env var, default url)
+UPSTREAMS: dict = {
+    "google": (
+        "GOOGLE_MAPS_URL",
+        "https://maps.googleapis.com"),
+    "counties": (
+        "ARCGIS_COUNTIES_URL",
+        "https://services.arcgis.com/P3ePLMYs2RVChkJx/ArcGIS/rest/services/USA_Census_Counties/FeatureServer/0"),
+    "slc": (
+        "ARCGIS_SLC_URL",
+        "https://services2.arcgis.com/w657bnjzrjguNyOy/ArcGIS/rest/services/AGS_Jurisdictions/FeatureServer/8"),
+    "jeffco": (
+        "ARCGIS_JEFFCO_URL",
+        "https://services1.arcgis.com/Ur3TPhgM56qvxaar/arcgis/rest/services/Tax_Districts/FeatureServer/0"),
+}
+
+DEFAULT_POOL_MAXSIZE: int = 10
+
+_lock = threading.Lock()
+_sessions: dict = {}
+_rate_limiters: dict = {}
+_pid: int = os.getpid()
+
+
+def url(name: str) -> str:
+    """Base url of an upstream (FeatureServer layer url for ArcGIS)."""
+    env_var, default = UPSTREAMS[name]
+    return os.getenv(env_var, default).rstrip("/")
+
+
+def pool_maxsize(name: str) -> int:
+    """Number of keep-alive connections kept for an upstream."""
+    value = os.getenv(f"HTTP_POOL_MAXSIZE_{name.upper()}",
+                      os.getenv("HTTP_POOL_MAXSIZE", DEFAULT_POOL_MAXSIZE))
+    return max(1, int(value))
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` calls per second with bursts of `burst`."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Block until a call is allowed. Raises DeadlineExceeded instead when
+        that is past the running lookup's deadline.
+        """
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        """Same as acquire, waiting without blocking the event loop."""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def _take(self) -> float:
+        """Take a token; returns 0, or the seconds until the next one."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens
+                               + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            wait = (1 - self._tokens) / self.rate
+        left = resilience.remaining()
+        if left is not None and wait > left:
+            raise resilience.DeadlineExceeded(
+                "Lookup time budget exhausted waiting for the rate limit")
+        return wait
+
+
+def set_rate_limit(name: str, rate: float | None, burst: int = 1) -> None:
+    """Limit calls to an upstream to `rate` per second (None: no limit)."""
+    _rate_limiters[name] = RateLimiter(rate, burst) if rate else None
+
+
+def rate_limiter(name: str) -> RateLimiter | None:
+    """The upstream's rate limiter, None without a limit."""
+    if name not in _rate_limiters:
+        rate = os.getenv(f"RATE_LIMIT_{name.upper()}")
+        set_rate_limit(name, float(rate) if rate else None)
+    return _rate_limiters[name]
+
+
+def throttle(name: str) -> None:
+    """Wait for the upstream's rate limit, if it has one."""
+    limiter = rate_limiter(name)
+    if limiter is not None:
+        limiter.acquire()
+
+
+async def throttle_async(name: str) -> None:
+    """Same as throttle, for coroutines."""
+    limiter = rate_limiter(name)
+    if limiter is not None:
+        await limiter.acquire_async()
+
+
+def throttled(name: str):
+    """
+    Decorator waiting for the upstream's rate limit before each call (also
+    for coroutine functions). Put it above @resilience.circuit, so the
+    breaker and the upstream metrics don't count the wait as a slow call.
+    """
+    def decorator(func):
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                await throttle_async(name)
+                return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            throttle(name)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _check_pid() -> None:
+    # fallback for forks that bypass os.register_at_fork (e.g. os.posix_spawn
+    # wrappers); a child must never reuse the parent's sockets
+    if os.getpid() != _pid:
+        reset()
+
+
+def reset() -> None:
+    """
+    Forget all clients without closing them.
+    Closing would shut down TLS sessions still owned by the parent process.
+    """
+    global _pid
+    with _lock:
+        _sessions.clear()
+        _pid = os.getpid()
+
+
+def session(name: str) -> requests.Session:
+    """Returns the pooled session for an upstream, creating it on first use."""
+    _check_pid()
+    s = _sessions.get(name)
+    if s is not None:
+        return s
+
+    with _lock:
+        s = _sessions.get(name)
+        if s is None:
+            s = requests.Session()
+            # recording.py swaps in a recording or replaying adapter
+            adapter = recording.adapter(pool_maxsize(name))
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            _sessions[name] = s
+    return s
+
+
+def _after_fork() -> None:
+    global _lock
+    # the parent may have held the locks at fork time
+    _lock = threading.Lock()
+    _rate_limiters.clear()
+    reset()
+
+
+def close() -> None:
+    """Close all pooled connections (worker shutdown)."""
+    with _lock:
+        for s in _sessions.values():
+            s.close()
+        _sessions.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork)
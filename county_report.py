@@ -0,0 +1,122 @@
+"""
+Verification report: Google's county component against the ArcGIS counties
+layer, over recorded upstream traffic (see recording.py).
+
+For every recorded Geocoder response the county Google reported is compared
+with the recorded counties query for the same point. Lookups take the
+county from Google only when google_county() settles it (the "trusted"
+rows); the other rows show what the extra checks protect against. The
+near-boundary check is not replayed here, it depends on the live cell cache.
+
+Example:
+    python county_report.py tests/fixtures/upstreams.jsonl.gz
+    python county_report.py tests/fixtures --query-missing
+"""
+import argparse
+import json
+from urllib.parse import urlencode
+
+import clients
+import recording
+from main import (arcgis_county, county_component, geocode_results,
+                  google_county, parse_county, parse_geocode,
+                  point_query_params)
+
+
+def compare(fixtures: recording.FixtureStore,
+            query_missing: bool = False) -> list[dict]:
+    """
+    One row per recorded geocode with a point:
+    {"request", "google", "trusted", "arcgis"} (arcgis None when there is
+    no recorded counties query for the point and `query_missing` is off).
+    """
+    counties_url: str = clients.url("counties") + "/query"
+    rows: list = []
+    for key, entry in sorted(fixtures.responses.items()):
+        if "/maps/api/geocode/json" not in key or entry["status"] != 200:
+            continue
+        body = json.loads(recording.body_text(entry))
+        try:
+            results: list = geocode_results(body)
+            lng, lat, *_ = parse_geocode(results)
+        except Exception:
+            continue
+        if lng is None or lat is None:
+            continue
+
+        arcgis: str | None = None
+        county_key: str = recording.request_key(
+            "GET", counties_url + "?" + urlencode(
+                point_query_params(lng, lat, "NAME")))
+        recorded: dict | None = fixtures.get(county_key)
+        if recorded is not None and recorded["status"] == 200:
+            try:
+                arcgis = parse_county(
+                    json.loads(recording.body_text(recorded)))
+            except Exception:
+                arcgis = "(not found)"
+        elif query_missing:
+            arcgis = arcgis_county(lng, lat)
+
+        rows.append({
+            "request": key,
+            "google": county_component(results[0]),
+            "trusted": google_county(results) is not None,
+            "arcgis": arcgis,
+        })
+    return rows
+
+
+def summary(rows: list[dict]) -> dict:
+    """Counts per (trusted, outcome); outcome is agree/disagree/unverified."""
+    counts: dict = {}
+    for row in rows:
+        if row["arcgis"] is None:
+            outcome = "unverified"
+        elif row["google"] == row["arcgis"]:
+            outcome = "agree"
+        else:
+            outcome = "disagree"
+        key = ("trusted" if row["trusted"] else "not trusted", outcome)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def report(rows: list[dict]) -> str:
+    """The summary table and the disagreements as text."""
+    counts: dict = summary(rows)
+    lines: list = [f"{len(rows)} recorded geocodes",
+                   f"{'':<14}{'agree':>10}{'disagree':>10}{'unverified':>12}"]
+    for group in ("trusted", "not trusted"):
+        lines.append(f"{group:<14}"
+                     f"{counts.get((group, 'agree'), 0):>10}"
+                     f"{counts.get((group, 'disagree'), 0):>10}"
+                     f"{counts.get((group, 'unverified'), 0):>12}")
+
+    disagreements: list = [r for r in rows if r["arcgis"] is not None
+                           and r["google"] != r["arcgis"]]
+    if disagreements:
+        lines.append("\nGoogle / ArcGIS disagreements (* would have been "
+                     "used by the lookup):")
+        for r in disagreements:
+            mark = "*" if r["trusted"] else " "
+            lines.append(f" {mark} {r['google']!s:<22} {r['arcgis']!s:<22} "
+                         f"{r['request']}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("fixtures", nargs="?", default=recording.FIXTURES,
+                        help="fixture directory or file")
+    parser.add_argument("--query-missing", action="store_true",
+                        help="query ArcGIS for points without a recording")
+    args = parser.parse_args()
+
+    rows = compare(recording.FixtureStore(args.fixtures).load(),
+                   args.query_missing)
+    print(report(rows))
+    # a trusted disagreement means the fast path gives a wrong county
+    raise SystemExit(1 if any(r["trusted"] and r["arcgis"] is not None
+                              and r["google"] != r["arcgis"]
+                              for r in rows) else 0)
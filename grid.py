@@ -0,0 +1,315 @@
+"""
+Rasterized eligibility grid.
+
+A grid of square cells (CELL_SIZE degrees) over the service area: the
+counties with rules (St. Louis County, Jefferson County and the ones in
+OtherCounties.csv). Each cell holds a 2-byte code for the answers the
+eligibility rules need there: the county, plus the library district in
+St. Louis County or the school district in Jefferson County. A cell gets
+BOUNDARY instead when a snapshot boundary passes through it or next to it.
+A point in an interior cell is answered with one array index. Boundary
+cells, and points off the grid, use the exact snapshot geometry or ArcGIS
+as before.
+
+The grid stores the rule inputs, not the final geo and patron codes,
+because the Washington, MO rule depends on the geocoded city;
+AddressDetails.apply_rules still makes the decision.
+
+The grid is built offline from the local snapshots (needs NumPy, see
+requirements-classify.txt):
+    python grid.py build
+
+Workers memory-map the file, so they all share one copy. A rebuilt file
+is swapped in atomically and mapped within CHECK_INTERVAL seconds. A grid
+built from other snapshots than the ones mapped is not used.
+
+File layout (little-endian): "JGRD", format version (uint32), header
+length (uint32), JSON header (version, snapshot version, origin, cell
+size, columns, rows, answers), then one uint16 code per cell, row by row
+from the south-west corner.
+
+Settings:
+    ELIGIBILITY_GRID   grid file (default SNAPSHOT_DIR/eligibility.grid,
+                       "" to turn off)
+"""
+import argparse
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+import metrics
+import reference_data
+import spatial
+
+logger = logging.getLogger(__name__)
+
+GRID_PATH: str = os.getenv(
+    "ELIGIBILITY_GRID", os.path.join(spatial.SNAPSHOT_DIR, "eligibility.grid"))
+# about 110 m north-south, 85 m east-west
+CELL_SIZE: float = 0.001
+CHECK_INTERVAL: float = 5.0
+
+MAGIC: bytes = b"JGRD"
+FORMAT_VERSION: int = 1
+PREAMBLE = struct.Struct("<4sII")
+
+# cell codes; answers[i] has code FIRST_ANSWER + i
+OUTSIDE: int = 0
+BOUNDARY: int = 1
+FIRST_ANSWER: int = 2
+
+
+class EligibilityGrid:
+    """A memory-mapped grid file."""
+
+    def __init__(self, buffer, header: dict, codes):
+        self.buffer = buffer
+        self.header = header
+        self.codes = codes
+        self.minx, self.miny = header["origin"]
+        self.cell: float = header["cell"]
+        self.cols: int = header["cols"]
+        self.rows: int = header["rows"]
+        self.answers: list = [tuple(a) for a in header["answers"]]
+
+    @classmethod
+    def open(cls, path: str = GRID_PATH) -> "EligibilityGrid":
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, size = PREAMBLE.unpack_from(buffer, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} grid")
+        header: dict = json.loads(
+            bytes(buffer[PREAMBLE.size:PREAMBLE.size + size]))
+        start = PREAMBLE.size + size
+        codes = memoryview(buffer)[start:start + 2 * header["cols"]
+                                   * header["rows"]]
+        if sys.byteorder == "little":
+            codes = codes.cast("H")
+        else:
+            from array import array
+            codes = array("H", codes.tobytes())
+            codes.byteswap()
+        logger.info("Mapped eligibility grid %s (%s x %s cells) from %s",
+                    header["version"], header["cols"], header["rows"], path)
+        return cls(buffer, header, codes)
+
+    @property
+    def snapshot(self) -> str | None:
+        """Version of the snapshots the grid was built from."""
+        return self.header.get("snapshot")
+
+    def code(self, lng: float, lat: float) -> int:
+        col = math.floor((lng - self.minx) / self.cell)
+        row = math.floor((lat - self.miny) / self.cell)
+        if not (0 <= col < self.cols and 0 <= row < self.rows):
+            return OUTSIDE
+        return self.codes[row * self.cols + col]
+
+    def lookup(self, lng: float, lat: float) -> tuple | None:
+        """
+        (county, library, school) of an interior cell, None for boundary
+        cells and points off the grid.
+        """
+        code = self.code(lng, lat)
+        return None if code < FIRST_ANSWER else self.answers[
+            code - FIRST_ANSWER]
+
+
+_grid: EligibilityGrid | None = None
+_loaded: bool = False
+_lock = threading.Lock()
+_source: tuple | None = None
+_next_check: float = 0.0
+
+
+def grid() -> EligibilityGrid | None:
+    """
+    The per-process grid, mapped on first use and re-mapped within
+    CHECK_INTERVAL seconds of a new file; None without a file.
+    """
+    global _grid, _loaded, _source, _next_check
+    if _loaded and (not GRID_PATH or time.monotonic() < _next_check):
+        return _grid
+
+    with _lock:
+        if _loaded and time.monotonic() < _next_check:
+            return _grid
+        _next_check = time.monotonic() + CHECK_INTERVAL
+        source = spatial._stat(GRID_PATH) if GRID_PATH else None
+        if source != _source:
+            # remember the file either way, a bad one isn't retried
+            _source = source
+            try:
+                _grid = EligibilityGrid.open(GRID_PATH) if source else None
+            except (OSError, ValueError, KeyError, struct.error) as e:
+                logger.error("Eligibility grid %s not loaded: %s",
+                             GRID_PATH, e)
+        _loaded = True
+    return _grid
+
+
+def answers(lng: float, lat: float) -> tuple | None:
+    """
+    (county, library, school) for the point when it is in an interior cell
+    of a grid that matches the mapped snapshots, otherwise None.
+    """
+    g = grid()
+    if g is None:
+        return None
+    snapshot = spatial.version()
+    if snapshot is not None and g.snapshot != snapshot:
+        return None
+    result = g.lookup(lng, lat)
+    metrics.inc("cache_requests_total", cache="eligibility_grid",
+                result="miss" if result is None else "hit")
+    return result
+
+
+def boundary_near(lng: float, lat: float, margin: float) -> bool | None:
+    """
+    Whether a boundary cell of the grid is within about `margin` meters of
+    the point; None without a grid.
+    """
+    g = grid()
+    if g is None:
+        return None
+    d_lat = margin / 111_320
+    d_lng = d_lat / max(math.cos(math.radians(lat)), 0.01)
+    # probes at most a cell apart, so the boundary band can't be skipped
+    steps = max(1, math.ceil(max(d_lat, d_lng) / g.cell))
+    for i in range(-steps, steps + 1):
+        for j in range(-steps, steps + 1):
+            if g.code(lng + d_lng * i / steps,
+                      lat + d_lat * j / steps) == BOUNDARY:
+                return True
+    return False
+
+
+def in_service_area(county: str) -> bool:
+    """Whether the eligibility rules give `county` its own answer."""
+    return (county.title() in ("St. Louis County", "Jefferson County")
+            or reference_data.OTHER_COUNTIES.get(county) is not None)
+
+
+def build(engine: spatial.SpatialEngine, cell: float = CELL_SIZE) -> tuple:
+    """
+    Rasterize the snapshots over the service area.
+    Returns (header, codes) with codes a uint16 NumPy array (rows x cols).
+    """
+    import numpy as np
+
+    import classify
+
+    counties = engine.layers["counties"]
+    boxes = [f.bbox for f in counties.features if in_service_area(f.value)]
+    if not boxes:
+        raise ValueError("no service area counties in the snapshots")
+    minx = min(b[0] for b in boxes) - cell
+    miny = min(b[1] for b in boxes) - cell
+    cols = math.ceil((max(b[2] for b in boxes) + cell - minx) / cell)
+    rows = math.ceil((max(b[3] for b in boxes) + cell - miny) / cell)
+
+    # cells an edge of any layer passes through: points along every edge,
+    # at most half a cell apart, then grown by one cell so cells an edge
+    # only clips are covered too
+    edge_cells = np.zeros((rows, cols), dtype=bool)
+    for layer in engine.layers.values():
+        for feature in layer.features:
+            for ring in feature.rings:
+                a = np.asarray(ring, dtype=float).reshape(-1, 2)
+                b = np.roll(a, -1, axis=0)
+                steps = np.ceil(np.hypot(*(b - a).T) / (cell / 2)
+                                ).astype(int) + 1
+                edge = np.repeat(np.arange(len(a)), steps)
+                first = np.repeat(np.cumsum(steps) - steps, steps)
+                t = (np.arange(len(edge)) - first) / np.repeat(
+                    np.maximum(steps - 1, 1), steps)
+                points = a[edge] + (b[edge] - a[edge]) * t[:, None]
+                c = np.floor((points[:, 0] - minx) / cell).astype(int)
+                r = np.floor((points[:, 1] - miny) / cell).astype(int)
+                keep = (c >= 0) & (c < cols) & (r >= 0) & (r < rows)
+                edge_cells[r[keep], c[keep]] = True
+
+    boundary = edge_cells.copy()
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            shifted = np.roll(np.roll(edge_cells, dr, axis=0), dc, axis=1)
+            boundary |= shifted
+
+    codes = np.full((rows, cols), BOUNDARY, dtype=np.uint16)
+    r, c = np.nonzero(~boundary)
+    found = classify.classify(minx + (c + 0.5) * cell, miny + (r + 0.5) * cell,
+                              engine)
+
+    answer_codes: dict = {}
+    cell_codes = np.empty(len(r), dtype=np.uint16)
+    for i, (county, library, school) in enumerate(
+            zip(found["county"], found["library"], found["school"])):
+        if county is None:
+            cell_codes[i] = OUTSIDE
+            continue
+        # a district the snapshots don't cover is looked up exactly
+        if (county.lower() == "st. louis county" and library is None
+                or county.lower() == "jefferson county" and school is None):
+            cell_codes[i] = BOUNDARY
+            continue
+        # keep only the districts the rules use
+        key = (county,
+               library if county.lower() == "st. louis county" else None,
+               school if county.lower() == "jefferson county" else None)
+        code = answer_codes.get(key)
+        if code is None:
+            code = answer_codes[key] = FIRST_ANSWER + len(answer_codes)
+        cell_codes[i] = code
+    codes[r, c] = cell_codes
+
+    header: dict = {
+        "version": time.strftime("%Y%m%dT%H%M%SZ", time.gmtime()),
+        "snapshot": engine.version or str(int(engine.mtime * 1000)),
+        "origin": [minx, miny], "cell": cell, "cols": cols, "rows": rows,
+        "answers": [list(key) for key in answer_codes],
+    }
+    logger.info("%s x %s cells, %.1f%% boundary, %s distinct answers",
+                cols, rows, 100 * boundary.mean(), len(answer_codes))
+    return header, codes
+
+
+def write(path: str, header: dict, codes) -> None:
+    """Write a grid file, replacing `path` atomically."""
+    head: bytes = json.dumps(header).encode("utf-8")
+    head += b" " * (-(PREAMBLE.size + len(head)) % 8)
+    data = codes.astype("<u2").tobytes()
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(head)))
+        f.write(head)
+        f.write(data)
+    os.replace(tmp, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Eligibility grid")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("-o", "--out", default=GRID_PATH)
+    parser.add_argument("--cell", type=float, default=CELL_SIZE,
+                        help="cell size in degrees")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    engine = spatial.engine()
+    if engine is None:
+        sys.exit("No local snapshots, run python spatial.py build first")
+    header, codes = build(engine, args.cell)
+    write(args.out or GRID_PATH, header, codes)
+    sys.exit(0)
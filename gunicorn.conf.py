@@ -1,13 +1,42 @@
+import os
+
 from dotenv import load_dotenv
 
 load_dotenv()
 
 bind = "0.0.0.0:$PORT"
 workers = 4
-worker_class = "sync"
+# "uvicorn.workers.UvicornWorker" serves asgi:app (see asgi.py)
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
 worker_connections = 1000
 timeout = 30
 keepalive = 2
 max_requests = 1000
 max_requests_jitter = 50
-preload_app = True
\ No newline at end of file
+preload_app = True
+
+
+def when_ready(server):
+    # runs in the master after the app is preloaded and before workers fork,
+    # so every (recycled) worker inherits the imports and reference tables
+    import main
+    import metrics
+    main.warm_up()
+    # counters start over with the server; drop the last run's worker files
+    metrics.clear()
+
+
+def child_exit(server, worker):
+    # runs in the master: an exited worker's in-flight gauges are meaningless
+    import metrics
+    metrics.mark_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    # close this worker's keep-alive connections to the upstream APIs
+    import clients
+    import journal
+    import metrics
+    clients.close()
+    metrics.flush(force=True)
+    journal.flush()
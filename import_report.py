@@ -0,0 +1,92 @@
+"""
+Startup-time report: per-module import cost of the app.
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter and
+summarizes the cost per top-level package. Used in CI to catch cold-start
+regressions (e.g. a heavy dependency creeping back onto the import path).
+
+Example:
+    python import_report.py --module main --forbid pandas
+"""
+import argparse
+import re
+import subprocess
+import sys
+
+LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def measure(module: str) -> list[dict]:
+    """
+    Import `module` in a fresh interpreter with -X importtime.
+    Returns one entry per imported module:
+    {"name", "self_us", "cumulative_us", "depth"}
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True)
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr}")
+
+    entries: list = []
+    for line in proc.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append({
+                "name": name,
+                "self_us": int(self_us),
+                "cumulative_us": int(cumulative_us),
+                "depth": (len(indent) - 1) // 2,
+            })
+    return entries
+
+
+def by_package(entries: list[dict]) -> dict[str, int]:
+    """Total self time (us) per top-level package."""
+    totals: dict = {}
+    for e in entries:
+        package = e["name"].split(".")[0]
+        totals[package] = totals.get(package, 0) + e["self_us"]
+    return totals
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--module", default="app",
+                        help="module to import (default: app)")
+    parser.add_argument("--top", type=int, default=15,
+                        help="number of packages to list")
+    parser.add_argument("--budget-ms", type=float,
+                        help="fail if the total import time exceeds this")
+    parser.add_argument("--forbid", action="append", default=[],
+                        help="fail if this package is imported (repeatable)")
+    args = parser.parse_args(argv)
+
+    entries = measure(args.module)
+    totals = by_package(entries)
+    total_ms = sum(totals.values()) / 1000
+
+    print(f"Import cost of '{args.module}': {total_ms:.1f} ms "
+          f"({len(entries)} modules)")
+    print(f"{'package':<30}{'self ms':>10}")
+    for package, us in sorted(totals.items(), key=lambda kv: -kv[1])[:args.top]:
+        print(f"{package:<30}{us / 1000:>10.1f}")
+
+    failed = False
+    for package in args.forbid:
+        if package in totals:
+            print(f"FAIL: '{package}' is imported by '{args.module}'")
+            failed = True
+
+    if args.budget_ms is not None and total_ms > args.budget_ms:
+        print(f"FAIL: import time {total_ms:.1f} ms exceeds budget "
+              f"{args.budget_ms:.1f} ms")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
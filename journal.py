@@ -0,0 +1,213 @@
+"""
+Lookup journal: one JSON line per lookup, for capacity planning and
+regression benchmarks (see replay.py).
+
+Each record has the lookup's normalized input, when it started and how long
+it took, its stage timings (the Server-Timing spans), its cache and upstream
+counts and its outcome:
+
+    {"ts": 1760000000.123, "route": "api_lookup", "status": 200,
+     "street": "4444 Weber Rd", "zip": "63123", "key": "4444 WEBER RD|63123",
+     "duration_ms": 412.3, "outcome": "ok", "geo_code": "St Louis County",
+     "patron_code": "Resident", "spans": {"google": 120.5, ...},
+     "counts": {"cache_requests_total{cache=geocode,result=miss}": 1, ...}}
+
+Requests only put records on a bounded in-memory queue. A background thread
+per worker writes them in batches (at most every FLUSH_INTERVAL seconds), so
+journaling adds no file I/O to requests. When the queue is full, records are
+dropped and counted (journal_records_total{result="dropped"}) rather than
+slowing lookups down. All workers append to the same file; once it is larger
+than JOURNAL_MAX_BYTES it is renamed with a timestamp suffix and the oldest
+JOURNAL_BACKUPS rotated files are kept.
+
+The journal holds patrons' addresses: keep it out of shared locations.
+
+Settings:
+    JOURNAL_PATH        journal file (default cache/journal/lookups.jsonl,
+                        "" to turn off)
+    JOURNAL_MAX_BYTES   size that triggers rotation (default 64 MB)
+    JOURNAL_BACKUPS     rotated files kept (default 10)
+"""
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import cache
+import main
+import metrics
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR: str = os.path.dirname(os.path.abspath(__file__))
+JOURNAL_PATH: str = os.getenv(
+    "JOURNAL_PATH", os.path.join(BASE_DIR, "cache", "journal", "lookups.jsonl"))
+MAX_BYTES: int = int(os.getenv("JOURNAL_MAX_BYTES", 64 * 1024 * 1024))
+BACKUPS: int = int(os.getenv("JOURNAL_BACKUPS", "10"))
+
+QUEUE_SIZE: int = 10000
+BATCH_SIZE: int = 1000
+FLUSH_INTERVAL: float = 1.0
+
+
+class JournalWriter:
+    """Batched, rotating background writer of one journal file."""
+
+    def __init__(self, path: str, max_bytes: int = MAX_BYTES,
+                 backups: int = BACKUPS, queue_size: int = QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._pid: int | None = None
+        self._queue: queue.Queue | None = None
+
+    def _start(self) -> queue.Queue:
+        # one thread per process: a forked worker starts its own
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self.queue_size)
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, args=(self._queue,),
+                                 name="journal", daemon=True).start()
+        return self._queue
+
+    def record(self, entry: dict) -> None:
+        """Queue a record; never blocks."""
+        q = self._queue if self._pid == os.getpid() else self._start()
+        try:
+            q.put_nowait(entry)
+        except queue.Full:
+            metrics.inc("journal_records_total", result="dropped")
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait until the queued records are written (tests, worker exit)."""
+        if self._pid != os.getpid():
+            return True
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def _run(self, q: queue.Queue) -> None:
+        while True:
+            batch: list = [q.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(q.get(timeout=max(
+                        0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+                if isinstance(batch[-1], threading.Event):
+                    break
+
+            records = [r for r in batch if isinstance(r, dict)]
+            if records:
+                try:
+                    self.write(records)
+                    metrics.inc("journal_records_total", len(records),
+                                result="written")
+                except (OSError, TypeError, ValueError) as e:
+                    metrics.inc("journal_records_total", len(records),
+                                result="dropped")
+                    logger.warning("Journal records not written to %s: %s",
+                                   self.path, e)
+            for r in batch:
+                if isinstance(r, threading.Event):
+                    r.set()
+
+    def write(self, records: list) -> None:
+        """Append records with one write, then rotate the file if needed."""
+        data: bytes = "".join(json.dumps(r, separators=(",", ":")) + "\n"
+                              for r in records).encode("utf-8")
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, data)
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if size >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self) -> None:
+        now = time.time()
+        # e.g. lookups.jsonl.20261018T101500.123456-4242, sorts by time
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now))
+        rotated = (f"{self.path}.{stamp}.{int(now % 1 * 1e6):06d}"
+                   f"-{os.getpid()}")
+        try:
+            os.rename(self.path, rotated)
+        except FileNotFoundError:
+            # another worker rotated it first
+            return
+        for old in rotated_files(self.path)[:-self.backups or None]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+
+def rotated_files(path: str) -> list:
+    """Rotated journal files of `path`, oldest first."""
+    return sorted(glob.glob(glob.escape(path) + ".*T*"))
+
+
+WRITER: JournalWriter | None = JournalWriter(JOURNAL_PATH) \
+    if JOURNAL_PATH else None
+
+
+def entry(route: str, street: str, zip: str, started: float,
+          spans: list | None, counts: dict | None, result: dict | None = None,
+          error: Exception | None = None, status: int | None = None) -> dict:
+    """The journal record of one lookup (`started` from time.time())."""
+    timings: dict = {}
+    for name, duration in spans or ():
+        timings[name] = round(timings.get(name, 0.0) + duration * 1000, 1)
+
+    if error is not None:
+        outcome = main.lookup_outcome(error)
+    elif result.get("zip_index"):
+        outcome = "zip_index"
+    else:
+        outcome = "stale" if result.get("stale") else "ok"
+
+    record: dict = {
+        "ts": round(started, 3), "route": route, "status": status,
+        "street": str(street), "zip": str(zip),
+        "key": cache.address_key(street, zip),
+        "duration_ms": round((time.time() - started) * 1000, 1),
+        "outcome": outcome,
+        "spans": timings, "counts": counts or {},
+    }
+    if result is not None:
+        record["geo_code"] = result.get("geo_code")
+        record["patron_code"] = result.get("patron_code")
+    return record
+
+
+def record(route: str, street: str, zip: str, started: float,
+           spans: list | None, counts: dict | None, **outcome) -> None:
+    """Journal a lookup (see entry); nothing when JOURNAL_PATH is ""."""
+    if WRITER is None:
+        return
+    try:
+        WRITER.record(entry(route, street, zip, started, spans, counts,
+                            **outcome))
+    except Exception:
+        # journaling must never fail a lookup
+        logger.exception("Journal record failed")
+
+
+def flush(timeout: float = 5.0) -> None:
+    if WRITER is not None:
+        WRITER.flush(timeout)
@@ -1,71 +1,143 @@
-import functools
+import contextlib
+import contextvars
 import json
 import logging
 import os
-import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import googlemaps
-import pandas as pd
 import requests
 
+import autocomplete
+import cache
+import clients
+import grid
+import metrics
+import reference_data
+import resilience
+import singleflight
+import spatial
+import zip_index
+from resilience import retry
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# send the county, library district and school district queries at once
+FAN_OUT: bool = os.getenv("LOOKUP_FAN_OUT", "0") == "1"
+FAN_OUT_WORKERS: int = int(os.getenv("LOOKUP_FAN_OUT_WORKERS", "6"))
 
-def retry(max_attempts=3, delay=1, backoff=1, exceptions=(Exception,)):
-    """Define decorator function for retries if APIs time out."""
-    def decorator(func):
-
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-
-            current_delay = delay
+# take the county from Google's answer instead of querying ArcGIS for it,
+# when the eligibility grid shows no boundary within COUNTY_HINT_MARGIN meters
+COUNTY_HINT: bool = os.getenv("COUNTY_HINT", "0") == "1"
+COUNTY_HINT_MARGIN: float = float(os.getenv("COUNTY_HINT_MARGIN", "300"))
+# share of lookups that query ArcGIS anyway to check Google's county
+COUNTY_HINT_VERIFY_RATE: float = float(
+    os.getenv("COUNTY_HINT_VERIFY_RATE", "0.02"))
+# Google location types precise enough to trust the county of
+PRECISE_LOCATION_TYPES: tuple = ("ROOFTOP", "RANGE_INTERPOLATED")
 
-            for attempt in range(1, max_attempts + 1):
-                try:
-                    return func(*args, **kwargs)
+# callback(stage, fields) of the lookup running in this context
+_progress: contextvars.ContextVar = contextvars.ContextVar("progress",
+                                                          default=None)
 
-                except exceptions as e:
-                    if attempt == max_attempts:
-                        logger.error("Max retries reached for %s", func.__name__)
-                        raise
+_fan_out_executor: ThreadPoolExecutor | None = None
+_fan_out_lock = threading.Lock()
 
-                    logger.warning(
-                        "Attempt %s failed for %s: %s. Retrying in %ss",
-                        attempt,
-                        func.__name__,
-                        e,
-                        current_delay,
-                    )
+RETRY_EXCEPTIONS: tuple = (requests.exceptions.Timeout,
+                           requests.exceptions.ConnectionError)
+# HTTP statuses worth another attempt, per upstream
+GOOGLE_RETRY_STATUSES: tuple = (429, 500, 503, 504)
+ARCGIS_RETRY_STATUSES: tuple = (429, 503)
 
-                    time.sleep(current_delay)
-                    current_delay *= backoff
 
-        return wrapper
+class AddressNotFound(Exception):
+    """
+    An upstream answered, and the address doesn't exist or lies outside all
+    counties. Unlike timeouts and upstream errors this is remembered for
+    a while (cache.NOT_FOUND).
+    """
 
-    return decorator
+    def __init__(self, message: str = "Address not found."):
+        super().__init__(message)
 
 
-@retry(max_attempts=3, delay=1, backoff=2, exceptions=(requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+@retry(max_attempts=3, delay=1, backoff=2, exceptions=RETRY_EXCEPTIONS,
+       retry_statuses=GOOGLE_RETRY_STATUSES)
+@clients.throttled("google")
+@resilience.circuit("google", RETRY_EXCEPTIONS)
 def goog_geocode(address: str, zip: str) -> tuple:
     """
     Get data from Google Geocoder API.
     Returns: (lng, lat, formatted_address, zip, city, state)
     """
-    api_key = os.getenv("GOOGLE_MAPS_API_KEY")
-
-    gmaps = googlemaps.Client(key=api_key)
+    url: str = clients.url("google") + "/maps/api/geocode/json"
+    params: dict = {"address": address + " " + zip,
+                    "key": os.getenv("GOOGLE_MAPS_API_KEY")}
 
     try:
-        data: list = gmaps.geocode(address + " " + zip)
+        response = clients.session("google").get(
+            url, params=params, timeout=resilience.timeout(3, 10))
+
+        if response.status_code != requests.codes.ok:
+            # not raise_for_status(): its message has the url with the key
+            raise requests.exceptions.HTTPError(
+                f"{response.status_code} from Google Geocoder API",
+                response=response)
+
+        data: list = geocode_results(response.json())
 
     except Exception as e:
         logger.info("Google Geocoder API call was unsuccessful."
                      f"Error: {e}")
         raise e
-    
+
+    return parse_geocode(data)
+
+
+class Geocode(tuple):
+    """
+    (lng, lat, formatted_address, zip, city, state) from parse_geocode.
+    `county` is the county Google reported, when its results settle it
+    (see google_county), otherwise None.
+    """
+
+    def __new__(cls, fields, county: str | None = None):
+        geocode = super().__new__(cls, fields)
+        geocode.county = county
+        return geocode
+
+    @classmethod
+    def from_cache(cls, entry: list) -> "Geocode":
+        # entries cached before the county was kept have six fields
+        return cls(entry[:6], entry[6] if len(entry) > 6 else None)
+
+    @staticmethod
+    def cache_entry(result: tuple) -> list:
+        return list(result[:6]) + [getattr(result, "county", None)]
+
+
+def geocode_results(data: dict) -> list:
+    """
+    Results of a Geocoder API response.
+    Raises RetryableError for OVER_QUERY_LIMIT, Exception for other errors.
+    """
+    status: str = data.get("status")
+    if status == "OVER_QUERY_LIMIT":
+        raise resilience.RetryableError(f"Google Geocoder API error: {status}")
+    if status not in ("OK", "ZERO_RESULTS"):
+        raise Exception(f"Google Geocoder API error: {status}")
+    return data.get("results", [])
+
+
+def parse_geocode(data: list) -> tuple:
+    """
+    Extract address details from Google Geocoder results.
+    Returns: (lng, lat, formatted_address, zip, city, state)
+    """
     if len(data) == 0:
-        raise Exception('Address not found.')
+        raise AddressNotFound()
 
     elif len(data) > 1:
         logger.warning('Multiple addresses found, using the first one.')
@@ -86,7 +158,7 @@ def goog_geocode(address: str, zip: str) -> tuple:
     # Check if both exist, otherwise raise error.
     if not (street_number and route):
         logger.info("street_number and/or route not found.")
-        raise Exception("Address not found.")
+        raise AddressNotFound()
 
     # get longitude and latitude
     lng: float = result.get("geometry", {}).get("location", {}).get("lng")
@@ -112,7 +184,66 @@ def goog_geocode(address: str, zip: str) -> tuple:
             state: str = component.get('short_name')
             break
 
-    return lng, lat, address, zip, city, state
+    return Geocode((lng, lat, address, zip, city, state), google_county(data))
+
+
+def county_component(result: dict) -> str | None:
+    """
+    County (administrative_area_level_2) of a Geocoder result, formatted
+    like parse_county. Example output: St. Louis County
+    """
+    name: str | None = next(
+        (c.get("long_name") for c in result.get("address_components", [])
+         if "administrative_area_level_2" in c.get("types", [])), None)
+    return name.title() if name else None
+
+
+def google_county(data: list) -> str | None:
+    """
+    County of the Geocoder results, or None when they don't settle it:
+    no county component, results in different counties, a partial match or
+    a location less precise than an address range.
+    """
+    counties: set = {county_component(result) for result in data}
+    if len(counties) != 1:
+        return None
+    result: dict = data[0]
+    if result.get("partial_match"):
+        return None
+    location_type = result.get("geometry", {}).get("location_type")
+    if location_type not in PRECISE_LOCATION_TYPES:
+        return None
+    return counties.pop()
+
+
+@metrics.timed("geocode")
+def geocode(address: str, zip: str) -> tuple:
+    """
+    goog_geocode behind the geocode cache shared by all workers.
+    While Google's circuit is open, expired cache entries are used (stale).
+    Returns: (lng, lat, formatted_address, zip, city, state)
+    """
+    key: str = cache.address_key(address, zip)
+
+    cached: list | None = cache.GEOCODE.get(key)
+    metrics.inc("cache_requests_total", cache=cache.GEOCODE.namespace,
+                result="miss" if cached is None else "hit")
+    if cached is not None:
+        return Geocode.from_cache(cached)
+
+    try:
+        result: tuple = goog_geocode(address, zip)
+    except resilience.CircuitOpen:
+        # Google is unavailable, serve an expired answer if there is one
+        stale: list | None = cache.GEOCODE.get_stale(key)
+        if stale is None:
+            raise
+        resilience.mark_stale(cache.GEOCODE.namespace)
+        return Geocode.from_cache(stale)
+
+    if None not in result:
+        cache.GEOCODE.set(key, Geocode.cache_entry(result))
+    return result
 
 
 def format_address(address: str) -> str:
@@ -126,33 +257,52 @@ def format_address(address: str) -> str:
         ", USA", '')
 
 
-@retry(max_attempts=3, delay=1, backoff=2, exceptions=(requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+def point_query_params(lng: float, lat: float, out_fields: str) -> dict:
+    """Query parameters for the ArcGIS feature containing a point."""
+    return {
+        "geometry": f"{lng},{lat}",
+        "geometryType": "esriGeometryPoint",
+        "inSR": "4326",
+        "spatialRel": "esriSpatialRelIntersects",
+        "outFields": out_fields,
+        "returnGeometry": "false",
+        "defaultSR": "4326",
+        "f": "json"
+    }
+
+
+@cache.cell_cached(cache.COUNTIES)
+@retry(max_attempts=3, delay=1, backoff=2, exceptions=RETRY_EXCEPTIONS,
+       retry_statuses=ARCGIS_RETRY_STATUSES)
+@clients.throttled("counties")
+@resilience.circuit("counties", RETRY_EXCEPTIONS)
 def arcgis_county(lng: float, lat: float) -> str:
     """
-    Returns county_name or raises Exception('Address not found.')
+    Returns county_name or raises AddressNotFound
     Example output: St. Louis County
     """
 
-    url: str = "https://services.arcgis.com/P3ePLMYs2RVChkJx/ArcGIS/rest/services/USA_Census_Counties/FeatureServer/0/query"
+    url: str = clients.url("counties") + "/query"
 
-    params: dict = {
-                "geometry": f"{lng},{lat}",
-                "geometryType": "esriGeometryPoint",
-                "inSR": "4326",
-                "spatialRel": "esriSpatialRelIntersects",
-                "outFields": "NAME",
-                "returnGeometry": "false",
-                "defaultSR": "4326",
-                "f": "json"
-            }
+    params: dict = point_query_params(lng, lat, "NAME")
 
-    response = requests.get(url, params=params, timeout=(3,10))
+    response = clients.session("counties").get(url, params=params, timeout=resilience.timeout(3, 10))
 
     if response.status_code != requests.codes.ok:
             response.raise_for_status()
-            
-    data: dict = response.json()
 
+    return parse_county(response.json())
+
+
+def parse_county(data: dict) -> str:
+    """
+    County name from an arcgis_county query response.
+    Raises AddressNotFound if the point is in no county, Exception('Address
+    not found.') for other responses without a county (ArcGIS errors).
+    """
+    if data.get("features") == []:
+        logger.info("No county contains the point")
+        raise AddressNotFound()
     try:
         county_name: str = (
             data.get("features", [{}])[0]
@@ -177,58 +327,66 @@ def check_county(county: str) -> list[str, str] | None:
     Returns [geo_code, patron_code]
     """
 
-    patron_codes = pd.read_csv("csv_files/OtherCounties.csv")
-
-    try:
-        result: list[str, str] = patron_codes[patron_codes["County"].str.lower(
-        ) == county.lower()].loc[:, ["Geographic Code", "Patron Code"]]
-        geo_code: str = result.iloc[0, 0]
-        patron_code: str = result.iloc[0, 1]
+    row: tuple | None = reference_data.OTHER_COUNTIES.get(county)
 
-    except IndexError:
+    if row is None:
         return None
 
+    geo_code, patron_code = row
+
     return [geo_code, patron_code]
 
 
-@retry(max_attempts=3, delay=1, backoff=2, exceptions=(requests.exceptions.Timeout, requests.exceptions.ConnectionError))
-def slc_libs(lng: float, lat: float, county: str) -> list[str, str, str] | None:
+@cache.cell_cached(cache.SLC)
+@retry(max_attempts=3, delay=1, backoff=2, exceptions=RETRY_EXCEPTIONS,
+       retry_statuses=ARCGIS_RETRY_STATUSES)
+@clients.throttled("slc")
+@resilience.circuit("slc", RETRY_EXCEPTIONS)
+def slc_library_district(lng: float, lat: float) -> str:
+    """
+    Query the St. Louis County jurisdictions layer for the library district.
+    Example output: ST LOUIS COUNTY
+    """
+
+    url: str = clients.url("slc") + "/query"
+
+    params: dict = point_query_params(lng, lat, "LIBRARY_DISTRICT")
+
+    response = clients.session("slc").get(url, params=params, timeout=resilience.timeout(3, 10))
+
+    if response.status_code != requests.codes.ok:
+        response.raise_for_status()
+
+    return parse_library_district(response.json())
+
+
+def parse_library_district(data: dict) -> str:
+    """Library district from a slc_library_district query response."""
+    library: str = (data.get("features",
+                        [{}])[0].get("attributes",
+                                     {}).get("LIBRARY_DISTRICT"))
+
+    return library
+
+
+def slc_libs(lng: float, lat: float, county: str,
+             fetch=None) -> list[str, str, str] | None:
     """
     Checks for library district if county is St. Louis County.
     Otherwise, returns None.
+    `fetch(lng, lat)` returns the raw district name (default: local
+    snapshot, then ArcGIS).
     Returns: [geo_code, patron_code, library] | None
     """
 
     if county.lower() == "st. louis county":
-        patron_codes = pd.read_csv("csv_files/StLouisCounty.csv")
-
-        url: str = "https://services2.arcgis.com/w657bnjzrjguNyOy/ArcGIS/rest/services/AGS_Jurisdictions/FeatureServer/8/query"
-
-        params: dict = {
-            "geometry": f"{lng},{lat}",
-            "geometryType": "esriGeometryPoint",
-            "inSR": "4326",
-            "spatialRel": "esriSpatialRelIntersects",
-            "outFields": "LIBRARY_DISTRICT",
-            "returnGeometry": "false",
-            "defaultSR": "4326",
-            "f": "json"
-        }
-
-        response = requests.get(url, params=params, timeout=(3,10))
-
-        if response.status_code != requests.codes.ok:
-            response.raise_for_status()
-
-        data: dict = response.json()
+        library: str = (fetch or find_library_district)(lng, lat)
 
-        library: str = (data.get("features",
-                            [{}])[0].get("attributes",
-                                         {}).get("LIBRARY_DISTRICT"))
-        selected_row = patron_codes[
-            patron_codes["Geographic Code"].str.lower() == library.lower()]
-        geo_code: str = str(selected_row.iloc[0, 0])
-        patron_code: str = str(selected_row.iloc[0, 1])
+        row: tuple | None = reference_data.ST_LOUIS_COUNTY.get(library)
+        if row is None:
+            raise Exception(
+                f"Library district {library!r} not found in StLouisCounty.csv")
+        geo_code, patron_code = row
 
         library_format: list = list(map(str.capitalize, library.split(' ')))
         if library_format[0] == "St":
@@ -242,43 +400,251 @@ def slc_libs(lng: float, lat: float, county: str) -> list[str, str, str] | None:
         return None
 
 
-@retry(max_attempts=3, delay=1, backoff=2, exceptions=(requests.exceptions.Timeout, requests.exceptions.ConnectionError))
-def jeffco_schools(lng: float, lat: float, county: str) -> str | None:
+@cache.cell_cached(cache.JEFFCO)
+@retry(max_attempts=3, delay=1, backoff=2, exceptions=RETRY_EXCEPTIONS,
+       retry_statuses=ARCGIS_RETRY_STATUSES)
+@clients.throttled("jeffco")
+@resilience.circuit("jeffco", RETRY_EXCEPTIONS)
+def jeffco_school_district(lng: float, lat: float) -> str | None:
+    """
+    Query the Jefferson County tax districts layer for the school district.
+    Example output: Fox
+    """
+
+    url: str = clients.url("jeffco") + "/query"
+
+    params: dict = point_query_params(lng, lat, "*")
+
+    response = clients.session("jeffco").get(url, params=params, timeout=resilience.timeout(3, 10))
+
+    if response.status_code != requests.codes.ok:
+        response.raise_for_status()
+
+    return parse_school_district(response.json())
+
+
+def parse_school_district(data: dict) -> str | None:
+    """School district from a jeffco_school_district query response."""
+    school: str = (data.get("features", [{}])[0].get("attributes",
+                                                {}).get("Name"))
+
+    return school
+
+
+@metrics.timed("county")
+def find_county(lng: float, lat: float) -> str:
+    """
+    County from the local snapshots when available, otherwise arcgis_county.
+    Example output: St. Louis County
+    """
+    engine = spatial.engine()
+    if engine is not None:
+        county: str | None = engine.county(lng, lat)
+        if county is not None:
+            return county
+    return arcgis_county(lng, lat)
+
+
+def county_hint(lng: float, lat: float, county: str | None) -> str | None:
+    """
+    Google's county for the point, when it can stand in for the county
+    query. None when Google had none, when the local snapshots answer
+    anyway, when there is no eligibility grid to tell how far the nearest
+    boundary is, when a boundary is near (a boundary cell of the grid, or
+    one learned by the counties cell cache) and for the share of lookups
+    sampled to check Google against ArcGIS (COUNTY_HINT_VERIFY_RATE).
+    """
+    if not COUNTY_HINT or county is None or spatial.engine() is not None:
+        return None
+    near: bool | None = grid.boundary_near(lng, lat, COUNTY_HINT_MARGIN)
+    if near is None:
+        return None
+    if near or cache.COUNTIES.boundary_near(lng, lat, county,
+                                            COUNTY_HINT_MARGIN):
+        metrics.inc("county_hint_total", result="near_boundary")
+        return None
+    if random.random() < COUNTY_HINT_VERIFY_RATE:
+        return None
+    metrics.inc("county_hint_total", result="used")
+    return county
+
+
+def check_county_hint(lng: float, lat: float, hint: str | None,
+                      county: str) -> None:
+    """Compare Google's county with the one the county query found."""
+    if hint is None:
+        return
+    agree: bool = hint == county
+    metrics.inc("county_hint_total", result="agree" if agree else "disagree")
+    if not agree:
+        logger.warning("Google county %r differs from %r at %s,%s",
+                       hint, county, lng, lat)
+
+
+@metrics.timed("library")
+def find_library_district(lng: float, lat: float) -> str:
+    """
+    Library district from the local snapshots when available,
+    otherwise slc_library_district.
+    """
+    engine = spatial.engine()
+    if engine is not None:
+        library: str | None = engine.library_district(lng, lat)
+        if library is not None:
+            return library
+    return slc_library_district(lng, lat)
+
+
+@metrics.timed("school")
+def find_school_district(lng: float, lat: float) -> str | None:
+    """
+    School district from the local snapshots when available,
+    otherwise jeffco_school_district.
+    """
+    engine = spatial.engine()
+    if engine is not None:
+        school: str | None = engine.school_district(lng, lat)
+        if school is not None:
+            return school
+    return jeffco_school_district(lng, lat)
+
+
+def jeffco_schools(lng: float, lat: float, county: str,
+                   fetch=None) -> str | None:
     """
     Checks for school district if county is Jefferson County.
     Otherwise, returns None.
+    `fetch(lng, lat)` returns the school district (default: local
+    snapshot, then ArcGIS).
     Returns school: str | None
     """
 
     if county.lower() == "jefferson county":
+        return (fetch or find_school_district)(lng, lat)
 
-        url: str = "https://services1.arcgis.com/Ur3TPhgM56qvxaar/arcgis/rest/services/Tax_Districts/FeatureServer/0/query"
-
-        params: dict = {
-            "geometry": f"{lng},{lat}",
-            "geometryType": "esriGeometryPoint",
-            "inSR": "4326",
-            "spatialRel": "esriSpatialRelIntersects",
-            "outFields": "*",
-            "returnGeometry": "false",
-            "defaultSR": "4326",
-            "f": "json"
-        }
+    else:
+        return None
 
-        response = requests.get(url, params=params, timeout=(3,10))
 
-        if response.status_code != requests.codes.ok:
-            response.raise_for_status()
+def fan_out_executor() -> ThreadPoolExecutor:
+    """Per-process thread pool for the speculative ArcGIS queries."""
+    global _fan_out_executor
+    with _fan_out_lock:
+        if _fan_out_executor is None:
+            _fan_out_executor = ThreadPoolExecutor(
+                max_workers=FAN_OUT_WORKERS, thread_name_prefix="fan-out")
+    return _fan_out_executor
 
-        data: dict = response.json()
 
-        school: str = (data.get("features", [{}])[0].get("attributes",
-                                                    {}).get("Name"))
+def _reset_fan_out_executor() -> None:
+    # threads don't survive fork; the child builds its own pool
+    global _fan_out_executor, _fan_out_lock
+    _fan_out_executor = None
+    _fan_out_lock = threading.Lock()
 
-        return school
 
-    else:
-        return None
+os.register_at_fork(after_in_child=_reset_fan_out_executor)
+
+
+def warm_up() -> None:
+    """
+    Load the reference tables and the local jurisdiction snapshots.
+    Called in the gunicorn master (preload_app) so forked workers inherit them.
+    """
+    for table in reference_data.TABLES:
+        table.refresh(force=True)
+
+    spatial.engine()
+    grid.grid()
+    zip_index.index()
+    autocomplete.index()
+
+
+@resilience.budget()
+def lookup(address: str, zip: str) -> dict:
+    """
+    AddressDetails().address_lookup, coalesced: identical lookups (same
+    normalized address + ZIP) running at the same time share one upstream
+    pipeline and all get its result or error. See singleflight.py.
+    ZIPs the ZIP index resolves are answered without any upstream call, and
+    so are addresses recently found not to exist (AddressNotFound is raised).
+    """
+    def run() -> dict:
+        if singleflight.SHARED:
+            return singleflight.SHARED_LOOKUPS.do(
+                key, AddressDetails().address_lookup, address, zip)
+        return AddressDetails().address_lookup(address, zip)
+
+    indexed: dict | None = zip_index.resolve(zip)
+    if indexed is not None:
+        metrics.inc("lookups_total", outcome="zip_index")
+        return indexed
+
+    key: str = cache.address_key(address, zip)
+    if known_not_found(key):
+        metrics.inc("lookups_total", outcome="not_found")
+        raise AddressNotFound()
+
+    with metrics.in_flight("lookups_in_flight"), metrics.span("lookup"):
+        try:
+            if not singleflight.ENABLED:
+                result = AddressDetails().address_lookup(address, zip)
+            else:
+                result = dict(singleflight.LOOKUPS.do(key, run))
+        except Exception as e:
+            remember_not_found(key, e)
+            metrics.inc("lookups_total", outcome=lookup_outcome(e))
+            raise
+    metrics.inc("lookups_total",
+                outcome="stale" if result.get("stale") else "ok")
+    return result
+
+
+@contextlib.contextmanager
+def watch_progress(callback):
+    """
+    Call callback(stage, fields) as lookups in the block progress: "address"
+    once Google has answered, "county" once the county is known. A lookup
+    that joins an identical one already running (singleflight) only gets the
+    result.
+    """
+    token = _progress.set(callback)
+    try:
+        yield
+    finally:
+        _progress.reset(token)
+
+
+def report_progress(stage: str, **fields) -> None:
+    callback = _progress.get()
+    if callback is not None:
+        callback(stage, fields)
+
+
+def known_not_found(key: str) -> bool:
+    """Whether the address (cache.address_key) is in the negative cache."""
+    found: bool = cache.NOT_FOUND.get(key) is not None
+    metrics.inc("cache_requests_total", cache=cache.NOT_FOUND.namespace,
+                result="hit" if found else "miss")
+    return found
+
+
+def remember_not_found(key: str, e: Exception) -> None:
+    """
+    Put the address in the negative cache if the lookup failed with
+    AddressNotFound; timeouts and upstream errors are never remembered.
+    """
+    if isinstance(e, AddressNotFound) and cache.NOT_FOUND_TTL > 0:
+        cache.NOT_FOUND.set(key, True)
+
+
+def lookup_outcome(e: Exception) -> str:
+    """Label of a failed lookup in the lookups_total metric."""
+    if isinstance(e, AddressNotFound):
+        return "not_found"
+    if isinstance(e, (resilience.CircuitOpen, resilience.DeadlineExceeded)):
+        return "unavailable"
+    return "error"
 
 
 class AddressDetails:
@@ -295,27 +661,86 @@ class AddressDetails:
         for attr in attributes:
             setattr(self, attr, None)
 
-    def address_lookup(self, address: str, zip: str):
+    @resilience.budget()
+    def address_lookup(self, address: str, zip: str,
+                       fan_out: bool | None = None):
         """
         Determine patron code, geographic code, and other relevant information
         depending on location.
+        With `fan_out` (default: LOOKUP_FAN_OUT), the county, library district
+        and school district queries are sent together once the coordinates
+        are known, and the rules use only the answers they need.
+        All upstream calls share one time budget (LOOKUP_BUDGET).
         """
 
         """
         Step 1:
-        Use Google Geocoding API to validate address and get coords. 
-        Use ArcGIS API to identify county.
+        Use Google Geocoding API (cached) to validate address and get coords. 
+        Use local snapshots or ArcGIS API to identify county.
         Raise exception if details cannot be found from the address and zip.
         """
 
-        lng, lat, self.address, zip, city, state = goog_geocode(
-            address, zip)
+        result: tuple = geocode(address, zip)
+        lng, lat, self.address, zip, city, state = result
         if None in [lng, lat, self.address, zip, city, state]:
             raise Exception(
                 "Google geocoder failed to find all address details")
-
-        # identify county using arcgis API.
-        self.county: str = arcgis_county(lng, lat)
+        report_progress("address", address=self.address)
+
+        if fan_out is None:
+            fan_out = FAN_OUT
+
+        # interior cells of the eligibility grid need no query at all
+        answers: tuple | None = grid.answers(lng, lat)
+        if answers is not None:
+            self.county, library, school = answers
+            return self.apply_rules(
+                lng, lat, city, state,
+                library_fetch=lambda lng, lat: library,
+                school_fetch=lambda lng, lat: school)
+
+        # Google's county saves the county query when it can be trusted
+        google: str | None = getattr(result, "county", None)
+        self.county: str | None = county_hint(lng, lat, google)
+        if self.county is not None:
+            # at most one district query is left, nothing to overlap
+            return self.apply_rules(lng, lat, city, state)
+
+        # with local snapshots every query is in-process, nothing to overlap
+        if not fan_out or spatial.engine() is not None:
+            # identify county using local snapshots or the arcgis API.
+            self.county: str = find_county(lng, lat)
+            check_county_hint(lng, lat, google, self.county)
+            return self.apply_rules(lng, lat, city, state)
+
+        # speculative queries: the ones the rules don't reach are ignored
+        executor = fan_out_executor()
+        futures: dict = {
+            "county": resilience.submit(executor, arcgis_county, lng, lat),
+            "library": resilience.submit(executor, slc_library_district,
+                                         lng, lat),
+            "school": resilience.submit(executor, jeffco_school_district,
+                                        lng, lat),
+        }
+        try:
+            self.county: str = futures["county"].result()
+            check_county_hint(lng, lat, google, self.county)
+            return self.apply_rules(
+                lng, lat, city, state,
+                library_fetch=lambda lng, lat: futures["library"].result(),
+                school_fetch=lambda lng, lat: futures["school"].result())
+        finally:
+            for future in futures.values():
+                future.cancel()
+
+    def apply_rules(self, lng: float, lat: float, city: str, state: str,
+                    library_fetch=None, school_fetch=None) -> dict:
+        """
+        Apply the eligibility rules once the address and county are known.
+        `library_fetch` and `school_fetch` are passed to slc_libs and
+        jeffco_schools.
+        """
+        report_progress("county", county=self.county)
 
         """
         Step 2:
@@ -346,7 +771,8 @@ class AddressDetails:
         If true, find the correct geo code and patron type
         Returns library, geo code, and patron type.
         """
-        lookup_library: list[str] | None = slc_libs(lng, lat, self.county)
+        lookup_library: list[str] | None = slc_libs(lng, lat, self.county,
+                                                    library_fetch)
 
         if lookup_library:
             self.geo_code: str = lookup_library[0]
@@ -359,7 +785,8 @@ class AddressDetails:
         Check if address is in Jefferson County.
         If true, set school, geo code, and patron type and return.
         """
-        self.school: str | None = jeffco_schools(lng, lat, self.county)
+        self.school: str | None = jeffco_schools(lng, lat, self.county,
+                                                 school_fetch)
 
         if self.school:
 
@@ -389,6 +816,7 @@ class AddressDetails:
         - address, county, geo_code, and patron type are always returned
         - library is returned if address is in St. Louis County
         - school is returned if address is in Jefferson County
+        - stale is True if an upstream was down and cached answers were used
         """
         return {
             k: v
@@ -398,7 +826,8 @@ class AddressDetails:
                 "library": self.library,
                 "school": self.school,
                 "geo_code": self.geo_code,
-                "patron_code": self.patron_code
+                "patron_code": self.patron_code,
+                "stale": True if resilience.stale() else None
             }.items() if v is not None
         }
 
@@ -0,0 +1,368 @@
+"""
+Timing spans and Prometheus-style metrics.
+
+span(name) (or the timed decorator) times a stage of a lookup. The timing goes into a histogram and
+into the Server-Timing header of the response (app.py collects the spans of
+a request with collect_spans()). Upstream latency, retries, cache hits and
+in-flight counts are recorded by resilience.py, cache.py and main.py.
+
+Each gunicorn worker keeps its own registry and writes it to
+METRICS_DIR/<pid>.json at most every FLUSH_INTERVAL seconds. /metrics adds
+up the files of all workers, so the numbers cover the whole server (other
+workers' numbers can be up to FLUSH_INTERVAL seconds old). Files of exited
+workers are kept for their counters and histograms; their gauges are
+dropped (see mark_dead, called from gunicorn's child_exit hook).
+
+Settings:
+    METRICS_DIR     directory for the per-worker files ("" for this process
+                    only; default cache/metrics)
+"""
+import contextlib
+import contextvars
+import functools
+import glob
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR: str = os.path.dirname(os.path.abspath(__file__))
+METRICS_DIR: str = os.getenv("METRICS_DIR",
+                             os.path.join(BASE_DIR, "cache", "metrics"))
+FLUSH_INTERVAL: float = 1.0
+
+BUCKETS: tuple = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# name -> (type, help)
+METRICS: dict = {
+    "lookup_stage_seconds": (
+        "histogram", "Time spent in each stage of a lookup"),
+    "upstream_request_seconds": (
+        "histogram", "Latency of calls to each upstream, per attempt"),
+    "upstream_requests_total": (
+        "counter", "Calls to each upstream by outcome"),
+    "upstream_retries_total": (
+        "counter", "Retries of upstream calls"),
+    "upstream_in_flight": (
+        "gauge", "Upstream calls waiting for an answer"),
+    "cache_requests_total": (
+        "counter", "Cache lookups by cache and result (hit/miss)"),
+    "county_hint_total": (
+        "counter", "Google counties used instead of the county query, "
+        "skipped near a boundary, or checked against it"),
+    "lookups_total": (
+        "counter", "Address lookups by outcome (zip_index: answered from "
+        "the ZIP index)"),
+    "lookups_in_flight": (
+        "gauge", "Address lookups in progress"),
+    "journal_records_total": (
+        "counter", "Lookup journal records written, or dropped because the "
+        "writer fell behind"),
+}
+
+# counters also counted per request for the lookup journal (collect_counts)
+REQUEST_COUNTERS: tuple = ("cache_requests_total", "upstream_requests_total",
+                           "upstream_retries_total")
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return (name,) + tuple(sorted(labels.items()))
+
+
+class Registry:
+    """Counters, gauges and histograms of one process."""
+
+    def __init__(self):
+        self.values: dict = {}
+        self.histograms: dict = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Add to a counter or gauge."""
+        key = _key(name, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Record a value (seconds) in a histogram."""
+        key = _key(name, labels)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                # one count per bucket, then sum and count
+                h = self.histograms[key] = [0] * len(BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "values": [[list(k), v] for k, v in self.values.items()],
+                "histograms": [[list(k), list(h)]
+                               for k, h in self.histograms.items()],
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self.values.clear()
+            self.histograms.clear()
+
+
+REGISTRY = Registry()
+_last_flush: float = 0.0
+_flush_lock = threading.Lock()
+
+_spans: contextvars.ContextVar = contextvars.ContextVar("spans", default=None)
+_counts: contextvars.ContextVar = contextvars.ContextVar("counts",
+                                                        default=None)
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    REGISTRY.inc(name, value, **labels)
+    counts = _counts.get()
+    if counts is not None and name in REQUEST_COUNTERS:
+        key = name + "{" + ",".join(f"{k}={v}" for k, v in
+                                    sorted(labels.items())) + "}"
+        counts[key] = counts.get(key, 0) + value
+    flush()
+
+
+def observe(name: str, value: float, **labels) -> None:
+    REGISTRY.observe(name, value, **labels)
+    flush()
+
+
+@contextlib.contextmanager
+def in_flight(name: str, **labels):
+    """Count the block in the gauge `name` while it runs."""
+    inc(name, 1, **labels)
+    try:
+        yield
+    finally:
+        inc(name, -1, **labels)
+
+
+@contextlib.contextmanager
+def collect_spans():
+    """Collect the spans timed in the block (for Server-Timing)."""
+    spans: list = []
+    token = _spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _spans.reset(token)
+
+
+def start_spans() -> list:
+    """
+    Collect the spans timed from now on in this context (for requests whose
+    start and end are separate hooks) and return the list.
+    """
+    spans: list = []
+    _spans.set(spans)
+    return spans
+
+
+@contextlib.contextmanager
+def collect_counts():
+    """
+    Count the REQUEST_COUNTERS increments made in the block, e.g.
+    {"cache_requests_total{cache=geocode,result=hit}": 1}.
+    """
+    counts: dict = {}
+    token = _counts.set(counts)
+    try:
+        yield counts
+    finally:
+        _counts.reset(token)
+
+
+def start_counts() -> dict:
+    """collect_counts for requests whose start and end are separate hooks."""
+    counts: dict = {}
+    _counts.set(counts)
+    return counts
+
+
+def add_span(name: str, duration: float) -> None:
+    """Add a timing to the spans being collected, if any."""
+    spans = _spans.get()
+    if spans is not None:
+        spans.append((name, duration))
+
+
+@contextlib.contextmanager
+def span(name: str):
+    """Time a lookup stage: lookup_stage_seconds and Server-Timing."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        observe("lookup_stage_seconds", duration, stage=name)
+        add_span(name, duration)
+
+
+def timed(name: str):
+    """Decorator timing a function (or coroutine function) as span `name`."""
+    def decorator(func):
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def server_timing(spans: list) -> str:
+    """
+    Server-Timing header value, durations of a name added up.
+    Example: "geocode;dur=120.5, county;dur=80.1"
+    """
+    totals: dict = {}
+    for name, duration in spans:
+        totals[name] = totals.get(name, 0.0) + duration
+    return ", ".join(f"{name};dur={duration * 1000:.1f}"
+                     for name, duration in totals.items())
+
+
+def _path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"{pid}.json")
+
+
+def _write(path: str, snapshot: dict) -> None:
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+
+
+def flush(force: bool = False) -> None:
+    """Write this worker's metrics file (at most every FLUSH_INTERVAL)."""
+    global _last_flush
+    if not METRICS_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < FLUSH_INTERVAL:
+        return
+    with _flush_lock:
+        _last_flush = now
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            _write(_path(os.getpid()), REGISTRY.snapshot())
+        except OSError as e:
+            logger.warning("Metrics not written to %s: %s", METRICS_DIR, e)
+
+
+def mark_dead(pid: int) -> None:
+    """Drop the gauges of an exited worker, keep its other metrics."""
+    path = _path(pid)
+    try:
+        with open(path, encoding="utf-8") as f:
+            snapshot = json.load(f)
+        snapshot["values"] = [
+            [key, value] for key, value in snapshot["values"]
+            if METRICS.get(key[0], ("counter",))[0] != "gauge"]
+        _write(path, snapshot)
+    except (OSError, ValueError) as e:
+        logger.warning("Metrics of worker %s not updated: %s", pid, e)
+
+
+def clear() -> None:
+    """Remove all workers' files (server start) and this process's metrics."""
+    REGISTRY.clear()
+    if METRICS_DIR:
+        for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+            os.remove(path)
+
+
+def collect() -> tuple:
+    """(values, histograms) added up over all workers."""
+    snapshots = [REGISTRY.snapshot()]
+    if METRICS_DIR:
+        own = _path(os.getpid())
+        for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+            if path == own:
+                continue
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning("Metrics file %s skipped: %s", path, e)
+
+    values: dict = {}
+    histograms: dict = {}
+    for snapshot in snapshots:
+        for key, value in snapshot["values"]:
+            key = tuple(tuple(k) if isinstance(k, list) else k for k in key)
+            values[key] = values.get(key, 0) + value
+        for key, h in snapshot["histograms"]:
+            key = tuple(tuple(k) if isinstance(k, list) else k for k in key)
+            total = histograms.setdefault(key, [0] * len(h))
+            for i, v in enumerate(h):
+                total[i] += v
+    return values, histograms
+
+
+def _labels(pairs, **extra) -> str:
+    items = list(pairs) + list(extra.items())
+    if not items:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"')
+               for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"'
+                          for (k, _), v in zip(items, escaped)) + "}"
+
+
+def render() -> str:
+    """All workers' metrics in the Prometheus text format."""
+    values, histograms = collect()
+    lines: list = []
+    for name, (kind, help) in METRICS.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "histogram":
+            for key in sorted(k for k in histograms if k[0] == name):
+                h = histograms[key]
+                for bound, count in zip(BUCKETS, h):
+                    lines.append(f"{name}_bucket"
+                                 f"{_labels(key[1:], le=bound)} {count}")
+                lines.append(f"{name}_bucket{_labels(key[1:], le='+Inf')} "
+                             f"{h[-1]}")
+                lines.append(f"{name}_sum{_labels(key[1:])} {h[-2]}")
+                lines.append(f"{name}_count{_labels(key[1:])} {h[-1]}")
+        else:
+            for key in sorted(k for k in values if k[0] == name):
+                lines.append(f"{name}{_labels(key[1:])} {values[key]}")
+    return "\n".join(lines) + "\n"
+
+
+def _after_fork() -> None:
+    # a forked worker starts counting from zero in its own file
+    global _flush_lock, _last_flush
+    _flush_lock = threading.Lock()
+    _last_flush = 0.0
+    REGISTRY.clear()
+    REGISTRY._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,219 @@
+"""
+Record and replay upstream traffic.
+
+With UPSTREAM_MODE=record every upstream response (Google and the ArcGIS
+layers) is also written to a fixture store; with UPSTREAM_MODE=replay the
+responses come from the store and no request leaves the process. Requests
+are matched on method, path and query parameters (the API key is left out),
+so fixtures recorded against the live services replay against any build.
+
+Recording appends to one JSON Lines file per process in UPSTREAM_FIXTURES,
+so gunicorn workers never write to the same file. `compact` merges them
+into a single gzipped file:
+
+    UPSTREAM_MODE=record python tests/integration.py
+    python recording.py compact tests/fixtures -o tests/fixtures/upstreams.jsonl.gz
+    UPSTREAM_MODE=replay python tests/integration.py
+
+Settings:
+    UPSTREAM_MODE       live (default), record or replay
+    UPSTREAM_FIXTURES   fixture directory or file (default tests/fixtures)
+    REPLAY_LATENCY      1 to wait as long as the recorded response took
+"""
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR: str = os.path.dirname(os.path.abspath(__file__))
+MODE: str = os.getenv("UPSTREAM_MODE", "live")
+FIXTURES: str = os.getenv("UPSTREAM_FIXTURES",
+                          os.path.join(BASE_DIR, "tests", "fixtures"))
+REPLAY_LATENCY: bool = os.getenv("REPLAY_LATENCY", "0") == "1"
+
+# query parameters that are secrets or don't change the answer
+IGNORED_PARAMS: tuple = ("key",)
+
+
+def request_key(method: str, url: str) -> str:
+    """
+    Identifies a request independent of host and API key.
+    Example: "GET /counties/query?f=json&geometry=-90.3%2C38.5&..."
+    """
+    parts = urlsplit(url)
+    params = sorted((k, v) for k, v in parse_qsl(parts.query)
+                    if k not in IGNORED_PARAMS)
+    return f"{method.upper()} {parts.path}?{urlencode(params)}"
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class FixtureStore:
+    """Recorded responses: request key -> {status, body, elapsed}."""
+
+    def __init__(self, path: str = FIXTURES):
+        self.path = path
+        self.responses: dict = {}
+        self._file = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def files(self) -> list:
+        if os.path.isdir(self.path):
+            return sorted(glob.glob(os.path.join(self.path, "*.jsonl"))
+                          + glob.glob(os.path.join(self.path, "*.jsonl.gz")))
+        return [self.path] if os.path.exists(self.path) else []
+
+    def load(self) -> "FixtureStore":
+        for path in self.files():
+            with _open(path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        # the first recording of a request wins
+                        self.responses.setdefault(entry.pop("key"), entry)
+        logger.info("Loaded %s recorded responses from %s",
+                    len(self.responses), self.path)
+        return self
+
+    def get(self, key: str) -> dict | None:
+        return self.responses.get(key)
+
+    def put(self, key: str, status: int, body: str, elapsed: float) -> None:
+        """Record a response (once per request key)."""
+        try:
+            body = json.loads(body)
+        except ValueError:
+            pass
+        entry = {"status": status, "body": body, "elapsed": round(elapsed, 4)}
+        with self._lock:
+            if key in self.responses:
+                return
+            self.responses[key] = entry
+            if self._file is None or self._pid != os.getpid():
+                # one file per process, so workers never interleave writes
+                os.makedirs(self.path, exist_ok=True)
+                self._pid = os.getpid()
+                self._file = open(
+                    os.path.join(self.path, f"recorded-{self._pid}.jsonl"),
+                    "a", encoding="utf-8")
+            self._file.write(json.dumps(dict(entry, key=key)) + "\n")
+            self._file.flush()
+
+
+def body_text(entry: dict) -> str:
+    body = entry["body"]
+    return body if isinstance(body, str) else json.dumps(body)
+
+
+class RecordingAdapter(HTTPAdapter):
+    """HTTPAdapter that also records every response it receives."""
+
+    def __init__(self, store: FixtureStore, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        self.store.put(request_key(request.method, request.url),
+                       response.status_code, response.text,
+                       response.elapsed.total_seconds())
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """Answers requests from a FixtureStore, never touching the network."""
+
+    def __init__(self, store: FixtureStore):
+        super().__init__()
+        self.store = store
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        key = request_key(request.method, request.url)
+        entry = self.store.get(key)
+        if entry is None:
+            raise requests.exceptions.ConnectionError(
+                f"No recorded response for {key}", request=request)
+        if REPLAY_LATENCY:
+            time.sleep(entry["elapsed"])
+
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response._content = body_text(entry).encode("utf-8")
+        response.headers = CaseInsensitiveDict(
+            {"Content-Type": "application/json"})
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(seconds=entry["elapsed"])
+        return response
+
+    def close(self):
+        pass
+
+
+_store: FixtureStore | None = None
+_store_lock = threading.Lock()
+
+
+def store() -> FixtureStore:
+    """The process's fixture store (loaded for replay)."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = FixtureStore(FIXTURES)
+            if MODE == "replay":
+                _store.load()
+    return _store
+
+
+def adapter(pool_maxsize: int) -> BaseAdapter:
+    """Transport adapter for an upstream session in the current MODE."""
+    if MODE == "replay":
+        return ReplayAdapter(store())
+    if MODE == "record":
+        return RecordingAdapter(store(), pool_connections=1,
+                                pool_maxsize=pool_maxsize)
+    # one host per upstream, so a single pool of `pool_maxsize` connections
+    return HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+
+
+def compact(source: str, output: str) -> int:
+    """Merge recorded files into one (gzipped if `output` ends in .gz)."""
+    fixtures = FixtureStore(source).load()
+    with _open(output, "w") as f:
+        for key, entry in sorted(fixtures.responses.items()):
+            f.write(json.dumps(dict(entry, key=key)) + "\n")
+    return len(fixtures.responses)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upstream fixture tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    compact_parser = sub.add_parser(
+        "compact", help="merge recorded files into one fixture file")
+    compact_parser.add_argument("source", nargs="?", default=FIXTURES,
+                                help="fixture directory or file")
+    compact_parser.add_argument("-o", "--output", required=True)
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        count = compact(args.source, args.output)
+        print(f"{count} responses written to {args.output}")
@@ -0,0 +1,153 @@
+"""
+Reference data used by the eligibility rules.
+
+Each CSV table is parsed once per worker into a case-folded dict index.
+The file's mtime is re-checked at most every `check_interval` seconds and the
+table is reparsed only when it changes. A new index replaces the old one in a
+single assignment, so readers always see a complete table. If an edited file
+is malformed, the error is logged and the previous index stays live.
+"""
+import csv
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR: str = os.path.dirname(os.path.abspath(__file__))
+CSV_DIR: str = os.path.join(BASE_DIR, "csv_files")
+
+
+class ReferenceDataError(Exception):
+    """Raised when a reference table cannot be parsed or validated."""
+
+
+class ReferenceTable:
+    """
+    Case-folded index over one CSV reference table.
+    Maps the value of `key_column` to a tuple of `value_columns`.
+    """
+
+    def __init__(self, path: str, key_column: str, value_columns: tuple,
+                 check_interval: float = 1.0):
+        self.path = path
+        self.key_column = key_column
+        self.value_columns = tuple(value_columns)
+        self.check_interval = check_interval
+
+        self._index: dict | None = None
+        self._mtime_ns: int | None = None
+        self._rejected_mtime_ns: int | None = None
+        self._next_check: float = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fold(key: str) -> str:
+        """Normalize a key for case-insensitive lookups."""
+        return " ".join(key.split()).casefold()
+
+    def parse(self) -> dict:
+        """
+        Parse and validate the CSV file.
+        Raises ReferenceDataError if the table is malformed.
+        """
+        with open(self.path, newline="", encoding="utf-8-sig") as f:
+            reader = csv.DictReader(f)
+            columns = [self.key_column, *self.value_columns]
+            missing = [c for c in columns if c not in (reader.fieldnames or [])]
+            if missing:
+                raise ReferenceDataError(
+                    f"{self.path}: missing column(s) {', '.join(missing)}")
+
+            index: dict = {}
+            for line, row in enumerate(reader, start=2):
+                values = [(row.get(c) or "").strip() for c in columns]
+                if not any(values):
+                    # ignore blank lines
+                    continue
+                if not all(values):
+                    raise ReferenceDataError(
+                        f"{self.path}:{line}: empty value in {columns}")
+
+                key = self.fold(values[0])
+                if key in index:
+                    raise ReferenceDataError(
+                        f"{self.path}:{line}: duplicate key {values[0]!r}")
+                index[key] = tuple(values[1:])
+
+        if not index:
+            raise ReferenceDataError(f"{self.path}: table is empty")
+
+        return index
+
+    def refresh(self, force: bool = False) -> None:
+        """
+        Reload the table if the file's mtime changed.
+        The first load raises on error; later reloads keep the live index.
+        """
+        now = time.monotonic()
+        if not force and self._index is not None and now < self._next_check:
+            return
+
+        with self._lock:
+            self._next_check = now + self.check_interval
+            try:
+                mtime_ns = os.stat(self.path).st_mtime_ns
+            except OSError as e:
+                if self._index is None:
+                    raise ReferenceDataError(f"{self.path}: {e}") from e
+                logger.error("Reference table unavailable, keeping loaded "
+                             "version: %s", e)
+                return
+
+            if mtime_ns in (self._mtime_ns, self._rejected_mtime_ns) and not force:
+                return
+
+            try:
+                index = self.parse()
+            except (OSError, csv.Error, ReferenceDataError) as e:
+                if self._index is None:
+                    raise ReferenceDataError(str(e)) from e
+                self._rejected_mtime_ns = mtime_ns
+                logger.error("Rejected edit to %s, keeping loaded version: %s",
+                             self.path, e)
+                return
+
+            self._index = index
+            self._mtime_ns = mtime_ns
+            self._rejected_mtime_ns = None
+            logger.info("Loaded %s rows from %s", len(index), self.path)
+
+    def get(self, key: str) -> tuple | None:
+        """Returns the value columns for `key`, or None if not listed."""
+        self.refresh()
+        return self._index.get(self.fold(key))
+
+    @property
+    def mtime(self) -> float | None:
+        """Modification time (seconds) of the loaded version of the table."""
+        self.refresh()
+        return None if self._mtime_ns is None else self._mtime_ns / 1e9
+
+
+# counties other than St. Louis County and Jefferson County
+# County -> (Geographic Code, Patron Code)
+OTHER_COUNTIES = ReferenceTable(
+    os.path.join(CSV_DIR, "OtherCounties.csv"),
+    key_column="County",
+    value_columns=("Geographic Code", "Patron Code"))
+
+# St. Louis County library districts
+# Geographic Code -> (Geographic Code, Patron Code)
+ST_LOUIS_COUNTY = ReferenceTable(
+    os.path.join(CSV_DIR, "StLouisCounty.csv"),
+    key_column="Geographic Code",
+    value_columns=("Geographic Code", "Patron Code"))
+
+TABLES: tuple = (OTHER_COUNTIES, ST_LOUIS_COUNTY)
+
+
+def version() -> str:
+    """Identifies the currently loaded reference data (combined mtimes)."""
+    return "-".join(str(int((t.mtime or 0) * 1000)) for t in TABLES)
@@ -0,0 +1,153 @@
+"""
+Replay a lookup journal (see journal.py) against a running instance.
+
+Every journaled lookup is sent again as GET /api/v1/lookup at its original
+offset from the first one, divided by --speed (2 replays the traffic twice
+as fast), or at a fixed --rate per second. The report has the latency
+percentiles, the status counts, how late requests were sent (the client
+falling behind), and the answers whose geo or patron code differs from the
+journal (regressions, or changed reference data).
+
+Example:
+    python replay.py cache/journal/lookups.jsonl --url http://localhost:8000
+    python replay.py cache/journal/lookups.jsonl* --speed 4 --concurrency 64
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+def read_journal(paths: list) -> list:
+    """Lookup records of the journal files, oldest first."""
+    records: list = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                if record.get("street") and record.get("zip"):
+                    records.append(record)
+    records.sort(key=lambda r: r["ts"])
+    return records
+
+
+def schedule(records: list, speed: float = 1.0,
+             rate: float | None = None) -> list:
+    """Seconds after the start at which each record is sent again."""
+    if rate:
+        return [i / rate for i in range(len(records))]
+    start = records[0]["ts"] if records else 0.0
+    return [(r["ts"] - start) / speed for r in records]
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def replay(records: list, url: str, speed: float = 1.0,
+           rate: float | None = None, concurrency: int = 32,
+           session=None) -> dict:
+    """
+    Send the records and return the results:
+    {"latencies": [...], "lags": [...], "statuses": {...}, "mismatches": [...]}
+    """
+    session = session or requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    results: dict = {"latencies": [], "lags": [], "statuses": {},
+                     "mismatches": []}
+    lock = threading.Lock()
+    endpoint: str = url.rstrip("/") + "/api/v1/lookup"
+
+    def send(record: dict, due: float) -> None:
+        lag = time.monotonic() - due
+        start = time.monotonic()
+        try:
+            response = session.get(endpoint, timeout=60, params={
+                "street": record["street"], "zip": record["zip"]})
+            status = str(response.status_code)
+            answer = response.json() if response.status_code == 200 else None
+        except (requests.RequestException, ValueError) as e:
+            status, answer = type(e).__name__, None
+        latency = time.monotonic() - start
+
+        with lock:
+            results["latencies"].append(latency)
+            results["lags"].append(max(0.0, lag))
+            results["statuses"][status] = results["statuses"].get(status,
+                                                                  0) + 1
+            if answer is not None and record.get("geo_code") is not None and (
+                    (answer.get("geo_code"), answer.get("patron_code"))
+                    != (record["geo_code"], record.get("patron_code"))):
+                results["mismatches"].append({
+                    "key": record.get("key"),
+                    "journal": [record["geo_code"], record.get("patron_code")],
+                    "replay": [answer.get("geo_code"),
+                               answer.get("patron_code")]})
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for record, offset in zip(records, schedule(records, speed, rate)):
+            due = start + offset
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            executor.submit(send, record, due)
+    results["elapsed"] = time.monotonic() - start
+    return results
+
+
+def report(results: dict) -> str:
+    latencies = results["latencies"]
+    lines: list = [
+        f"{len(latencies)} lookups in {results.get('elapsed', 0):.1f} s "
+        f"({len(latencies) / max(results.get('elapsed', 0), 1e-9):.1f}/s)",
+        "latency ms: " + ", ".join(
+            f"p{p} {percentile(latencies, p) * 1000:.0f}"
+            for p in (50, 90, 99)),
+        f"send lag ms: p99 {percentile(results['lags'], 99) * 1000:.0f}",
+        "statuses: " + ", ".join(f"{k} {v}" for k, v in
+                                 sorted(results["statuses"].items())),
+        f"answers different from the journal: {len(results['mismatches'])}",
+    ]
+    for m in results["mismatches"][:20]:
+        lines.append(f"  {m['key']}: {m['journal']} -> {m['replay']}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a lookup journal")
+    parser.add_argument("journal", nargs="+", help="journal file(s)")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay this many times faster than recorded")
+    parser.add_argument("--rate", type=float,
+                        help="send this many lookups per second instead")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--limit", type=int, help="replay the first N only")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    records = read_journal(args.journal)[:args.limit]
+    if not records:
+        sys.exit("No lookups in the journal")
+    results = replay(records, args.url, args.speed, args.rate,
+                     args.concurrency)
+    print(report(results))
+    sys.exit(1 if results["mismatches"] else 0)
@@ -0,0 +1,460 @@
+"""
+Time budgets and retries for upstream calls.
+
+A lookup runs under a Deadline (LOOKUP_BUDGET seconds by default, below
+gunicorn's 30 second timeout). The deadline is kept in a context variable,
+so every upstream call made for the lookup sees it, including calls in
+fan-out threads (which copy the context) and asyncio tasks. Upstream
+timeouts are clamped to the remaining budget, and `retry` waits with
+jittered exponential backoff only when the remaining budget still leaves
+room for another attempt.
+
+Each upstream also has a CircuitBreaker per worker. Once too many recent calls
+failed or were slow it opens and calls fail fast with CircuitOpen, so the
+caches can answer with their last known (stale) values instead of every
+request waiting out the timeouts. After BREAKER_RESET seconds one probe call
+is let through (half-open); it closes the breaker again if it succeeds.
+
+Settings:
+    LOOKUP_BUDGET           total seconds for one lookup (default 20)
+    BREAKER_WINDOW          recent calls a breaker looks at (default 20)
+    BREAKER_MIN_CALLS       calls needed before it can open (default 5)
+    BREAKER_FAILURE_RATE    share of failed calls that opens it (default 0.5)
+    BREAKER_SLOW_CALL       seconds after which a call counts as slow
+                            (default 5)
+    BREAKER_SLOW_RATE       share of slow calls that opens it (default 0.5)
+    BREAKER_RESET           seconds open before a probe call (default 30)
+"""
+import contextlib
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LOOKUP_BUDGET: float = float(os.getenv("LOOKUP_BUDGET", 20))
+
+# don't start an attempt with less time than this left
+MIN_ATTEMPT_TIME: float = 0.5
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a lookup has no time left for an upstream call."""
+
+
+class RetryableError(Exception):
+    """An upstream answer that asks to be retried (e.g. OVER_QUERY_LIMIT)."""
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an upstream whose breaker is open."""
+
+
+class Deadline:
+    """
+    Point in time (monotonic clock) by which a lookup must finish.
+    Also collects the upstreams the lookup answered from stale cache.
+    """
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires = time.monotonic() + budget
+        self.stale: set = set()
+
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+
+_deadline: contextvars.ContextVar = contextvars.ContextVar("deadline",
+                                                           default=None)
+
+
+def current() -> Deadline | None:
+    """The deadline of the running lookup, if any."""
+    return _deadline.get()
+
+
+def remaining() -> float | None:
+    """Seconds left in the running lookup's budget (None: no deadline)."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline.remaining()
+
+
+@contextlib.contextmanager
+def budget(seconds: float | None = None):
+    """
+    Run the block under a deadline of `seconds` (default: LOOKUP_BUDGET).
+    A block nested in another deadline keeps the outer (shared) one.
+    """
+    if _deadline.get() is not None:
+        yield _deadline.get()
+        return
+
+    token = _deadline.set(Deadline(LOOKUP_BUDGET if seconds is None
+                                   else seconds))
+    try:
+        yield _deadline.get()
+    finally:
+        _deadline.reset(token)
+
+
+def mark_stale(name: str) -> None:
+    """Record that the running lookup used a stale answer for `name`."""
+    deadline = _deadline.get()
+    if deadline is not None:
+        deadline.stale.add(name)
+
+
+def stale() -> set:
+    """Upstreams the running lookup answered from stale cache."""
+    deadline = _deadline.get()
+    return set() if deadline is None else set(deadline.stale)
+
+
+def submit(executor, fn, *args):
+    """executor.submit that runs `fn` under the caller's deadline."""
+    # a context can only be entered by one thread at a time, copy per task
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def timeout(connect: float = 3, read: float = 10) -> tuple:
+    """
+    (connect, read) timeouts clamped to the remaining budget.
+    Raises DeadlineExceeded if the budget is used up.
+    """
+    left = remaining()
+    if left is None:
+        return connect, read
+    if left <= 0:
+        raise DeadlineExceeded("Lookup time budget exhausted")
+    return min(connect, left), min(read, left)
+
+
+def status_code(e: Exception) -> int | None:
+    """HTTP status of a requests/httpx error, if it carries a response."""
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+
+def retry_after(e: Exception) -> float:
+    """Seconds asked for by a Retry-After header (0 if none)."""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return max(0.0, float(headers.get("Retry-After", 0)))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def retry(max_attempts=3, delay=1, backoff=1, exceptions=(Exception,),
+          retry_statuses=()):
+    """
+    Define decorator function for retries if APIs time out.
+
+    Retries errors in `exceptions`, HTTP errors whose status is in
+    `retry_statuses` (other HTTP errors are not retried) and RetryableError.
+    Waits are jittered (between half and all of the backoff delay, or longer
+    if the upstream sent Retry-After) and a retry is skipped when the
+    lookup's remaining budget can't cover the wait plus another attempt.
+    Works for coroutine functions too (waits with asyncio.sleep).
+    """
+    def should_retry(e: Exception) -> bool:
+        if isinstance(e, RetryableError):
+            return True
+        status = status_code(e)
+        if status is not None:
+            return status in retry_statuses
+        return isinstance(e, exceptions)
+
+    def decorator(func):
+
+        def next_wait(attempt: int, e: Exception, current_delay: float):
+            """Seconds to wait before the next attempt, or None to give up."""
+            if attempt == max_attempts or not should_retry(e):
+                if attempt == max_attempts:
+                    logger.error("Max retries reached for %s", func.__name__)
+                return None
+
+            wait = max(current_delay * random.uniform(0.5, 1), retry_after(e))
+            left = remaining()
+            if left is not None and left < wait + MIN_ATTEMPT_TIME:
+                logger.error(
+                    "Not retrying %s: %.1fs left in the lookup budget",
+                    func.__name__, left)
+                return None
+
+            metrics.inc("upstream_retries_total", function=func.__name__)
+            logger.warning(
+                "Attempt %s failed for %s: %s. Retrying in %.2fs",
+                attempt,
+                func.__name__,
+                e,
+                wait,
+            )
+            return wait
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                # only imported by the async pipeline
+                import asyncio
+
+                current_delay = delay
+
+                for attempt in range(1, max_attempts + 1):
+                    try:
+                        return await func(*args, **kwargs)
+
+                    except Exception as e:
+                        wait = next_wait(attempt, e, current_delay)
+                        if wait is None:
+                            raise
+                        await asyncio.sleep(wait)
+                        current_delay *= backoff
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+
+            current_delay = delay
+
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    return func(*args, **kwargs)
+
+                except Exception as e:
+                    wait = next_wait(attempt, e, current_delay)
+                    if wait is None:
+                        raise
+                    # bounded by the lookup budget (see next_wait)
+                    time.sleep(wait)
+                    current_delay *= backoff
+
+        return wrapper
+
+    return decorator
+
+
+def is_upstream_failure(e: Exception, exceptions: tuple = ()) -> bool:
+    """
+    Whether an error means the upstream is unhealthy: one of `exceptions`
+    (timeouts, connection errors), a 429/5xx answer or a RetryableError.
+    Errors about the answer itself (address not found) are not failures.
+    """
+    if isinstance(e, RetryableError):
+        return True
+    status = status_code(e)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(e, exceptions)
+
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open breaker for one upstream, judged on the last
+    `window` calls: it opens when at least `min_calls` were made and the
+    share of failed or slow calls reaches `failure_rate` or `slow_rate`.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5,
+                 failure_rate: float = 0.5, slow_call: float = 5.0,
+                 slow_rate: float = 0.5, reset_timeout: float = 30.0):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened_at: float | None = None
+        self.rejected = 0
+        # (failed, slow) of recent calls
+        self._calls: deque = deque(maxlen=window)
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> None:
+        """Raise CircuitOpen unless a call may go to the upstream now."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if (self.state == self.OPEN and time.monotonic()
+                    - self.opened_at >= self.reset_timeout):
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+        raise CircuitOpen(f"{self.name} circuit is open")
+
+    def record(self, failed: bool, duration: float) -> None:
+        """Record the outcome of a call let through by allow()."""
+        slow = duration >= self.slow_call
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if failed or slow:
+                    self._open()
+                else:
+                    self._calls.clear()
+                    self._set_state(self.CLOSED)
+                return
+
+            self._calls.append((failed, slow))
+            if self.state == self.CLOSED and len(self._calls) >= self.min_calls:
+                failures = sum(f for f, _ in self._calls) / len(self._calls)
+                slow_calls = sum(s for _, s in self._calls) / len(self._calls)
+                if (failures >= self.failure_rate
+                        or slow_calls >= self.slow_rate):
+                    self._open()
+
+    def release(self) -> None:
+        """Forget a call that ended without an outcome (cancelled)."""
+        with self._lock:
+            self._probing = False
+
+    def _open(self) -> None:
+        self.opened_at = time.monotonic()
+        self._set_state(self.OPEN)
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            log = logger.info if state == self.CLOSED else logger.warning
+            log("Circuit for %s is %s", self.name, state.replace("_", "-"))
+        self.state = state
+
+    def snapshot(self) -> dict:
+        """State for monitoring."""
+        with self._lock:
+            calls = len(self._calls)
+            return {
+                "state": self.state,
+                "calls": calls,
+                "failures": sum(f for f, _ in self._calls),
+                "slow_calls": sum(s for _, s in self._calls),
+                "rejected": self.rejected,
+                "open_for": (round(time.monotonic() - self.opened_at, 1)
+                             if self.state != self.CLOSED else None),
+            }
+
+
+_breakers: dict = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(name: str) -> CircuitBreaker:
+    """The worker's breaker for an upstream, created on first use."""
+    b = _breakers.get(name)
+    if b is not None:
+        return b
+    with _breakers_lock:
+        b = _breakers.get(name)
+        if b is None:
+            b = CircuitBreaker(
+                name,
+                window=int(os.getenv("BREAKER_WINDOW", 20)),
+                min_calls=int(os.getenv("BREAKER_MIN_CALLS", 5)),
+                failure_rate=float(os.getenv("BREAKER_FAILURE_RATE", 0.5)),
+                slow_call=float(os.getenv("BREAKER_SLOW_CALL", 5)),
+                slow_rate=float(os.getenv("BREAKER_SLOW_RATE", 0.5)),
+                reset_timeout=float(os.getenv("BREAKER_RESET", 30)))
+            _breakers[name] = b
+    return b
+
+
+def breaker_states() -> dict:
+    """Upstream name -> breaker snapshot, for this worker."""
+    return {name: b.snapshot() for name, b in sorted(_breakers.items())}
+
+
+def reset_breakers() -> None:
+    """Forget all breakers (also done in a forked child)."""
+    global _breakers_lock
+    _breakers_lock = threading.Lock()
+    _breakers.clear()
+
+
+os.register_at_fork(after_in_child=reset_breakers)
+
+
+def _allow(b: CircuitBreaker) -> None:
+    try:
+        b.allow()
+    except CircuitOpen:
+        metrics.inc("upstream_requests_total", upstream=b.name,
+                    outcome="rejected")
+        raise
+
+
+def _record(b: CircuitBreaker, failed: bool, duration: float) -> None:
+    b.record(failed, duration)
+    metrics.observe("upstream_request_seconds", duration, upstream=b.name)
+    metrics.inc("upstream_requests_total", upstream=b.name,
+                outcome="failure" if failed else "ok")
+    metrics.add_span(b.name, duration)
+
+
+def circuit(name: str, exceptions: tuple = ()):
+    """
+    Decorator guarding an upstream call with the breaker `name`.
+    Raises CircuitOpen without calling while the breaker is open; see
+    is_upstream_failure for what counts as a failure. Put it under @retry,
+    so every attempt is counted and an open breaker stops the retries.
+    Each attempt is also recorded in the upstream metrics and spans.
+    """
+    def decorator(func):
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                b = breaker(name)
+                _allow(b)
+                start = time.monotonic()
+                try:
+                    with metrics.in_flight("upstream_in_flight",
+                                           upstream=name):
+                        result = await func(*args, **kwargs)
+                except Exception as e:
+                    _record(b, is_upstream_failure(e, exceptions),
+                            time.monotonic() - start)
+                    raise
+                except BaseException:
+                    # cancelled: an unneeded fan-out query, not an outcome
+                    b.release()
+                    raise
+                _record(b, False, time.monotonic() - start)
+                return result
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            b = breaker(name)
+            _allow(b)
+            start = time.monotonic()
+            try:
+                with metrics.in_flight("upstream_in_flight", upstream=name):
+                    result = func(*args, **kwargs)
+            except Exception as e:
+                _record(b, is_upstream_failure(e, exceptions),
+                        time.monotonic() - start)
+                raise
+            _record(b, False, time.monotonic() - start)
+            return result
+
+        return wrapper
+
+    return decorator
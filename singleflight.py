@@ -0,0 +1,251 @@
+"""
+Single-flight coalescing of identical lookups.
+
+When the same address is looked up again while a lookup for it is still
+running (two desks at once, a double-clicked submit button), the newcomer
+waits for the running lookup and gets its result or error instead of
+starting another upstream chain.
+
+SingleFlight does this for threads in one worker and AsyncSingleFlight for
+tasks on one event loop. With SINGLE_FLIGHT_SHARED=1, SharedFlights also
+coalesces across gunicorn workers: the first worker takes a lease in the
+shared SQLite cache file, and the others poll for the result it publishes
+there (bounded by the lookup's time budget). SharedFlights.do_async does
+the same for the asyncio pipeline.
+
+Settings:
+    SINGLE_FLIGHT           0 to turn coalescing off (default 1)
+    SINGLE_FLIGHT_SHARED    1 to coalesce across workers too (default 0)
+"""
+import logging
+import os
+import threading
+import time
+
+import cache
+import resilience
+
+logger = logging.getLogger(__name__)
+
+ENABLED: bool = os.getenv("SINGLE_FLIGHT", "1") == "1"
+SHARED: bool = os.getenv("SINGLE_FLIGHT_SHARED", "0") == "1"
+
+# seconds a published result stays readable for waiting workers
+RESULT_TTL: float = 5.0
+POLL_INTERVAL: float = 0.05
+# SharedFlights.poll: the lease holder hasn't published yet
+RUNNING = object()
+
+
+class _Call:
+    """One running call and its outcome."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time in this process."""
+
+    def __init__(self):
+        self._calls: dict = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn, *args):
+        """
+        Returns fn(*args), or the outcome of the call already running for
+        `key` (its exception is raised to every waiter).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if call.waiters:
+                logger.info("Coalesced %s identical lookups", call.waiters)
+            call.done.set()
+
+    def reset(self) -> None:
+        # after fork: the parent's running calls never finish in the child
+        self._calls.clear()
+        self._lock = threading.Lock()
+
+
+class AsyncSingleFlight:
+    """Runs at most one coroutine per key at a time on an event loop."""
+
+    def __init__(self):
+        self._tasks: dict = {}
+
+    async def do(self, key: str, fn, *args):
+        """Returns await fn(*args), sharing a running call for `key`."""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        task = self._tasks.get((loop, key))
+        if task is None:
+            task = loop.create_task(fn(*args))
+            self._tasks[(loop, key)] = task
+            task.add_done_callback(
+                lambda _: self._tasks.pop((loop, key), None))
+        # a waiter being cancelled must not cancel the shared call
+        return await asyncio.shield(task)
+
+
+class SharedFlights:
+    """
+    Cross-worker coalescing through the shared SQLite cache file: a lease
+    row marks the running lookup, a result row carries its outcome.
+    """
+
+    def __init__(self, path: str | None = cache.CACHE_PATH):
+        self.leases = (cache.SQLiteStore(path, "flight:lease",
+                                         ttl=resilience.LOOKUP_BUDGET)
+                       if path else None)
+        self.results = (cache.SQLiteStore(path, "flight:result",
+                                          ttl=RESULT_TTL)
+                        if path else None)
+
+    def do(self, key: str, fn, *args):
+        """
+        Returns fn(*args), or the outcome another worker publishes for `key`
+        while this one waits. Calls fn itself if the other worker goes away
+        without publishing (its lease expires after LOOKUP_BUDGET).
+        """
+        if self.leases is None:
+            return fn(*args)
+
+        while not self.leases.add(key, os.getpid()):
+            outcome = self.wait(key)
+            if outcome is not None:
+                return self.follow(outcome)
+            self.check_taken_over(key)
+        # the outcome of an earlier lookup must not answer this one's waiters
+        self.results.delete(key)
+
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self.publish(key, {"error": str(e), "type": type(e).__name__})
+            raise
+        else:
+            self.publish(key, {"result": result})
+            return result
+
+    async def do_async(self, key: str, fn, *args):
+        """
+        Same as do for a coroutine function fn; the shared store is used
+        from worker threads so the event loop never waits on SQLite.
+        """
+        import asyncio
+
+        if self.leases is None:
+            return await fn(*args)
+
+        while not await asyncio.to_thread(self.leases.add, key, os.getpid()):
+            while True:
+                outcome = await asyncio.to_thread(self.poll, key)
+                if outcome is not RUNNING:
+                    break
+                await asyncio.sleep(POLL_INTERVAL)
+            if outcome is not None:
+                return self.follow(outcome)
+            await asyncio.to_thread(self.check_taken_over, key)
+        await asyncio.to_thread(self.results.delete, key)
+
+        try:
+            result = await fn(*args)
+        except Exception as e:
+            await asyncio.to_thread(self.publish, key, {
+                "error": str(e), "type": type(e).__name__})
+            raise
+        else:
+            await asyncio.to_thread(self.publish, key, {"result": result})
+            return result
+
+    def wait(self, key: str) -> dict | None:
+        """
+        Poll for the outcome of the lease holder's lookup.
+        Returns None if the lease went away without one.
+        """
+        while True:
+            outcome = self.poll(key)
+            if outcome is not RUNNING:
+                return outcome
+            time.sleep(POLL_INTERVAL)
+
+    def poll(self, key: str):
+        """
+        The published outcome for `key`; RUNNING while the lease holder is
+        still at it and the lookup has time to wait, None otherwise.
+        """
+        outcome = self.results.get(key)
+        if outcome is not None:
+            return outcome
+        if self.leases.get(key) is None:
+            return self.results.get(key)
+        left = resilience.remaining()
+        if left is not None and left < POLL_INTERVAL:
+            return None
+        return RUNNING
+
+    def check_taken_over(self, key: str) -> None:
+        """
+        After a wait without outcome: raises DeadlineExceeded if the lease
+        holder is still running, otherwise the caller takes over.
+        """
+        if self.leases.get(key) is not None:
+            raise resilience.DeadlineExceeded(
+                "Lookup time budget exhausted waiting for another worker")
+
+    @staticmethod
+    def follow(outcome: dict):
+        """The published result, or its error raised."""
+        if "error" in outcome:
+            raise error(outcome)
+        return outcome["result"]
+
+    def publish(self, key: str, outcome: dict) -> None:
+        self.results.set(key, outcome)
+        self.leases.delete(key)
+
+
+def error(outcome: dict) -> Exception:
+    """
+    The exception another worker's lookup raised, of the same type when it
+    is one that lookups handle specially, otherwise an Exception.
+    """
+    import main
+
+    types: dict = {t.__name__: t for t in (
+        main.AddressNotFound, resilience.CircuitOpen,
+        resilience.DeadlineExceeded)}
+    return types.get(outcome.get("type"), Exception)(outcome["error"])
+
+
+LOOKUPS = SingleFlight()
+ASYNC_LOOKUPS = AsyncSingleFlight()
+SHARED_LOOKUPS = SharedFlights()
+
+os.register_at_fork(after_in_child=LOOKUPS.reset)
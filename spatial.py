@@ -0,0 +1,602 @@
+"""
+Local jurisdiction engine.
+
+Answers the county, St. Louis County library district and Jefferson County
+school district questions from local polygon snapshots of the ArcGIS layers
+instead of live FeatureServer queries. Each layer keeps a grid of buckets
+(GRID_SIZE degrees square) listing the features whose bounding box touches
+the bucket, so a point is only tested against a few polygons.
+
+The snapshot is one binary file (SNAPSHOT_FILE) holding all layers,
+simplified within SNAPSHOT_TOLERANCE degrees, with a version stamp:
+    python spatial.py build
+
+Workers memory-map it, so opening it costs next to nothing and all workers
+share its pages. `build` re-downloads only the layers whose upstream edit
+date changed, writes a new file and swaps it in atomically; workers pick it
+up within CHECK_INTERVAL seconds. GeoJSON files in SNAPSHOT_DIR (written by
+`python spatial.py fetch`) are still read when there is no snapshot file.
+
+Snapshot file layout (little-endian, sections 8-byte aligned):
+    "JSNP", format version (uint32), header length (uint32), JSON header
+    per layer: features  (value index, first ring, ring count, 0: uint32;
+                          min x, min y, max x, max y: float64)
+               rings     (first coordinate, coordinate count: uint32)
+               coords    (x0, y0, x1, y1, ...: float64)
+The header has the version stamp and, per layer, the attribute values,
+section offsets and sizes, upstream edit date and tolerance.
+
+Settings:
+    JURISDICTION_BACKEND  "auto" (local when snapshots exist), "local" or
+                          "arcgis"
+    SNAPSHOT_DIR          directory with the snapshots (default data/snapshots)
+    SNAPSHOT_FILE         binary snapshot (default SNAPSHOT_DIR/
+                          jurisdictions.snap)
+    SNAPSHOT_TOLERANCE    simplification tolerance in degrees (default
+                          0.00001, about 1 m)
+"""
+import argparse
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR: str = os.path.dirname(os.path.abspath(__file__))
+SNAPSHOT_DIR: str = os.getenv("SNAPSHOT_DIR",
+                              os.path.join(BASE_DIR, "data", "snapshots"))
+SNAPSHOT_FILE: str = os.getenv(
+    "SNAPSHOT_FILE", os.path.join(SNAPSHOT_DIR, "jurisdictions.snap"))
+TOLERANCE: float = float(os.getenv("SNAPSHOT_TOLERANCE", "0.00001"))
+BACKEND: str = os.getenv("JURISDICTION_BACKEND", "auto").lower()
+
+GRID_SIZE: float = 0.05
+# seconds between checks for a new snapshot file
+CHECK_INTERVAL: float = 5.0
+
+MAGIC: bytes = b"JSNP"
+FORMAT_VERSION: int = 1
+PREAMBLE = struct.Struct("<4sII")
+FEATURE = struct.Struct("<4I4d")
+RING = struct.Struct("<2I")
+
+# snapshot name -> upstream (see clients.UPSTREAMS), attribute, query filter
+LAYERS: dict = {
+    "counties": {
+        "upstream": "counties",
+        "field": "NAME",
+        "where": "STATE_NAME IN ('Missouri', 'Illinois')",
+    },
+    "slc": {
+        "upstream": "slc",
+        "field": "LIBRARY_DISTRICT",
+        "where": "1=1",
+    },
+    "jeffco": {
+        "upstream": "jeffco",
+        "field": "Name",
+        "where": "1=1",
+    },
+}
+
+
+def ring_contains(coords, x: float, y: float) -> bool:
+    """
+    Even-odd ray casting test against one ring.
+    `coords` is a flat sequence: x0, y0, x1, y1, ...
+    """
+    inside = False
+    n = len(coords) // 2
+    xj, yj = coords[2 * n - 2], coords[2 * n - 1]
+    for i in range(0, 2 * n, 2):
+        xi, yi = coords[i], coords[i + 1]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        xj, yj = xi, yi
+    return inside
+
+
+class Feature:
+    """One polygon (or multipolygon) with its attribute value."""
+
+    __slots__ = ("value", "rings", "bbox")
+
+    def __init__(self, value: str, rings: list, bbox: tuple | None = None):
+        self.value = value
+        # flat coordinate sequences: arrays, or views into a snapshot file
+        self.rings = rings
+        if bbox is None:
+            xs = [c for ring in rings for c in ring[0::2]]
+            ys = [c for ring in rings for c in ring[1::2]]
+            bbox = (min(xs), min(ys), max(xs), max(ys))
+        self.bbox = bbox
+
+    def contains(self, x: float, y: float) -> bool:
+        minx, miny, maxx, maxy = self.bbox
+        if not (minx <= x <= maxx and miny <= y <= maxy):
+            return False
+        # even-odd across all rings handles holes and multipolygons
+        inside = False
+        for ring in self.rings:
+            if ring_contains(ring, x, y):
+                inside = not inside
+        return inside
+
+
+class Layer:
+    """Features of one snapshot with a grid bucket index."""
+
+    def __init__(self, name: str, features: list, grid_size: float = GRID_SIZE):
+        self.name = name
+        self.features = features
+        self.grid_size = grid_size
+        self.grid: dict = {}
+
+        for i, feature in enumerate(features):
+            minx, miny, maxx, maxy = feature.bbox
+            for gx in range(self._cell(minx), self._cell(maxx) + 1):
+                for gy in range(self._cell(miny), self._cell(maxy) + 1):
+                    self.grid.setdefault((gx, gy), []).append(i)
+
+    def _cell(self, value: float) -> int:
+        return int(value // self.grid_size)
+
+    @classmethod
+    def from_geojson(cls, name: str, data: dict, field: str) -> "Layer":
+        features: list = []
+        for value, rings in geojson_features(data, field):
+            features.append(Feature(value, [
+                array("d", [c for point in ring for c in point[:2]])
+                for ring in rings]))
+        return cls(name, features)
+
+    def locate(self, lng: float, lat: float) -> str | None:
+        """Attribute value of the feature containing the point, or None."""
+        for i in self.grid.get((self._cell(lng), self._cell(lat)), ()):
+            if self.features[i].contains(lng, lat):
+                return self.features[i].value
+        return None
+
+
+def geojson_features(data: dict, field: str):
+    """Yields (value, rings) for the polygon features of a GeoJSON layer."""
+    for f in data.get("features", []):
+        geometry = f.get("geometry") or {}
+        value = (f.get("properties") or {}).get(field)
+        if value is None:
+            continue
+
+        if geometry.get("type") == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            continue
+
+        rings = [ring for polygon in polygons for ring in polygon if ring]
+        if rings:
+            yield value, rings
+
+
+def simplify(ring: list, tolerance: float) -> list:
+    """
+    Douglas-Peucker simplification of a closed ring of [x, y] points.
+    A ring that would drop below four points is kept as it is.
+    """
+    if tolerance <= 0 or len(ring) <= 4:
+        return ring
+    keep = [False] * len(ring)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(ring) - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = ring[first][0], ring[first][1]
+        x2, y2 = ring[last][0], ring[last][1]
+        dx, dy = x2 - x1, y2 - y1
+        length = math.hypot(dx, dy)
+        farthest, distance = None, 0.0
+        for i in range(first + 1, last):
+            px, py = ring[i][0], ring[i][1]
+            if length == 0:
+                d = math.hypot(px - x1, py - y1)
+            else:
+                d = abs(dy * px - dx * py + x2 * y1 - y2 * x1) / length
+            if d > distance:
+                farthest, distance = i, d
+        if farthest is not None and distance > tolerance:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    simplified = [point for point, k in zip(ring, keep) if k]
+    return simplified if len(simplified) >= 4 else ring
+
+
+def pack_layer(data: dict, field: str, tolerance: float = TOLERANCE) -> dict:
+    """
+    Simplify a GeoJSON layer into the sections of a snapshot layer:
+    {"values": [...], "features": bytes, "rings": bytes, "coords": bytes}
+    """
+    values: list = []
+    value_index: dict = {}
+    features = bytearray()
+    rings = bytearray()
+    coords = array("d")
+    ring_count = 0
+    for value, polygon_rings in geojson_features(data, field):
+        first_ring = ring_count
+        first_coord = len(coords)
+        for ring in polygon_rings:
+            ring = simplify(ring, tolerance)
+            rings += RING.pack(len(coords), 2 * len(ring))
+            for point in ring:
+                coords.extend(point[:2])
+            ring_count += 1
+
+        xs = coords[first_coord::2]
+        ys = coords[first_coord + 1::2]
+        if value not in value_index:
+            value_index[value] = len(values)
+            values.append(value)
+        features += FEATURE.pack(value_index[value], first_ring,
+                                 ring_count - first_ring, 0,
+                                 min(xs), min(ys), max(xs), max(ys))
+
+    if sys.byteorder != "little":
+        coords.byteswap()
+    return {"values": values, "features": bytes(features),
+            "rings": bytes(rings), "coords": coords.tobytes()}
+
+
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % 8)
+
+
+def write_snapshot(path: str, layers: dict, version: str | None = None) -> str:
+    """
+    Write packed layers to `path`, replacing it atomically.
+    `layers`: name -> pack_layer() sections plus "field", "edit_date" and
+    "tolerance". Returns the version stamp.
+    """
+    version = version or time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    header: dict = {"version": version, "layers": {}}
+    chunks: list = []
+    offset = 0
+    for name, layer in layers.items():
+        entry: dict = {key: layer.get(key) for key in
+                       ("field", "edit_date", "tolerance", "values")}
+        for part in ("features", "rings", "coords"):
+            data: bytes = layer[part]
+            # offsets count from the end of the header
+            entry[part] = [offset, len(data)]
+            chunks += [data, _padding(len(data))]
+            offset += len(data) + len(_padding(len(data)))
+        header["layers"][name] = entry
+
+    head: bytes = json.dumps(header).encode("utf-8")
+    head += b" " * (-(PREAMBLE.size + len(head)) % 8)
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(head)))
+        f.write(head)
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp, path)
+    return version
+
+
+class Snapshot:
+    """A memory-mapped snapshot file."""
+
+    def __init__(self, buffer, header: dict, data_start: int):
+        self.buffer = buffer
+        self.header = header
+        self.data_start = data_start
+
+    @classmethod
+    def open(cls, path: str = SNAPSHOT_FILE) -> "Snapshot":
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, size = PREAMBLE.unpack_from(buffer, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(
+                f"{path} is not a version {FORMAT_VERSION} snapshot")
+        header = json.loads(
+            bytes(buffer[PREAMBLE.size:PREAMBLE.size + size]))
+        return cls(buffer, header, PREAMBLE.size + size)
+
+    @property
+    def version(self) -> str:
+        return self.header["version"]
+
+    def section(self, name: str, part: str) -> memoryview:
+        offset, length = self.header["layers"][name][part]
+        start = self.data_start + offset
+        return memoryview(self.buffer)[start:start + length]
+
+    def packed(self, name: str) -> dict:
+        """A layer as write_snapshot takes it (to carry it over)."""
+        layer: dict = dict(self.header["layers"][name])
+        for part in ("features", "rings", "coords"):
+            layer[part] = bytes(self.section(name, part))
+        return layer
+
+    def layer(self, name: str) -> Layer:
+        """A Layer whose rings are views into the mapped file."""
+        values: list = self.header["layers"][name]["values"]
+        coords = self.section(name, "coords")
+        if sys.byteorder == "little":
+            coords = coords.cast("d")
+        else:
+            coords = array("d", coords.tobytes())
+            coords.byteswap()
+        rings: list = [coords[start:start + count] for start, count
+                       in RING.iter_unpack(self.section(name, "rings"))]
+        features: list = [
+            Feature(values[value], rings[first:first + count], tuple(bbox))
+            for value, first, count, _, *bbox
+            in FEATURE.iter_unpack(self.section(name, "features"))]
+        return Layer(name, features)
+
+
+class SpatialEngine:
+    """
+    Local answers with the same shapes as the ArcGIS functions in main.py.
+    Each method returns None when the point isn't covered by the snapshot,
+    so the caller can fall back to ArcGIS.
+    """
+
+    def __init__(self, layers: dict, mtime: float = 0.0,
+                 version: str | None = None):
+        self.layers = layers
+        # modification time of the newest snapshot file
+        self.mtime = mtime
+        # version stamp of a binary snapshot
+        self.version = version
+
+    @classmethod
+    def open(cls, path: str = SNAPSHOT_FILE) -> "SpatialEngine":
+        """Memory-map a binary snapshot (see the module docstring)."""
+        snapshot = Snapshot.open(path)
+        layers: dict = {name: snapshot.layer(name)
+                        for name in snapshot.header["layers"]}
+        logger.info("Mapped snapshot %s (%s) from %s", snapshot.version,
+                    ", ".join(f"{name}: {len(layer.features)} features"
+                              for name, layer in layers.items()), path)
+        return cls(layers, os.path.getmtime(path), snapshot.version)
+
+    @classmethod
+    def load(cls, directory: str = SNAPSHOT_DIR) -> "SpatialEngine":
+        layers: dict = {}
+        mtime: float = 0.0
+        for name, config in LAYERS.items():
+            path = os.path.join(directory, f"{name}.geojson")
+            mtime = max(mtime, os.path.getmtime(path))
+            with open(path, encoding="utf-8") as f:
+                layers[name] = Layer.from_geojson(name, json.load(f),
+                                                  config["field"])
+            logger.info("Loaded %s features from %s",
+                        len(layers[name].features), path)
+        return cls(layers, mtime)
+
+    def _locate(self, layer: str, lng: float, lat: float) -> str | None:
+        if layer not in self.layers:
+            return None
+        return self.layers[layer].locate(lng, lat)
+
+    def county(self, lng: float, lat: float) -> str | None:
+        """Same as arcgis_county. Example output: St. Louis County"""
+        name = self._locate("counties", lng, lat)
+        return None if name is None else name.title()
+
+    def library_district(self, lng: float, lat: float) -> str | None:
+        """Same as slc_library_district. Example output: ST LOUIS COUNTY"""
+        return self._locate("slc", lng, lat)
+
+    def school_district(self, lng: float, lat: float) -> str | None:
+        """Same as jeffco_school_district. Example output: Fox"""
+        return self._locate("jeffco", lng, lat)
+
+
+_engine: SpatialEngine | None = None
+_loaded: bool = False
+_lock = threading.Lock()
+# (inode, mtime) of the mapped snapshot file and when to check it again
+_source: tuple | None = None
+_next_check: float = 0.0
+
+
+def _stat(path: str) -> tuple | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+
+def _load() -> SpatialEngine | None:
+    if os.path.exists(SNAPSHOT_FILE):
+        return SpatialEngine.open(SNAPSHOT_FILE)
+    if BACKEND == "local" or os.path.isdir(SNAPSHOT_DIR):
+        return SpatialEngine.load(SNAPSHOT_DIR)
+    return None
+
+
+def engine() -> SpatialEngine | None:
+    """
+    The per-process engine, loaded on first use.
+    None when the backend is "arcgis" or (for "auto") no snapshots exist.
+    A new snapshot file is mapped within CHECK_INTERVAL seconds of being
+    swapped in; if it can't be read, the mapped one stays live.
+    """
+    global _engine, _loaded, _source, _next_check
+    if _loaded and (BACKEND == "arcgis" or time.monotonic() < _next_check):
+        return _engine
+
+    with _lock:
+        if not _loaded:
+            if BACKEND != "arcgis":
+                _source = _stat(SNAPSHOT_FILE)
+                try:
+                    _engine = _load()
+                except (OSError, ValueError, KeyError, struct.error) as e:
+                    if BACKEND == "local":
+                        raise
+                    logger.warning("Local snapshots not loaded, using ArcGIS: "
+                                   "%s", e)
+            _next_check = time.monotonic() + CHECK_INTERVAL
+            _loaded = True
+
+        elif time.monotonic() >= _next_check:
+            _next_check = time.monotonic() + CHECK_INTERVAL
+            source = _stat(SNAPSHOT_FILE)
+            if source is not None and source != _source:
+                # remember the file either way, a bad one isn't retried
+                _source = source
+                try:
+                    _engine = SpatialEngine.open(SNAPSHOT_FILE)
+                except (OSError, ValueError, KeyError, struct.error) as e:
+                    logger.error("New snapshot %s not loaded, keeping the "
+                                 "current one: %s", SNAPSHOT_FILE, e)
+    return _engine
+
+
+def version() -> str | None:
+    """
+    Identifies the loaded snapshots (version stamp of the snapshot file,
+    newest mtime of GeoJSON snapshots), None without them.
+    """
+    e = engine()
+    if e is None:
+        return None
+    return e.version or str(int(e.mtime * 1000))
+
+
+def fetch_layer(name: str, page_size: int = 1000) -> dict:
+    """Download one layer as GeoJSON (WGS84), following result paging."""
+    import clients
+
+    config = LAYERS[name]
+    url = clients.url(config["upstream"]) + "/query"
+    features: list = []
+    offset = 0
+    while True:
+        params = {
+            "where": config["where"],
+            "outFields": config["field"],
+            "returnGeometry": "true",
+            "outSR": "4326",
+            "resultOffset": offset,
+            "resultRecordCount": page_size,
+            "f": "geojson",
+        }
+        response = clients.session(config["upstream"]).get(
+            url, params=params, timeout=(3, 60))
+        response.raise_for_status()
+        data: dict = response.json()
+        page = data.get("features", [])
+        features.extend(page)
+
+        exceeded = (data.get("exceededTransferLimit")
+                    or data.get("properties", {}).get("exceededTransferLimit"))
+        if not page or not exceeded:
+            break
+        offset += len(page)
+
+    return {"type": "FeatureCollection", "features": features}
+
+
+def layer_edit_date(name: str) -> int | None:
+    """Last edit time (ms) the upstream reports for a layer, if any."""
+    import clients
+
+    config = LAYERS[name]
+    response = clients.session(config["upstream"]).get(
+        clients.url(config["upstream"]), params={"f": "json"},
+        timeout=(3, 30))
+    response.raise_for_status()
+    info: dict = response.json().get("editingInfo") or {}
+    return info.get("dataLastEditDate") or info.get("lastEditDate")
+
+
+def build(path: str = SNAPSHOT_FILE, tolerance: float = TOLERANCE,
+          force: bool = False) -> list:
+    """
+    Write the snapshot file, downloading only the layers whose upstream
+    edit date (or the tolerance) changed since the current file; the others
+    are copied from it. Returns the names of the downloaded layers.
+    """
+    current: Snapshot | None = None
+    if not force and os.path.exists(path):
+        try:
+            current = Snapshot.open(path)
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            logger.warning("Rebuilding %s from scratch: %s", path, e)
+
+    layers: dict = {}
+    fetched: list = []
+    for name, config in LAYERS.items():
+        edit_date: int | None = layer_edit_date(name)
+        old: dict | None = (current.header["layers"].get(name)
+                            if current is not None else None)
+        if (old is not None and edit_date is not None
+                and old["edit_date"] == edit_date
+                and old["tolerance"] == tolerance
+                and old["field"] == config["field"]):
+            logger.info("%s unchanged since %s", name, edit_date)
+            layers[name] = current.packed(name)
+            continue
+
+        layers[name] = dict(
+            pack_layer(fetch_layer(name), config["field"], tolerance),
+            field=config["field"], edit_date=edit_date, tolerance=tolerance)
+        fetched.append(name)
+
+    if fetched or current is None or set(layers) != set(
+            current.header["layers"]):
+        version = write_snapshot(path, layers)
+        logger.info("Wrote snapshot %s to %s", version, path)
+    return fetched
+
+
+def fetch(directory: str = SNAPSHOT_DIR) -> None:
+    """Download all layers into `directory`, replacing files atomically."""
+    os.makedirs(directory, exist_ok=True)
+    for name in LAYERS:
+        data = fetch_layer(name)
+        path = os.path.join(directory, f"{name}.geojson")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+        logger.info("Wrote %s features to %s", len(data["features"]), path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local jurisdiction snapshots")
+    parser.add_argument("command", choices=["build", "fetch"],
+                        help="build: binary snapshot file (incremental), "
+                             "fetch: GeoJSON files")
+    parser.add_argument("--out", help="snapshot file (build) or directory "
+                                      "(fetch)")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="simplification tolerance in degrees (build)")
+    parser.add_argument("--force", action="store_true",
+                        help="download every layer (build)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "build":
+        build(args.out or SNAPSHOT_FILE, args.tolerance, args.force)
+    else:
+        fetch(args.out or SNAPSHOT_DIR)
+    sys.exit(0)
@@ -0,0 +1,424 @@
+"""
+Offline benchmark for the AddressLookup app.
+
+Starts local stand-ins for the Google geocoder and the three ArcGIS layers,
+drives the real Flask app with concurrent GET /api/v1/lookup requests and
+reports requests/sec, latency percentiles and upstream calls per scenario.
+No network access or API key is needed.
+
+Each scenario is one branch of the eligibility rules (St. Louis County,
+Jefferson County, another listed county, ineligible). By default every
+request uses a new street number, so geocodes are cache misses and nearby
+points exercise the ArcGIS cell caches.
+
+Examples:
+    python tests/benchmark.py
+    python tests/benchmark.py --requests 500 --concurrency 16 --fan-out
+    python tests/benchmark.py --latency google=lognormal:80:0.5 \\
+        --latency counties=uniform:50:300 --error-rate slc=0.05
+    python tests/benchmark.py --gunicorn "--workers 4 --threads 4"
+    python tests/benchmark.py --scenario jefferson_county --json
+
+Latency distributions (milliseconds): fixed:MS, uniform:MIN:MAX,
+normal:MEAN:SD, lognormal:MEDIAN:SIGMA.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+# append current working directory to sys
+CWD = Path(os.getcwd())
+sys.path.append(str(CWD))
+
+# zip -> what the stand-ins answer and what the lookup should return
+SCENARIOS: dict = {
+    "st_louis_county": {
+        "street": "Weber Rd", "zip": "63123", "city": "St. Louis",
+        "lng": -90.298, "lat": 38.551,
+        "county": "ST. LOUIS COUNTY", "library": "ST LOUIS COUNTY",
+        "expected": "St Louis County"},
+    "jefferson_county": {
+        "street": "Main St", "zip": "63050", "city": "Hillsboro",
+        "lng": -90.562, "lat": 38.232,
+        "county": "Jefferson County", "school": "Fox",
+        "expected": "Jefferson County"},
+    "other_county": {
+        "street": "Main St", "zip": "63301", "city": "St. Charles",
+        "lng": -90.481, "lat": 38.784,
+        "county": "St. Charles County",
+        "expected": "St Charles"},
+    "ineligible": {
+        "street": "High St", "zip": "65101", "city": "Jefferson City",
+        "lng": -92.173, "lat": 38.576,
+        "county": "Cole County",
+        "expected": "Ineligible"},
+}
+
+UPSTREAM_PATHS: dict = {
+    "/maps/api/geocode/json": "google",
+    "/counties/query": "counties",
+    "/slc/query": "slc",
+    "/jeffco/query": "jeffco",
+}
+
+
+def parse_distribution(spec: str):
+    """
+    Returns a function sampling a delay in seconds.
+    Example: "lognormal:80:0.5" (median 80 ms)
+    """
+    kind, *args = spec.split(":")
+    try:
+        values = [float(a) for a in args]
+        if kind == "fixed":
+            (ms,) = values
+            return lambda: ms / 1000
+        if kind == "uniform":
+            low, high = values
+            return lambda: random.uniform(low, high) / 1000
+        if kind == "normal":
+            mean, sd = values
+            return lambda: max(0.0, random.gauss(mean, sd)) / 1000
+        if kind == "lognormal":
+            median, sigma = values
+            return lambda: random.lognormvariate(math.log(median), sigma) / 1000
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"bad latency distribution: {spec!r}")
+
+
+def upstream_option(parse):
+    """argparse type for UPSTREAM=VALUE options."""
+    def parse_option(value: str) -> tuple:
+        name, _, spec = value.partition("=")
+        if name not in UPSTREAM_PATHS.values() or not spec:
+            raise argparse.ArgumentTypeError(
+                f"expected <upstream>=<value> with upstream one of "
+                f"{', '.join(UPSTREAM_PATHS.values())}")
+        return name, parse(spec)
+    return parse_option
+
+
+class SimulatedUpstreams:
+    """
+    Local HTTP server answering like Google and the three ArcGIS layers.
+    Geocodes are answered by ZIP, spatial queries by the nearest scenario.
+    """
+
+    def __init__(self, scenarios: dict = SCENARIOS, latency: dict | None = None,
+                 error_rate: dict | None = None, pad_bytes: int = 0):
+        self.scenarios = scenarios
+        self.latency = latency or {}
+        self.error_rate = error_rate or {}
+        self.padding = "x" * pad_bytes
+        self.calls: dict = {}
+        self.errors: dict = {}
+        self._lock = threading.Lock()
+
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                name = UPSTREAM_PATHS.get(url.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                status, body = upstreams.answer(name, params)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def answer(self, name: str | None, params: dict) -> tuple:
+        """(status, JSON body) for a request to upstream `name`."""
+        if name is None:
+            return 404, {}
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if name in self.latency:
+            time.sleep(self.latency[name]())
+        if random.random() < self.error_rate.get(name, 0):
+            with self._lock:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            return 503, {"error": "simulated outage"}
+
+        if name == "google":
+            return 200, self.geocode(params.get("address", ""))
+
+        lng, lat = (float(v) for v in params["geometry"].split(","))
+        scenario = min(self.scenarios.values(), key=lambda s:
+                       (s["lng"] - lng) ** 2 + (s["lat"] - lat) ** 2)
+        field, value = {
+            "counties": ("NAME", scenario.get("county")),
+            "slc": ("LIBRARY_DISTRICT", scenario.get("library")),
+            "jeffco": ("Name", scenario.get("school")),
+        }[name]
+        features = [] if value is None else [{"attributes": {field: value}}]
+        return 200, {"features": features, "padding": self.padding}
+
+    def geocode(self, address: str) -> dict:
+        number, *_, zip = address.split()
+        scenario = next((s for s in self.scenarios.values()
+                         if s["zip"] == zip), None)
+        if scenario is None:
+            return {"status": "ZERO_RESULTS", "results": []}
+
+        # a different point (within ~50 m) for every street number
+        rng = random.Random(f"{number} {zip}")
+        lng = scenario["lng"] + rng.uniform(-0.0005, 0.0005)
+        lat = scenario["lat"] + rng.uniform(-0.0005, 0.0005)
+        return {"status": "OK", "padding": self.padding, "results": [{
+            "formatted_address": f"{number} {scenario['street']}, "
+                                 f"{scenario['city']}, MO {zip}, USA",
+            "geometry": {"location": {"lng": lng, "lat": lat},
+                         "location_type": "ROOFTOP"},
+            "address_components": [
+                {"long_name": number, "types": ["street_number"]},
+                {"long_name": scenario["street"], "types": ["route"]},
+                {"long_name": zip, "types": ["postal_code"]},
+                {"long_name": scenario["county"].title(),
+                 "types": ["administrative_area_level_2"]},
+                {"long_name": "Missouri", "short_name": "MO",
+                 "types": ["administrative_area_level_1"]}]}]}
+
+    def env(self) -> dict:
+        """Environment variables pointing the app at the stand-ins."""
+        return {
+            "GOOGLE_MAPS_API_KEY": "benchmark",
+            "GOOGLE_MAPS_URL": self.url,
+            "ARCGIS_COUNTIES_URL": self.url + "/counties",
+            "ARCGIS_SLC_URL": self.url + "/slc",
+            "ARCGIS_JEFFCO_URL": self.url + "/jeffco",
+        }
+
+    def reset_counts(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def in_process_target():
+    """Returns get(path) -> (status, JSON) calling the app in this process."""
+    import app
+
+    local = threading.local()
+
+    def get(path: str) -> tuple:
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.app.test_client()
+        response = client.get(path)
+        return response.status_code, response.get_json(silent=True)
+
+    return get
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def gunicorn_target(options: str, env: dict):
+    """
+    Starts gunicorn (gunicorn.conf.py plus `options`) and returns
+    (get, process).
+    """
+    import requests
+
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py",
+         "--bind", f"127.0.0.1:{port}", *shlex.split(options), "app:app"],
+        env=dict(os.environ, **env), cwd=CWD)
+
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            requests.get(base + "/health", timeout=1)
+            break
+        except requests.exceptions.ConnectionError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise SystemExit("gunicorn did not start")
+            time.sleep(0.2)
+
+    local = threading.local()
+
+    def get(path: str) -> tuple:
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        response = session.get(base + path, timeout=60)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+    return get, process
+
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def run_scenario(get, name: str, scenario: dict, requests: int,
+                 concurrency: int, repeat: bool, offset: int) -> dict:
+    """Send `requests` lookups for a scenario and measure them."""
+    def one(n: int) -> tuple:
+        number = 100 if repeat else offset + n
+        path = (f"/api/v1/lookup?street={number}+"
+                f"{scenario['street'].replace(' ', '+')}&zip={scenario['zip']}")
+        start = time.perf_counter()
+        status, body = get(path)
+        elapsed = time.perf_counter() - start
+        ok = (status == 200 and body is not None
+              and body.get("geo_code") == scenario["expected"])
+        return elapsed, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(requests)))
+    wall = time.perf_counter() - start
+
+    latencies = [elapsed for elapsed, _ in results]
+    return {
+        "scenario": name,
+        "requests": requests,
+        "errors": sum(1 for _, ok in results if not ok),
+        "rps": requests / wall,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def print_report(rows: list) -> None:
+    upstreams = list(UPSTREAM_PATHS.values())
+    header = (f"{'scenario':<18}{'reqs':>6}{'errors':>8}{'req/s':>9}"
+              f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+              + "".join(f"{u:>10}" for u in upstreams))
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        print(f"{row['scenario']:<18}{row['requests']:>6}{row['errors']:>8}"
+              f"{row['rps']:>9.1f}{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}"
+              f"{row['p99_ms']:>9.1f}"
+              + "".join(f"{row['calls'].get(u, 0):>10}" for u in upstreams))
+    print("\nupstream columns: calls made for the scenario's requests")
+
+
+def main(argv: list | None = None) -> list:
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark with simulated upstreams",
+        formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="scenario to run (repeatable; default: all)")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests per scenario (default: 200)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="requests in flight (default: 8)")
+    parser.add_argument("--latency", action="append", default=[],
+                        type=upstream_option(parse_distribution),
+                        metavar="UPSTREAM=DIST",
+                        help="upstream latency (default: fixed:20 for all)")
+    parser.add_argument("--error-rate", action="append", default=[],
+                        type=upstream_option(float), metavar="UPSTREAM=RATE",
+                        help="share of upstream calls answered with a 503")
+    parser.add_argument("--pad-bytes", type=int, default=0,
+                        help="extra bytes in every upstream response")
+    parser.add_argument("--repeat", action="store_true",
+                        help="look up the same address every time (cached)")
+    parser.add_argument("--fan-out", action="store_true",
+                        help="set LOOKUP_FAN_OUT=1")
+    parser.add_argument("--gunicorn", metavar="OPTIONS",
+                        help="serve with gunicorn (e.g. \"--workers 4\") "
+                             "instead of in this process")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    latency = {name: parse_distribution("fixed:20")
+               for name in UPSTREAM_PATHS.values()}
+    latency.update(dict(args.latency))
+
+    tmp = tempfile.TemporaryDirectory()
+    upstreams = SimulatedUpstreams(latency=latency,
+                                   error_rate=dict(args.error_rate),
+                                   pad_bytes=args.pad_bytes)
+    env = dict(upstreams.env(),
+               CACHE_PATH=os.path.join(tmp.name, "lookups.sqlite3"),
+               METRICS_DIR=os.path.join(tmp.name, "metrics"),
+               JURISDICTION_BACKEND="arcgis",
+               LOOKUP_FAN_OUT="1" if args.fan_out else "0",
+               PORT="0")
+
+    process = None
+    rows: list = []
+    with tmp, upstreams:
+        if args.gunicorn is not None:
+            get, process = gunicorn_target(args.gunicorn, env)
+        else:
+            # read at import time by cache.py, spatial.py and main.py
+            os.environ.update(env)
+            get = in_process_target()
+
+        try:
+            for i, name in enumerate(args.scenario or SCENARIOS):
+                upstreams.reset_counts()
+                row = run_scenario(get, name, SCENARIOS[name], args.requests,
+                                   args.concurrency, args.repeat,
+                                   offset=1000 + i * args.requests)
+                row["calls"] = dict(upstreams.calls)
+                row["upstream_errors"] = dict(upstreams.errors)
+                rows.append(row)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_report(rows)
+    return rows
+
+
+if __name__ == "__main__":
+    main()
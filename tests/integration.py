@@ -9,6 +9,7 @@ sys.path.append(str(CWD))
 
 from dotenv import load_dotenv
 
+import recording
 from main import AddressDetails
 
 load_dotenv()
@@ -29,7 +30,9 @@ Future tests can be written to test non-resident and ineligible addresses.
 # defines parent class that waits 1 second after each test runs
 class TestSleep(unittest.TestCase):
     def tearDown(self):
-        time.sleep(1)
+        # replayed responses (UPSTREAM_MODE=replay) don't need the pause
+        if recording.MODE != "replay":
+            time.sleep(1)
 
 class TestMunicipal(TestSleep):
 
@@ -1,16 +1,48 @@
+import asyncio
+import json
 import os
 import sys
+import tempfile
+import threading
 import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from unittest import mock
+from urllib.parse import urlencode
 
 # append current working directory to sys
 CWD = Path(os.getcwd())
 sys.path.append(str(CWD))
 
+# keep the files the tests write out of the repo
+TMP_DIR = tempfile.TemporaryDirectory()
+os.environ["CACHE_PATH"] = os.path.join(TMP_DIR.name, "lookups.sqlite3")
+os.environ["METRICS_DIR"] = os.path.join(TMP_DIR.name, "metrics")
+os.environ["JOURNAL_PATH"] = os.path.join(TMP_DIR.name, "journal",
+                                          "lookups.jsonl")
+
+import requests
 from dotenv import load_dotenv
 
+import app
+import autocomplete
+import batch
+import cache
+import clients
+import county_report
+import grid
+import import_report
+import journal
 import main
+import metrics
+import recording
+import reference_data
+import replay
+import resilience
+import singleflight
+import spatial
+import zip_index
 
 load_dotenv()
 
@@ -61,5 +93,1655 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(result, test_case)
 
 
+class TestReferenceData(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "table.csv")
+        self.write("County,Geographic Code,Patron Code\n"
+                   "Warren County,Warren County,Reciprocal\n", mtime=1000)
+        self.table = reference_data.ReferenceTable(
+            self.path, "County", ("Geographic Code", "Patron Code"),
+            check_interval=0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, text, mtime):
+        with open(self.path, "w") as f:
+            f.write(text)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_case_folded_lookup(self):
+        self.assertEqual(self.table.get("WARREN  county"),
+                         ("Warren County", "Reciprocal"))
+        self.assertIsNone(self.table.get("Duval County"))
+
+    def test_reload_on_mtime_change(self):
+        self.table.get("Warren County")
+        self.write("County,Geographic Code,Patron Code\n"
+                   "Bond County,Illinois,Non-Resident\n", mtime=2000)
+        self.assertIsNone(self.table.get("Warren County"))
+        self.assertEqual(self.table.get("bond county"),
+                         ("Illinois", "Non-Resident"))
+
+    def test_malformed_edit_keeps_live_index(self):
+        self.table.get("Warren County")
+        self.write("County,Geographic Code\nBond County,Illinois\n", mtime=2000)
+        self.assertEqual(self.table.get("Warren County"),
+                         ("Warren County", "Reciprocal"))
+
+    def test_malformed_first_load_raises(self):
+        self.write("County,Geographic Code,Patron Code\n"
+                   "Bond County,,Non-Resident\n", mtime=2000)
+        with self.assertRaises(reference_data.ReferenceDataError):
+            self.table.get("Bond County")
+
+
+class TestImportCost(unittest.TestCase):
+    def test_main_skips_heavy_imports(self):
+        packages = import_report.by_package(import_report.measure("main"))
+        self.assertNotIn("pandas", packages)
+        self.assertNotIn("googlemaps", packages)
+
+
+class TestClients(unittest.TestCase):
+    def tearDown(self):
+        clients.reset()
+
+    def test_session_is_reused(self):
+        self.assertIs(clients.session("counties"), clients.session("counties"))
+        self.assertIsNot(clients.session("counties"), clients.session("slc"))
+
+    def test_pool_size_override(self):
+        with mock.patch.dict(os.environ, {"HTTP_POOL_MAXSIZE": "4",
+                                          "HTTP_POOL_MAXSIZE_SLC": "2"}):
+            clients.reset()
+            self.assertEqual(clients.session("slc").adapters["https://"]
+                             ._pool_maxsize, 2)
+            self.assertEqual(clients.session("jeffco").adapters["https://"]
+                             ._pool_maxsize, 4)
+
+    def test_rate_limit(self):
+        limiter = clients.RateLimiter(rate=50)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_rate_limit_respects_the_deadline(self):
+        limiter = clients.RateLimiter(rate=1)
+        with resilience.budget(0.5):
+            limiter.acquire()
+            start = time.monotonic()
+            with self.assertRaises(resilience.DeadlineExceeded):
+                limiter.acquire()
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    def test_forked_child_gets_new_session(self):
+        clients.session("counties")
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # the parent's pooled connections must not be visible here
+            os.close(r)
+            os.write(w, b"0" if clients._sessions else b"1")
+            os._exit(0)
+        os.close(w)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(r, 1), b"1")
+        os.close(r)
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "cache.sqlite3")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_address_key(self):
+        self.assertEqual(cache.address_key(" 4444  Weber Rd. ", "63123 "),
+                         cache.address_key("4444 WEBER RD", "63123"))
+
+    def test_lru_ttl_and_eviction(self):
+        lru = cache.LRUCache(maxsize=2, ttl=60)
+        lru.set("a", 1)
+        lru.set("b", 2, ttl=-1)
+        self.assertIsNone(lru.get("b"))
+        lru.set("c", 3)
+        self.assertEqual(lru.get("a"), 1)
+        lru.set("d", 4)
+        self.assertIsNone(lru.get("c"))
+
+    def test_store_shared_between_workers(self):
+        # two caches on one file stand in for two gunicorn workers
+        worker_1 = cache.TieredCache("geocode", ttl=60, path=self.path)
+        worker_2 = cache.TieredCache("geocode", ttl=60, path=self.path)
+        worker_1.set("4444 WEBER RD|63123", [-90.29, 38.55])
+        self.assertEqual(worker_2.get("4444 WEBER RD|63123"), [-90.29, 38.55])
+        worker_1.set("expired", 1, ttl=-1)
+        self.assertIsNone(worker_2.get("expired"))
+
+    def test_geohash(self):
+        self.assertEqual(cache.geohash(-5.6, 42.6, 5), "ezs42")
+
+    def cell_cache(self):
+        return cache.CellCache("cell:test", ttl=60, precision=7,
+                               max_precision=8, verify_rate=0, path=None)
+
+    def test_cell_needs_confirmation(self):
+        cells = self.cell_cache()
+        cells.record(-90.2990, 38.5500, "St. Louis County")
+        # a single point is not enough to answer for its neighbours
+        self.assertIsNone(cells.get(-90.29905, 38.55005))
+        cells.record(-90.29905, 38.55005, "St. Louis County")
+        self.assertEqual(cells.get(-90.2991, 38.5501), "St. Louis County")
+
+    def test_straddling_cell_is_refined_then_bypassed(self):
+        cells = self.cell_cache()
+        # a and b share an 8 character cell, c is in the next one
+        a, b, c = (-90.2991, 38.5501), (-90.29905, 38.55005), \
+            (-90.29895, 38.54995)
+        cells.record(*a, "St. Louis County")
+        cells.record(*c, "Jefferson County")
+        cells.record(*a, "St. Louis County")
+        cells.record(*b, "St. Louis County")
+        self.assertEqual(cells.get(*a), "St. Louis County")
+        self.assertIsNone(cells.get(*c))
+        # the finest cell disagrees too: no more caching there
+        cells.record(*b, "Jefferson County")
+        self.assertIsNone(cells.get(*a))
+
+    def test_cell_next_to_a_line_is_not_shared(self):
+        cells = self.cell_cache()
+        # a, b and c share a 7 character cell, the county line is east of c
+        a, b, c = (-90.2978, 38.55), (-90.2975, 38.55), (-90.2970, 38.55)
+        cells.record(*a, "St. Louis County")
+        cells.record(*b, "St. Louis County")
+        self.assertEqual(cells.get(*c), "St. Louis County")
+        cells.record(-90.2965, 38.55, "Jefferson County")
+        self.assertIsNone(cells.get(*c))
+        # near the line, points only share their finest cell
+        cells.record(*b, "St. Louis County")
+        cells.record(-90.2974, 38.55, "St. Louis County")
+        self.assertEqual(cells.get(-90.29745, 38.55), "St. Louis County")
+        self.assertIsNone(cells.get(*a))
+
+    def test_mixed_cell_stays_mixed_across_workers(self):
+        worker_1, worker_2 = (
+            cache.CellCache("cell:test", ttl=60, precision=7, max_precision=8,
+                            verify_rate=0, path=self.path) for _ in range(2))
+        a, b, c = (-90.2991, 38.5501), (-90.29905, 38.55005), \
+            (-90.29895, 38.54995)
+        worker_1.record(*a, "St. Louis County")
+        # worker 2 keeps a copy of the one-point cell
+        self.assertIsNone(worker_2.get(*b))
+        worker_1.record(*c, "Jefferson County")
+        worker_2.record(*b, "St. Louis County")
+        self.assertEqual(worker_2.cells.store.get(cache.geohash(*a, 7)),
+                         {"mixed": True})
+        for worker in (worker_1, worker_2):
+            self.assertIsNone(worker.get(-90.2989, 38.5499))
+
+    def test_grid_boundary_cells_are_not_shared(self):
+        cells = self.cell_cache()
+        boundary = mock.Mock(**{"code.return_value": grid.BOUNDARY})
+        with mock.patch.object(grid, "grid", return_value=boundary):
+            cells.record(-90.2978, 38.55, "St. Louis County")
+            cells.record(-90.2975, 38.55, "St. Louis County")
+            self.assertIsNone(cells.get(-90.2970, 38.55))
+
+    def test_cell_cached_decorator(self):
+        fetch = mock.Mock(return_value="Fox")
+        cached = cache.cell_cached(self.cell_cache())(fetch)
+        for lng in (-90.2990, -90.29905, -90.2991):
+            self.assertEqual(cached(lng, 38.5500), "Fox")
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_geocode_is_cached(self):
+        result = (-90.29, 38.55, "4444 WEBER RD, ST LOUIS, MO 63123",
+                  "63123", "ST LOUIS", "MO")
+        shared = cache.TieredCache("geocode", ttl=60, path=self.path)
+        with mock.patch.object(cache, "GEOCODE", shared), \
+                mock.patch.object(main, "goog_geocode",
+                                  return_value=result) as goog:
+            self.assertEqual(main.geocode("4444 Weber Rd.", "63123"), result)
+            self.assertEqual(main.geocode("4444 WEBER RD", "63123"), result)
+            self.assertEqual(goog.call_count, 1)
+
+
+def square(x0, y0, x1, y1):
+    return [[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]
+
+
+def polygon_layer(field, polygons):
+    """GeoJSON FeatureCollection: {value: [rings, ...]}"""
+    return {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "properties": {field: value},
+         "geometry": {"type": "Polygon", "coordinates": rings}}
+        for value, rings in polygons.items()]}
+
+
+def local_engine():
+    """Two counties side by side; Kirkwood is a hole in ST LOUIS COUNTY."""
+    return spatial.SpatialEngine({
+        "counties": spatial.Layer.from_geojson("counties", polygon_layer(
+            "NAME", {"ST. LOUIS COUNTY": [square(-90.6, 38.4, -90.2, 38.9)],
+                     "Jefferson County": [square(-90.8, 38.0, -90.2, 38.4)]}),
+            "NAME"),
+        "slc": spatial.Layer.from_geojson("slc", polygon_layer(
+            "LIBRARY_DISTRICT",
+            {"ST LOUIS COUNTY": [square(-90.6, 38.4, -90.2, 38.9),
+                                 square(-90.45, 38.55, -90.35, 38.6)],
+             "KIRKWOOD": [square(-90.45, 38.55, -90.35, 38.6)]}),
+            "LIBRARY_DISTRICT"),
+    })
+
+
+class TestSpatial(unittest.TestCase):
+    def test_point_in_polygon(self):
+        engine = local_engine()
+        self.assertEqual(engine.county(-90.3, 38.5), "St. Louis County")
+        self.assertEqual(engine.county(-90.3, 38.3), "Jefferson County")
+        self.assertIsNone(engine.county(-89.0, 38.5))
+
+    def test_hole_is_excluded(self):
+        engine = local_engine()
+        self.assertEqual(engine.library_district(-90.4, 38.57), "KIRKWOOD")
+        self.assertEqual(engine.library_district(-90.3, 38.5),
+                         "ST LOUIS COUNTY")
+
+    def test_falls_back_to_arcgis(self):
+        with mock.patch.object(spatial, "engine", return_value=local_engine()), \
+                mock.patch.object(main, "arcgis_county",
+                                  return_value="Madison County") as arcgis, \
+                mock.patch.object(main, "jeffco_school_district",
+                                  return_value="Fox") as jeffco:
+            self.assertEqual(main.find_county(-90.3, 38.5), "St. Louis County")
+            self.assertEqual(main.find_county(-89.9, 38.8), "Madison County")
+            # no school district layer loaded
+            self.assertEqual(main.find_school_district(-90.3, 38.3), "Fox")
+            self.assertEqual(arcgis.call_count, 1)
+            self.assertEqual(jeffco.call_count, 1)
+
+    def test_slc_libs_matches_arcgis_shape(self):
+        with mock.patch.object(spatial, "engine", return_value=local_engine()):
+            self.assertEqual(
+                main.slc_libs(-90.4, 38.57, "St. Louis County"),
+                ["Kirkwood", "Reciprocal", "Kirkwood"])
+
+
+class TestSnapshotFile(unittest.TestCase):
+    LAYERS = {
+        "counties": polygon_layer(
+            "NAME", {"ST. LOUIS COUNTY": [square(-90.6, 38.4, -90.2, 38.9)],
+                     "Jefferson County": [square(-90.8, 38.0, -90.2, 38.4)]}),
+        "slc": polygon_layer(
+            "LIBRARY_DISTRICT",
+            {"ST LOUIS COUNTY": [square(-90.6, 38.4, -90.2, 38.9),
+                                 square(-90.45, 38.55, -90.35, 38.6)],
+             "KIRKWOOD": [square(-90.45, 38.55, -90.35, 38.6)]}),
+        "jeffco": polygon_layer(
+            "Name", {"Fox": [square(-90.8, 38.0, -90.2, 38.4)]}),
+    }
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "jurisdictions.snap")
+
+    def build(self, edit_dates):
+        fetch = mock.Mock(side_effect=lambda name: self.LAYERS[name])
+        with mock.patch.object(spatial, "layer_edit_date",
+                               side_effect=edit_dates.get), \
+                mock.patch.object(spatial, "fetch_layer", fetch):
+            fetched = spatial.build(self.path)
+        return fetched, [c.args[0] for c in fetch.call_args_list]
+
+    def test_mapped_snapshot_answers_like_geojson(self):
+        self.build({})
+        mapped = spatial.SpatialEngine.open(self.path)
+        for lng, lat in ((-90.3, 38.5), (-90.3, 38.3), (-89.0, 38.5),
+                         (-90.4, 38.57)):
+            self.assertEqual(mapped.county(lng, lat),
+                             local_engine().county(lng, lat))
+            self.assertEqual(mapped.library_district(lng, lat),
+                             local_engine().library_district(lng, lat))
+        self.assertEqual(mapped.school_district(-90.3, 38.3), "Fox")
+        self.assertTrue(mapped.version)
+
+    def test_simplify(self):
+        # the midpoints of the sides are within the tolerance
+        ring = [[0, 0], [0.5, 0.000001], [1, 0], [1, 1], [0, 1], [0, 0]]
+        self.assertEqual(spatial.simplify(ring, 0.00001),
+                         [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]])
+        self.assertEqual(spatial.simplify(ring, 0), ring)
+
+    def test_incremental_build(self):
+        dates = {"counties": 1, "slc": 1, "jeffco": 1}
+        self.assertEqual(self.build(dates)[1], ["counties", "slc", "jeffco"])
+        version = spatial.Snapshot.open(self.path).version
+
+        # nothing changed upstream: no downloads, the file stays
+        self.assertEqual(self.build(dates), ([], []))
+        self.assertEqual(spatial.Snapshot.open(self.path).version, version)
+
+        self.LAYERS = dict(self.LAYERS, jeffco=polygon_layer(
+            "Name", {"Windsor": [square(-90.8, 38.0, -90.2, 38.4)]}))
+        self.assertEqual(self.build(dict(dates, jeffco=2))[1], ["jeffco"])
+        mapped = spatial.SpatialEngine.open(self.path)
+        self.assertEqual(mapped.school_district(-90.3, 38.3), "Windsor")
+        self.assertEqual(mapped.library_district(-90.4, 38.57), "KIRKWOOD")
+
+    def test_workers_pick_up_new_snapshot(self):
+        self.build({})
+        with mock.patch.object(spatial, "SNAPSHOT_FILE", self.path), \
+                mock.patch.object(spatial, "BACKEND", "auto"), \
+                mock.patch.object(spatial, "CHECK_INTERVAL", 0), \
+                mock.patch.object(spatial, "_loaded", False), \
+                mock.patch.object(spatial, "_engine", None):
+            first = spatial.version()
+            self.assertEqual(spatial.version(), first)
+
+            layer = dict(spatial.pack_layer(self.LAYERS["jeffco"], "Name"),
+                         field="Name", edit_date=None, tolerance=0)
+            spatial.write_snapshot(self.path, {"jeffco": layer}, "v2")
+            self.assertEqual(spatial.version(), "v2")
+            self.assertIsNone(spatial.engine().county(-90.3, 38.5))
+
+            # a broken file doesn't replace the mapped one
+            with open(self.path + ".new", "wb") as f:
+                f.write(b"not a snapshot")
+            os.replace(self.path + ".new", self.path)
+            self.assertEqual(spatial.version(), "v2")
+
+
+def fake_upstreams(county, library=None, school=None):
+    """Patch the four upstream calls in main with canned answers."""
+    def fail(lng, lat):
+        raise AssertionError("unexpected upstream call")
+
+    return [
+        mock.patch.object(cache, "GEOCODE",
+                          cache.TieredCache("geocode", ttl=60, path=None)),
+        mock.patch.object(main, "goog_geocode", return_value=(
+            -90.298, 38.551, "4444 WEBER RD, ST LOUIS, MO 63123", "63123",
+            "ST LOUIS", "MO")),
+        mock.patch.object(main, "arcgis_county", return_value=county),
+        mock.patch.object(main, "slc_library_district",
+                          side_effect=(lambda lng, lat: library) if library
+                          else fail),
+        mock.patch.object(main, "jeffco_school_district",
+                          side_effect=(lambda lng, lat: school) if school
+                          else fail),
+    ]
+
+
+class TestFanOut(unittest.TestCase):
+    def lookup(self, patches, fan_out):
+        for p in patches:
+            p.start()
+        self.addCleanup(mock.patch.stopall)
+        return main.AddressDetails().address_lookup("4444 Weber Rd", "63123",
+                                                    fan_out=fan_out)
+
+    def test_sequential_matches_fan_out(self):
+        expected = {'address': '4444 WEBER RD, ST LOUIS, MO 63123',
+                    'county': 'St. Louis County',
+                    'library': 'St. Louis County',
+                    'geo_code': 'St Louis County',
+                    'patron_code': 'Resident'}
+        for fan_out in (False, True):
+            result = self.lookup(fake_upstreams(
+                "St. Louis County", library="ST LOUIS COUNTY", school="Fox"),
+                fan_out)
+            self.assertEqual(result, expected)
+
+    def test_fan_out_ignores_unneeded_failures(self):
+        # the speculative library query fails, but Jefferson County
+        # addresses never need it
+        result = self.lookup(fake_upstreams("Jefferson County", school="Fox"),
+                             fan_out=True)
+        self.assertEqual(result["geo_code"], "Jefferson County")
+        self.assertEqual(result["patron_code"], "Reciprocal")
+
+
+def geocoder_result(county, location_type="ROOFTOP", **extra):
+    """A Geocoder result for 4444 Weber Rd in `county`."""
+    components = [
+        {"long_name": "4444", "types": ["street_number"]},
+        {"long_name": "Weber Road", "types": ["route"]},
+        {"long_name": "63123", "types": ["postal_code"]},
+        {"long_name": "Missouri", "short_name": "MO",
+         "types": ["administrative_area_level_1"]}]
+    if county:
+        components.append({"long_name": county,
+                           "types": ["administrative_area_level_2"]})
+    return dict({
+        "formatted_address": "4444 Weber Rd, St. Louis, MO 63123, USA",
+        "geometry": {"location": {"lng": -90.298, "lat": 38.551},
+                     "location_type": location_type},
+        "address_components": components}, **extra)
+
+
+class TestCountyHint(unittest.TestCase):
+    def setUp(self):
+        for p in (mock.patch.object(cache, "COUNTIES", cache.CellCache(
+                      "cell:counties", ttl=60, path=None)),
+                  mock.patch.object(main, "COUNTY_HINT", True),
+                  mock.patch.object(main, "COUNTY_HINT_VERIFY_RATE", 0),
+                  mock.patch.object(spatial, "engine", return_value=None),
+                  mock.patch.object(grid, "grid",
+                                    return_value=self.fake_grid())):
+            p.start()
+        self.addCleanup(mock.patch.stopall)
+
+    @staticmethod
+    def fake_grid(boundary_at=None):
+        """A grid with no answers, and boundary cells east of `boundary_at`."""
+        def code(lng, lat):
+            return (grid.BOUNDARY if boundary_at is not None
+                    and lng >= boundary_at else grid.OUTSIDE)
+        return mock.Mock(snapshot=None, cell=grid.CELL_SIZE, code=code,
+                         **{"lookup.return_value": None})
+
+    def test_google_county(self):
+        self.assertEqual(main.google_county([geocoder_result("St. Louis County")]),
+                         "St. Louis County")
+        self.assertEqual(main.parse_geocode(
+            [geocoder_result("ST. LOUIS COUNTY")]).county, "St. Louis County")
+        for results in ([geocoder_result(None)],
+                        [geocoder_result("St. Louis County", "APPROXIMATE")],
+                        [geocoder_result("St. Louis County",
+                                         partial_match=True)],
+                        [geocoder_result("St. Louis County"),
+                         geocoder_result("Jefferson County")]):
+            self.assertIsNone(main.google_county(results))
+
+    def test_geocode_cache_keeps_county(self):
+        result = main.parse_geocode([geocoder_result("Jefferson County")])
+        entry = main.Geocode.cache_entry(result)
+        self.assertEqual(main.Geocode.from_cache(entry).county,
+                         "Jefferson County")
+        self.assertEqual(main.Geocode.from_cache(entry), result)
+        # entries cached before the county was kept
+        self.assertIsNone(main.Geocode.from_cache(entry[:6]).county)
+
+    def lookup(self, county, fan_out=False):
+        patches = fake_upstreams(county, library="ST LOUIS COUNTY",
+                                 school="Fox")
+        patches[1] = mock.patch.object(main, "goog_geocode", return_value=(
+            main.parse_geocode([geocoder_result("St. Louis County")])))
+        for p in patches:
+            p.start()
+        return main.AddressDetails().address_lookup("4444 Weber Rd", "63123",
+                                                    fan_out=fan_out)
+
+    def test_google_county_skips_county_query(self):
+        for fan_out in (False, True):
+            result = self.lookup(None, fan_out)
+            self.assertEqual(result["county"], "St. Louis County")
+            self.assertEqual(result["geo_code"], "St Louis County")
+            main.arcgis_county.assert_not_called()
+            mock.patch.stopall()
+            self.setUp()
+
+    def test_near_boundary_queries_arcgis(self):
+        # a point ~100 m away is known to be in another county
+        cache.COUNTIES.record(-90.297, 38.551, "Jefferson County")
+        with self.assertLogs("main", "WARNING"):
+            result = self.lookup("Jefferson County")
+        self.assertEqual(result["county"], "Jefferson County")
+        main.arcgis_county.assert_called_once()
+
+    def test_grid_boundary_queries_arcgis(self):
+        # a boundary cell ~200 m east of the point
+        grid.grid.return_value = self.fake_grid(boundary_at=-90.2957)
+        with self.assertLogs("main", "WARNING"):
+            result = self.lookup("Jefferson County")
+        self.assertEqual(result["county"], "Jefferson County")
+        main.arcgis_county.assert_called_once()
+
+    def test_no_grid_queries_arcgis(self):
+        grid.grid.return_value = None
+        self.lookup("St. Louis County")
+        main.arcgis_county.assert_called_once()
+
+    def test_report(self):
+        fixtures = recording.FixtureStore("unused")
+        geocode_key = recording.request_key(
+            "GET", "/maps/api/geocode/json?address=4444+Weber+Rd+63123")
+        fixtures.responses[geocode_key] = {
+            "status": 200, "elapsed": 0.1, "body": {
+                "status": "OK",
+                "results": [geocoder_result("St. Louis County")]}}
+        county_key = recording.request_key(
+            "GET", clients.url("counties") + "/query?" + urlencode(
+                main.point_query_params(-90.298, 38.551, "NAME")))
+        fixtures.responses[county_key] = {
+            "status": 200, "elapsed": 0.1, "body": {"features": [
+                {"attributes": {"NAME": "Jefferson County"}}]}}
+
+        rows = county_report.compare(fixtures)
+        self.assertEqual(rows, [{"request": geocode_key,
+                                 "google": "St. Louis County",
+                                 "trusted": True,
+                                 "arcgis": "Jefferson County"}])
+        self.assertEqual(county_report.summary(rows),
+                         {("trusted", "disagree"): 1})
+        self.assertIn("* St. Louis County", county_report.report(rows))
+
+
+class TestZipIndex(unittest.TestCase):
+    SLC = {"county": "St. Louis County", "library": "St. Louis County",
+           "geo_code": "St Louis County", "patron_code": "Resident"}
+    INDEX = zip_index.ZipIndex({
+        "63123": SLC,
+        "63052-1234": {"county": "Jefferson County", "school": "Fox",
+                       "geo_code": "Jefferson County",
+                       "patron_code": "Reciprocal"}})
+
+    def test_outcome(self):
+        self.assertEqual(self.INDEX.outcome("63123"), self.SLC)
+        self.assertEqual(self.INDEX.outcome("63123-0001"), self.SLC)
+        self.assertEqual(self.INDEX.outcome("63052-1234")["school"], "Fox")
+        # boundary ZIPs and unknown ZIPs in the region need the full lookup
+        self.assertIsNone(self.INDEX.outcome("63052"))
+        self.assertIsNone(self.INDEX.outcome("62025"))
+        self.assertEqual(self.INDEX.outcome("90210"), zip_index.INELIGIBLE)
+
+    def test_lookup_answers_from_index(self):
+        with mock.patch.object(zip_index, "_index", self.INDEX), \
+                mock.patch.object(zip_index, "_loaded", True), \
+                mock.patch.object(main.AddressDetails,
+                                  "address_lookup") as full_lookup:
+            self.assertEqual(main.lookup("4444 Weber Rd", "63123"),
+                             dict(self.SLC, zip_index=True))
+            full_lookup.assert_not_called()
+
+    def test_build(self):
+        def address_lookup(street, zip):
+            number = int(street.split()[0])
+            if zip == "63126" and number == 3:
+                # one address across the county line
+                return {"address": f"{street}, ST LOUIS, MO 63126",
+                        "county": "Jefferson County", "school": "Fox",
+                        "geo_code": "Jefferson County",
+                        "patron_code": "Reciprocal"}
+            # Google moved the address to another ZIP
+            found = "63125" if zip == "63127" and number == 2 else zip
+            return dict(self.SLC, address=f"{street}, ST LOUIS, MO {found}")
+
+        samples = [(f"{n} Main St", zip) for zip in ("63123", "63126", "63127")
+                   for n in range(1, 5)] + [("1 Main St", "63128")]
+        with mock.patch.object(main.AddressDetails, "address_lookup",
+                               side_effect=address_lookup):
+            data = zip_index.build(samples, concurrency=2, min_samples=2)
+
+        self.assertEqual(data["zips"], {"63123": self.SLC})
+
+
+class TestAutocomplete(unittest.TestCase):
+    ROWS = [("4444 Weber Rd", "63123"), ("4500 Weber Rd Apt 2", "63123"),
+            ("10 Webster Ave", "63123"), ("12 S. Lindbergh Blvd", "63123-1000"),
+            ("1 Main St", "63126"), ("no zip", "")]
+
+    def test_build(self):
+        data = autocomplete.build(self.ROWS)
+        self.assertEqual(data["zips"], {
+            "63123": ["S LINDBERGH BLVD", "WEBER RD", "WEBSTER AVE"],
+            "63126": ["MAIN ST"]})
+        self.assertEqual(autocomplete.build(self.ROWS, min_count=2)["zips"],
+                         {"63123": ["WEBER RD"]})
+
+    def test_suggest(self):
+        index = autocomplete.StreetIndex(autocomplete.build(self.ROWS)["zips"])
+        self.assertEqual(index.suggest("4444 web", "63123"),
+                         ["4444 WEBER RD", "4444 WEBSTER AVE"])
+        self.assertEqual(index.suggest("weber", "63123-0001"), ["WEBER RD"])
+        self.assertEqual(index.suggest("9 lindb", "63123"),
+                         ["9 S LINDBERGH BLVD"])
+        self.assertEqual(index.suggest("9 s. lind", "63123"),
+                         ["9 S LINDBERGH BLVD"])
+        self.assertEqual(index.suggest("web", "63123", limit=1), ["WEBER RD"])
+        self.assertEqual(index.suggest("web", "63126"), [])
+        self.assertEqual(index.suggest("web", "90210"), [])
+        self.assertEqual(index.suggest("4444 ", "63123"), [])
+
+    def test_endpoint(self):
+        zips = autocomplete.build(self.ROWS)["zips"]
+        index = autocomplete.StreetIndex(zips, version="1")
+        rebuilt = autocomplete.StreetIndex(zips, version="2")
+        url = "/api/v1/autocomplete?street=4444+web&zip=63123"
+        client = app.app.test_client()
+        with mock.patch.object(autocomplete, "_loaded", True):
+            with mock.patch.object(autocomplete, "_index", index):
+                response = client.get(url)
+                invalid = client.get("/api/v1/autocomplete?street=4444"
+                                     "&zip=631")
+                etag = response.headers["ETag"]
+                unchanged = client.get(url, headers={"If-None-Match": etag})
+            with mock.patch.object(autocomplete, "_index", rebuilt):
+                changed = client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.get_json(),
+                         {"suggestions": ["4444 WEBER RD",
+                                          "4444 WEBSTER AVE"]})
+        self.assertEqual(response.cache_control.max_age,
+                         app.AUTOCOMPLETE_MAX_AGE)
+        self.assertEqual(invalid.status_code, 400)
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers["ETag"], etag)
+
+
+class TestNotFoundCache(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(cache, "NOT_FOUND", cache.TieredCache(
+            "not_found", ttl=60, path=None))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def count(self, result):
+        return metrics.REGISTRY.values.get(metrics._key(
+            "cache_requests_total", {"cache": "not_found", "result": result}),
+            0)
+
+    def test_not_found_is_remembered(self):
+        hits, misses = self.count("hit"), self.count("miss")
+        with mock.patch.object(main.AddressDetails, "address_lookup",
+                               side_effect=main.AddressNotFound()) as full:
+            for _ in range(3):
+                with self.assertRaisesRegex(Exception, "^Address not found.$"):
+                    main.lookup("1 Nowhere Rd", "63123")
+            # the same address, written differently
+            with self.assertRaises(main.AddressNotFound):
+                main.lookup("1 nowhere rd.", "63123")
+        self.assertEqual(full.call_count, 1)
+        self.assertEqual(self.count("hit") - hits, 3)
+        self.assertEqual(self.count("miss") - misses, 1)
+
+    def test_upstream_failures_are_not_remembered(self):
+        for error in (requests.exceptions.Timeout("slow"),
+                      resilience.CircuitOpen("google"),
+                      Exception("Google Geocoder API error: REQUEST_DENIED")):
+            with mock.patch.object(main.AddressDetails, "address_lookup",
+                                   side_effect=error) as full:
+                for _ in range(2):
+                    with self.assertRaises(Exception):
+                        main.lookup("4444 Weber Rd", "63123")
+            self.assertEqual(full.call_count, 2)
+
+    def test_definitive_answers_only(self):
+        with self.assertRaises(main.AddressNotFound):
+            main.parse_geocode([])
+        with self.assertRaises(main.AddressNotFound):
+            main.parse_county({"features": []})
+        # an ArcGIS error response is not an answer
+        with self.assertRaises(Exception) as raised:
+            main.parse_county({"error": {"code": 500}})
+        self.assertNotIsInstance(raised.exception, main.AddressNotFound)
+        self.assertEqual(str(raised.exception), "Address not found.")
+
+
+class TestBatch(unittest.TestCase):
+    CSV = ("Street,ZIP\n"
+           "4444 Weber Rd,63123\n"
+           "\n"
+           "2606 Seckman Rd,63052\n"
+           "1 Main St,abc\n")
+
+    def fake_lookup(self, street, zip):
+        if street.startswith("4444"):
+            # finishes last even though it was submitted first
+            time.sleep(0.05)
+            return {"geo_code": "St Louis County", "patron_code": "Resident"}
+        raise main.AddressNotFound()
+
+    def test_read_rows(self):
+        rows = list(batch.read_rows(self.CSV.splitlines()))
+        self.assertEqual(rows, [("4444 Weber Rd", "63123"),
+                                ("2606 Seckman Rd", "63052"),
+                                ("1 Main St", "abc")])
+        with self.assertRaises(ValueError):
+            batch.read_rows(["name,city", "a,b"])
+
+    def test_results_stream_in_completion_order(self):
+        with mock.patch.object(main.AddressDetails, "address_lookup",
+                               side_effect=lambda street, zip:
+                               self.fake_lookup(street, zip)):
+            results = list(batch.run_batch(
+                batch.read_rows(self.CSV.splitlines()), concurrency=2))
+
+        self.assertEqual([r["row"] for r in results], [2, 3, 1])
+        self.assertEqual(results[0]["error"], "Address not found.")
+        self.assertEqual(results[1]["error"], "Invalid ZIP code")
+        self.assertEqual(results[2]["patron_code"], "Resident")
+
+    def test_batch_endpoint(self):
+        client = app.app.test_client()
+        with mock.patch.object(main.AddressDetails, "address_lookup",
+                               side_effect=lambda street, zip:
+                               self.fake_lookup(street, zip)):
+            response = client.post("/batch", data=self.CSV,
+                                   content_type="text/csv")
+            body = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        lines = body.strip().splitlines()
+        self.assertEqual(lines[0], ",".join(batch.OUTPUT_COLUMNS))
+        self.assertEqual(len(lines), 4)
+
+        response = client.post("/batch", data="a,b\n1,2\n",
+                               content_type="text/csv")
+        self.assertEqual(response.status_code, 400)
+
+
+try:
+    import numpy
+
+    import classify
+except ImportError:
+    numpy = None
+
+
+@unittest.skipUnless(numpy, "requires requirements-classify.txt")
+class TestClassify(unittest.TestCase):
+    def test_matches_engine(self):
+        engine = local_engine()
+        rng = numpy.random.default_rng(0)
+        lngs = rng.uniform(-90.9, -90.1, 2000)
+        lats = rng.uniform(37.9, 39.0, 2000)
+        with mock.patch.object(classify, "BAND_SIZE", 16):
+            result = classify.classify(lngs, lats, engine)
+        for i in range(len(lngs)):
+            self.assertEqual(result["county"][i],
+                             engine.county(lngs[i], lats[i]))
+            self.assertEqual(result["library"][i],
+                             engine.library_district(lngs[i], lats[i]))
+            self.assertIsNone(result["school"][i])
+
+    def test_decide_uses_the_lookup_rules(self):
+        outcomes = classify.decide(
+            ["St. Louis County", "St. Louis County", "Jefferson County",
+             "Franklin County", None],
+            ["KIRKWOOD", "KIRKWOOD", None, None, None],
+            [None, None, "Fox", None, None],
+            cities=["", "", "", "Washington", ""],
+            states=["", "", "", "MO", ""])
+        self.assertEqual(outcomes[0], {"county": "St. Louis County",
+                                       "library": "Kirkwood",
+                                       "geo_code": "Kirkwood",
+                                       "patron_code": "Reciprocal"})
+        self.assertIs(outcomes[0], outcomes[1])
+        self.assertEqual(outcomes[2]["patron_code"], "Reciprocal")
+        self.assertEqual(outcomes[3]["geo_code"], "Washington Public Library")
+        self.assertIn("error", outcomes[4])
+
+
+@unittest.skipUnless(numpy, "requires requirements-classify.txt")
+class TestEligibilityGrid(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "eligibility.grid")
+        self.engine = local_engine()
+        self.engine.layers["jeffco"] = spatial.Layer.from_geojson(
+            "jeffco", polygon_layer("Name", {
+                "Fox": [square(-90.8, 38.0, -90.2, 38.4)]}), "Name")
+        grid.write(self.path, *grid.build(self.engine, cell=0.01))
+
+    def test_interior_cells_match_engine(self):
+        mapped = grid.EligibilityGrid.open(self.path)
+        rng = numpy.random.default_rng(0)
+        interior = 0
+        for lng, lat in zip(rng.uniform(-90.9, -90.1, 2000),
+                            rng.uniform(37.9, 39.0, 2000)):
+            answers = mapped.lookup(lng, lat)
+            if answers is None:
+                continue
+            interior += 1
+            county, library, school = answers
+            self.assertEqual(county, self.engine.county(lng, lat))
+            if county == "St. Louis County":
+                self.assertEqual(library,
+                                 self.engine.library_district(lng, lat))
+            else:
+                self.assertEqual(school,
+                                 self.engine.school_district(lng, lat))
+        self.assertGreater(interior, 500)
+
+        # next to a boundary, and off the grid
+        self.assertEqual(mapped.code(-90.401, 38.549), grid.BOUNDARY)
+        self.assertIsNone(mapped.lookup(-90.3, 38.401))
+        self.assertIsNone(mapped.lookup(-89.0, 38.5))
+
+    def test_district_gaps_are_not_answers(self):
+        # the library district layer only covers the east half of
+        # St. Louis County, there is no school district layer
+        engine = local_engine()
+        engine.layers["slc"] = spatial.Layer.from_geojson(
+            "slc", polygon_layer("LIBRARY_DISTRICT", {
+                "ST LOUIS COUNTY": [square(-90.4, 38.4, -90.2, 38.9)]}),
+            "LIBRARY_DISTRICT")
+        grid.write(self.path, *grid.build(engine, cell=0.01))
+        with mock.patch.object(spatial, "engine", return_value=engine), \
+                mock.patch.object(grid, "GRID_PATH", self.path), \
+                mock.patch.object(grid, "_loaded", False), \
+                mock.patch.object(grid, "_source", None), \
+                mock.patch.object(grid, "_grid", None):
+            self.assertIsNone(grid.answers(-90.5, 38.7))
+            self.assertIsNone(grid.answers(-90.5, 38.2))
+            self.assertEqual(grid.answers(-90.3, 38.7),
+                             ("St. Louis County", "ST LOUIS COUNTY", None))
+
+    def test_lookup_without_arcgis(self):
+        patches = fake_upstreams("Jefferson County") + [
+            mock.patch.object(main, "arcgis_county",
+                              side_effect=AssertionError("county query")),
+            mock.patch.object(spatial, "engine", return_value=self.engine),
+            mock.patch.object(grid, "GRID_PATH", self.path),
+            mock.patch.object(grid, "_loaded", False),
+            mock.patch.object(grid, "_source", None),
+            mock.patch.object(grid, "_grid", None)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        result = main.AddressDetails().address_lookup("4444 WEBER RD",
+                                                      "63123")
+        self.assertEqual(result["county"], "St. Louis County")
+        self.assertEqual(result["geo_code"], "St Louis County")
+
+        # a grid built from other snapshots is not used
+        with mock.patch.object(spatial, "version", return_value="other"):
+            self.assertIsNone(grid.answers(-90.298, 38.551))
+
+
+try:
+    import httpx
+
+    import asgi
+    import async_lookup
+except ImportError:
+    httpx = None
+
+
+class StandIn:
+    """
+    Local stand-in for Google and the three ArcGIS layers.
+    Every response waits `latency` seconds.
+    """
+    RESPONSES = {
+        "/maps/api/geocode/json": {"status": "OK", "results": [{
+            "formatted_address": "4444 Weber Rd, St. Louis, MO 63123, USA",
+            "geometry": {"location": {"lng": -90.298, "lat": 38.551}},
+            "address_components": [
+                {"long_name": "4444", "types": ["street_number"]},
+                {"long_name": "Weber Road", "types": ["route"]},
+                {"long_name": "63123", "types": ["postal_code"]},
+                {"long_name": "Missouri", "short_name": "MO",
+                 "types": ["administrative_area_level_1"]}]}]},
+        "/counties/query": {"features": [
+            {"attributes": {"NAME": "St. Louis County"}}]},
+        "/slc/query": {"features": [
+            {"attributes": {"LIBRARY_DISTRICT": "ST LOUIS COUNTY"}}]},
+        "/jeffco/query": {"features": []},
+    }
+
+    def __init__(self, latency=0.0):
+        stand_in = self
+        self.latency = latency
+        self.calls = {}
+        # path -> HTTP statuses returned before the normal response
+        self.failures = {}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                stand_in.calls[path] = stand_in.calls.get(path, 0) + 1
+                time.sleep(stand_in.latency)
+                failures = stand_in.failures.get(path)
+                status = failures.pop(0) if failures else 200
+                body = json.dumps(stand_in.RESPONSES.get(path, {})).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.patches = [
+            mock.patch.dict(os.environ, {
+                "GOOGLE_MAPS_API_KEY": "AIza-stand-in",
+                "GOOGLE_MAPS_URL": self.url,
+                "ARCGIS_COUNTIES_URL": self.url + "/counties",
+                "ARCGIS_SLC_URL": self.url + "/slc",
+                "ARCGIS_JEFFCO_URL": self.url + "/jeffco"}),
+            mock.patch.object(spatial, "engine", return_value=None),
+            mock.patch.object(cache, "NOT_FOUND", cache.TieredCache(
+                "not_found", ttl=60, path=None)),
+        ] + [mock.patch.object(cache, name, cache.TieredCache(
+                 "geocode", ttl=60, path=None)) for name in ["GEOCODE"]] \
+          + [mock.patch.object(cache, name, cache.CellCache(
+                 name, ttl=60, path=None)) for name in
+             ["COUNTIES", "SLC", "JEFFCO"]]
+        for p in self.patches:
+            p.start()
+        clients.reset()
+        resilience.reset_breakers()
+        return self
+
+    def __exit__(self, *exc):
+        for p in reversed(self.patches):
+            p.stop()
+        clients.reset()
+        resilience.reset_breakers()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestResilience(unittest.TestCase):
+    @staticmethod
+    def http_error(status, headers=None):
+        import requests
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers or {})
+        return requests.exceptions.HTTPError(str(status), response=response)
+
+    def test_retry_statuses(self):
+        import requests
+        calls = []
+
+        @resilience.retry(max_attempts=3, delay=0,
+                          exceptions=(requests.exceptions.Timeout,),
+                          retry_statuses=(429, 503))
+        def flaky(status):
+            calls.append(status)
+            if len(calls) == 1:
+                raise self.http_error(status)
+            return "ok"
+
+        self.assertEqual(flaky(503), "ok")
+        self.assertEqual(len(calls), 2)
+
+        calls.clear()
+        with self.assertRaises(requests.exceptions.HTTPError):
+            flaky(404)
+        self.assertEqual(len(calls), 1)
+
+    def test_retry_after(self):
+        self.assertEqual(resilience.retry_after(
+            self.http_error(429, {"Retry-After": "3"})), 3)
+        self.assertEqual(resilience.retry_after(self.http_error(503)), 0)
+
+    def test_no_retry_without_budget(self):
+        calls = []
+
+        @resilience.retry(max_attempts=3, delay=1)
+        def failing():
+            calls.append(1)
+            raise ConnectionError("down")
+
+        start = time.monotonic()
+        with resilience.budget(1):
+            with self.assertRaises(ConnectionError):
+                failing()
+        # the backoff wait plus another attempt don't fit in 1 second
+        self.assertEqual(len(calls), 1)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_timeout_clamped_to_budget(self):
+        self.assertEqual(resilience.timeout(3, 10), (3, 10))
+        with resilience.budget(2):
+            connect, read = resilience.timeout(3, 10)
+            self.assertLessEqual(read, 2)
+            self.assertLessEqual(connect, 2)
+        with resilience.budget(0):
+            with self.assertRaises(resilience.DeadlineExceeded):
+                resilience.timeout(3, 10)
+
+    def test_threads_share_deadline(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(2) as executor, resilience.budget(5) as d:
+            with resilience.budget(60):
+                # nested budgets keep the outer deadline
+                self.assertIs(resilience.current(), d)
+            futures = [resilience.submit(executor, resilience.current)
+                       for _ in range(2)]
+            self.assertEqual([f.result() for f in futures], [d, d])
+        self.assertIsNone(resilience.current())
+
+    def test_upstream_status_is_retried(self):
+        with StandIn() as stand_in:
+            stand_in.failures["/maps/api/geocode/json"] = [503]
+            stand_in.failures["/counties/query"] = [429]
+            result = main.AddressDetails().address_lookup("4444 Weber Rd",
+                                                          "63123")
+        self.assertEqual(result["county"], "St. Louis County")
+        self.assertEqual(stand_in.calls["/maps/api/geocode/json"], 2)
+        self.assertEqual(stand_in.calls["/counties/query"], 2)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.breaker = resilience.CircuitBreaker(
+            "test", window=4, min_calls=4, slow_call=1, reset_timeout=0.1)
+
+    def tearDown(self):
+        resilience.reset_breakers()
+
+    def test_opens_then_probes(self):
+        b = self.breaker
+        for failed in (False, True, False, True):
+            b.allow()
+            b.record(failed, 0.01)
+        self.assertEqual(b.state, b.OPEN)
+        with self.assertRaises(resilience.CircuitOpen):
+            b.allow()
+
+        time.sleep(0.15)
+        b.allow()  # the probe
+        self.assertEqual(b.state, b.HALF_OPEN)
+        with self.assertRaises(resilience.CircuitOpen):
+            b.allow()  # only one probe at a time
+        b.record(False, 0.01)
+        self.assertEqual(b.state, b.CLOSED)
+        self.assertEqual(b.snapshot()["rejected"], 2)
+
+    def test_slow_calls_open(self):
+        b = self.breaker
+        for duration in (2, 0.1, 2, 0.1):
+            b.record(False, duration)
+        self.assertEqual(b.state, b.OPEN)
+
+    def test_answers_are_not_failures(self):
+        @resilience.circuit("test", (ConnectionError,))
+        def not_found():
+            raise Exception("Address not found.")
+
+        for _ in range(10):
+            with self.assertRaises(Exception):
+                not_found()
+        self.assertEqual(resilience.breaker("test").state, "closed")
+        self.assertIn("test", resilience.breaker_states())
+
+    def test_rate_limit_waits_are_not_slow_calls(self):
+        @clients.throttled("test")
+        @resilience.circuit("test")
+        def instant():
+            return "ok"
+
+        clients.set_rate_limit("test", 20)
+        self.addCleanup(clients.set_rate_limit, "test", None)
+        with mock.patch.dict(os.environ, {"BREAKER_SLOW_CALL": "0.1"}):
+            results = TestSingleFlight.run_together(instant, n=8)
+        self.assertEqual(results, ["ok"] * 8)
+        snapshot = resilience.breaker("test").snapshot()
+        self.assertEqual(snapshot["state"], "closed")
+        self.assertEqual(snapshot["slow_calls"], 0)
+
+    def test_open_circuit_serves_stale_answers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            geocodes = cache.TieredCache("geocode", ttl=60,
+                                         path=os.path.join(tmp, "c.sqlite3"))
+            with StandIn() as stand_in, \
+                    mock.patch.object(cache, "GEOCODE", geocodes):
+                fresh = main.AddressDetails().address_lookup("4444 Weber Rd",
+                                                             "63123")
+                # the geocode expired, and ArcGIS saw one point per cell
+                key = cache.address_key("4444 Weber Rd", "63123")
+                geocodes.lru.clear()
+                geocodes.store.set(key, geocodes.store.get(key), ttl=-1)
+                for name in ("google", "counties", "slc"):
+                    resilience.breaker(name)._open()
+
+                stale = main.AddressDetails().address_lookup("4444 Weber Rd",
+                                                             "63123")
+                with self.assertRaises(resilience.CircuitOpen):
+                    main.AddressDetails().address_lookup("1 Elsewhere Rd",
+                                                         "63123")
+
+                health = app.app.test_client().get("/health").get_json()
+
+        self.assertNotIn("stale", fresh)
+        self.assertEqual(stale, dict(fresh, stale=True))
+        self.assertEqual(stand_in.calls["/maps/api/geocode/json"], 1)
+        self.assertEqual(health["status"], "degraded")
+        self.assertEqual(health["upstreams"]["google"]["state"], "open")
+
+
+class TestSingleFlight(unittest.TestCase):
+    @staticmethod
+    def run_together(fn, n=5):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(n) as executor:
+            futures = [executor.submit(fn) for _ in range(n)]
+        outcomes = []
+        for f in futures:
+            try:
+                outcomes.append(f.result())
+            except Exception as e:
+                outcomes.append(str(e))
+        return outcomes
+
+    def test_identical_calls_share_one_run(self):
+        flight = singleflight.SingleFlight()
+        calls = []
+
+        def slow(value):
+            calls.append(value)
+            time.sleep(0.2)
+            if value == "bad":
+                raise Exception("Address not found.")
+            return value
+
+        self.assertEqual(self.run_together(lambda: flight.do("k", slow, "ok")),
+                         ["ok"] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(
+            self.run_together(lambda: flight.do("k", slow, "bad")),
+            ["Address not found."] * 5)
+        self.assertEqual(len(calls), 2)
+
+    def test_lookup_is_coalesced(self):
+        with StandIn(latency=0.2) as stand_in:
+            results = self.run_together(
+                lambda: main.lookup("4444 Weber Rd", "63123"))
+        self.assertEqual(results, [TestAsyncLookup.EXPECTED] * 5)
+        self.assertEqual(stand_in.calls["/maps/api/geocode/json"], 1)
+        self.assertEqual(stand_in.calls["/counties/query"], 1)
+
+    def test_shared_between_workers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "c.sqlite3")
+            # one SharedFlights per "worker"
+            workers = [singleflight.SharedFlights(path) for _ in range(3)]
+            calls = []
+
+            def slow():
+                calls.append(1)
+                time.sleep(0.3)
+                return {"county": "Jefferson County"}
+
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(3) as executor:
+                futures = [executor.submit(w.do, "k", slow) for w in workers]
+                results = [f.result() for f in futures]
+
+        self.assertEqual(results, [{"county": "Jefferson County"}] * 3)
+        self.assertEqual(len(calls), 1)
+
+    def test_shared_result_is_not_reused(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "c.sqlite3")
+            workers = [singleflight.SharedFlights(path) for _ in range(3)]
+            workers[0].do("k", lambda: "earlier")
+
+            def slow():
+                time.sleep(0.3)
+                return "later"
+
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(3) as executor:
+                futures = [executor.submit(w.do, "k", slow) for w in workers]
+                results = [f.result() for f in futures]
+        self.assertEqual(results, ["later"] * 3)
+
+    def test_shared_errors_keep_their_type(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "c.sqlite3")
+            workers = [singleflight.SharedFlights(path) for _ in range(3)]
+
+            for error in (main.AddressNotFound("Address not found."),
+                          resilience.CircuitOpen("google is unavailable"),
+                          resilience.DeadlineExceeded("No time left"),
+                          ValueError("bad answer")):
+                def slow():
+                    time.sleep(0.3)
+                    raise error
+
+                from concurrent.futures import ThreadPoolExecutor
+                with ThreadPoolExecutor(3) as executor:
+                    futures = [executor.submit(w.do, str(error), slow)
+                               for w in workers]
+                    errors = [f.exception() for f in futures]
+
+                expected = (Exception if isinstance(error, ValueError)
+                            else type(error))
+                # the leader raises the error itself, the others a copy
+                self.assertEqual(sorted(type(e).__name__ for e in errors),
+                                 sorted([type(error).__name__]
+                                        + [expected.__name__] * 2))
+                self.assertEqual({str(e) for e in errors}, {str(error)})
+
+
+class TestJsonApi(unittest.TestCase):
+    URL = "/api/v1/lookup?street=4444+Weber+Rd&zip=63123"
+
+    def test_conditional_requests(self):
+        client = app.app.test_client()
+        with StandIn() as stand_in:
+            first = client.get(self.URL)
+            etag = first.headers["ETag"]
+            again = client.get(self.URL, headers={"If-None-Match": etag})
+            since = client.get(self.URL, headers={
+                "If-Modified-Since": first.headers["Last-Modified"]})
+            other = client.get("/api/v1/lookup?street=1+Main+St&zip=63123",
+                               headers={"If-None-Match": etag})
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.get_json(), TestAsyncLookup.EXPECTED)
+        self.assertIn("max-age=", first.headers["Cache-Control"])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.headers["ETag"], etag)
+        self.assertEqual(since.status_code, 304)
+        self.assertEqual(other.status_code, 200)
+        # the 304s didn't run the lookup
+        self.assertEqual(stand_in.calls["/maps/api/geocode/json"], 2)
+
+    def test_etag_follows_reference_data(self):
+        with mock.patch.object(reference_data, "version", return_value="1"):
+            etag, _ = app.lookup_validators("4444 Weber Rd", "63123")
+        with mock.patch.object(reference_data, "version", return_value="2"):
+            self.assertNotEqual(
+                app.lookup_validators("4444 Weber Rd", "63123")[0], etag)
+
+    def test_errors(self):
+        client = app.app.test_client()
+        self.assertEqual(
+            client.get("/api/v1/lookup?street=4444+Weber+Rd&zip=631").status_code,
+            400)
+        with mock.patch.object(app, "lookup",
+                               side_effect=main.AddressNotFound()):
+            response = client.get(self.URL)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json(), {"error": "Address not found."})
+        self.assertIn("no-store", response.headers["Cache-Control"])
+        # an upstream error is not a missing address
+        with mock.patch.object(app, "lookup",
+                               side_effect=Exception("Address not found.")):
+            response = client.get(self.URL)
+        self.assertEqual(response.status_code, 502)
+        with mock.patch.object(app, "lookup",
+                               side_effect=resilience.CircuitOpen("open")):
+            self.assertEqual(client.get(self.URL).status_code, 503)
+
+
+def parse_events(text):
+    """[(event, data), ...] of a text/event-stream body."""
+    events = []
+    for block in text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+class TestStreamingResults(unittest.TestCase):
+    FORM = {"streetAddress": "4444 Weber Rd", "ZIPCode": "63123"}
+
+    def test_shell_is_returned_before_the_lookup(self):
+        client = app.app.test_client()
+        with mock.patch.object(app, "STREAM_RESULTS", True), \
+                mock.patch.object(app, "lookup",
+                                  side_effect=AssertionError("lookup")):
+            response = client.post("/lookup", data=self.FORM)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("/lookup/events?streetAddress=4444+Weber+Rd"
+                      "\\u0026ZIPCode=63123", response.get_data(as_text=True))
+
+    def test_stages_are_pushed_in_order(self):
+        client = app.app.test_client()
+        with StandIn():
+            response = client.get("/lookup/events?streetAddress=4444+Weber+Rd"
+                                  "&ZIPCode=63123")
+            events = parse_events(response.get_data(as_text=True))
+        self.assertEqual(response.mimetype, "text/event-stream")
+        self.assertEqual([e for e, _ in events],
+                         ["address", "county", "result"])
+        self.assertEqual(events[0][1],
+                         {"address": TestAsyncLookup.EXPECTED["address"]})
+        self.assertEqual(events[1][1], {"county": "St. Louis County"})
+        self.assertEqual(events[2][1], TestAsyncLookup.EXPECTED)
+
+    def test_errors_are_events(self):
+        client = app.app.test_client()
+        response = client.get("/lookup/events?streetAddress=x&ZIPCode=631")
+        self.assertEqual(parse_events(response.get_data(as_text=True)),
+                         [("lookup_error", {"error": "Invalid ZIP code"})])
+        with mock.patch.object(app, "lookup",
+                               side_effect=Exception("Address not found.")):
+            response = client.get("/lookup/events?streetAddress=x"
+                                  "&ZIPCode=63123")
+        self.assertEqual(parse_events(response.get_data(as_text=True)),
+                         [("lookup_error", {"error": "Address not found."})])
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patch = mock.patch.object(metrics, "METRICS_DIR", self.tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        metrics.REGISTRY.clear()
+
+    def test_histogram_is_cumulative(self):
+        for seconds in (0.003, 0.2, 30):
+            metrics.observe("upstream_request_seconds", seconds,
+                            upstream="slc")
+        text = metrics.render()
+        self.assertIn('upstream_request_seconds_bucket{upstream="slc",'
+                      'le="0.005"} 1', text)
+        self.assertIn('upstream_request_seconds_bucket{upstream="slc",'
+                      'le="0.25"} 2', text)
+        self.assertIn('upstream_request_seconds_bucket{upstream="slc",'
+                      'le="+Inf"} 3', text)
+        self.assertIn('upstream_request_seconds_count{upstream="slc"} 3', text)
+
+    def test_workers_are_added_up(self):
+        metrics.inc("lookups_total", outcome="ok")
+        metrics.inc("lookups_in_flight", 1)
+        metrics.flush(force=True)
+        # that was another worker
+        os.rename(os.path.join(self.tmp.name, f"{os.getpid()}.json"),
+                  os.path.join(self.tmp.name, "1.json"))
+        metrics.REGISTRY.clear()
+
+        metrics.inc("lookups_total", outcome="ok")
+        text = metrics.render()
+        self.assertIn('lookups_total{outcome="ok"} 2', text)
+        self.assertIn("lookups_in_flight 1", text)
+
+        metrics.mark_dead(1)
+        self.assertNotIn("lookups_in_flight 1", metrics.render())
+        self.assertIn('lookups_total{outcome="ok"} 2', metrics.render())
+
+    def test_server_timing_and_endpoint(self):
+        client = app.app.test_client()
+        with StandIn():
+            response = client.post("/lookup", data={
+                "streetAddress": "4444 Weber Rd", "ZIPCode": "63123"})
+        timing = response.headers["Server-Timing"]
+        for name in ("geocode", "google", "county", "counties", "lookup"):
+            self.assertIn(f"{name};dur=", timing)
+
+        text = client.get("/metrics").get_data(as_text=True)
+        self.assertIn('lookup_stage_seconds_count{stage="geocode"} 1', text)
+        self.assertIn('upstream_requests_total{outcome="ok",upstream="slc"} 1',
+                      text)
+        self.assertIn('cache_requests_total{cache="geocode",result="miss"} 1',
+                      text)
+        self.assertIn("lookups_in_flight 0", text)
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "lookups.jsonl")
+
+    def read(self, path=None):
+        with open(path or self.path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_writer_batches_and_rotates(self):
+        writer = journal.JournalWriter(self.path, max_bytes=200, backups=2)
+        for n in range(3):
+            writer.record({"n": n})
+        self.assertTrue(writer.flush())
+        self.assertEqual(self.read(), [{"n": 0}, {"n": 1}, {"n": 2}])
+
+        for n in range(3, 40):
+            writer.record({"n": n, "pad": "x" * 40})
+            writer.flush()
+        # only the newest rotated files are kept, in order
+        rotated = journal.rotated_files(self.path)
+        self.assertEqual(len(rotated), 2)
+        kept = [r["n"] for path in rotated for r in self.read(path)]
+        if os.path.exists(self.path):
+            kept += [r["n"] for r in self.read()]
+        self.assertEqual(kept, list(range(kept[0], 40)))
+
+    def test_lookups_are_journaled(self):
+        writer = journal.JournalWriter(self.path)
+        client = app.app.test_client()
+        with mock.patch.object(journal, "WRITER", writer), StandIn():
+            client.get(TestJsonApi.URL)
+            client.post("/lookup", data={"streetAddress": "4444 Weber Rd.",
+                                         "ZIPCode": "63123"})
+            with mock.patch.object(app, "lookup",
+                                   side_effect=main.AddressNotFound()):
+                client.get(TestJsonApi.URL)
+            # no lookup, no record
+            client.get("/api/v1/lookup?street=x&zip=1")
+        writer.flush()
+
+        api, form, missing = self.read()
+        self.assertEqual(api["route"], "api_lookup")
+        self.assertEqual((api["status"], api["outcome"], api["key"]),
+                         (200, "ok", "4444 WEBER RD|63123"))
+        self.assertEqual(api["geo_code"], "St Louis County")
+        self.assertIn("google", api["spans"])
+        self.assertEqual(
+            api["counts"]["cache_requests_total{cache=geocode,result=miss}"], 1)
+        # the second lookup of the address is geocoded from the cache
+        self.assertEqual(form["route"], "lookup_address")
+        self.assertEqual(
+            form["counts"]["cache_requests_total{cache=geocode,result=hit}"], 1)
+        self.assertEqual((missing["status"], missing["outcome"]),
+                         (404, "not_found"))
+
+    def test_replay(self):
+        records = [
+            {"ts": 100.0, "street": "4444 Weber Rd", "zip": "63123",
+             "key": "a", "geo_code": "St Louis County",
+             "patron_code": "Resident"},
+            {"ts": 100.2, "street": "1 Main St", "zip": "63123", "key": "b",
+             "geo_code": "Kirkwood", "patron_code": "Reciprocal"}]
+        with open(self.path, "w", encoding="utf-8") as f:
+            for r in reversed(records):
+                f.write(json.dumps(r) + "\n")
+            f.write('{"ts": 1')
+        self.assertEqual(replay.read_journal([self.path]), records)
+        self.assertAlmostEqual(replay.schedule(records, speed=2)[1], 0.1)
+        self.assertEqual(replay.schedule(records, rate=10), [0.0, 0.1])
+
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {"geo_code": "St Louis County",
+                                      "patron_code": "Resident"}
+        session = mock.Mock()
+        session.get.return_value = response
+        results = replay.replay(records, "http://test", speed=10,
+                                session=session)
+        self.assertEqual(results["statuses"], {"200": 2})
+        self.assertEqual(results["mismatches"], [{
+            "key": "b", "journal": ["Kirkwood", "Reciprocal"],
+            "replay": ["St Louis County", "Resident"]}])
+        self.assertEqual(session.get.call_args.kwargs["params"],
+                         {"street": "1 Main St", "zip": "63123"})
+        self.assertIn("answers different from the journal: 1",
+                      replay.report(results))
+
+
+class TestRecording(unittest.TestCase):
+    def test_request_key_ignores_api_key_and_host(self):
+        self.assertEqual(
+            recording.request_key(
+                "get", "https://a.example/maps/api/geocode/json?key=1&address=x"),
+            recording.request_key(
+                "GET", "http://127.0.0.1:9/maps/api/geocode/json?address=x&key=2"))
+
+    def lookup_in_mode(self, mode, fixtures, stand_in=None):
+        patches = [mock.patch.object(recording, "MODE", mode),
+                   mock.patch.object(recording, "FIXTURES", fixtures),
+                   mock.patch.object(recording, "_store", None)]
+        for p in patches:
+            p.start()
+        clients.reset()
+        try:
+            return main.AddressDetails().address_lookup("4444 Weber Rd",
+                                                        "63123")
+        finally:
+            for p in reversed(patches):
+                p.stop()
+            clients.reset()
+
+    def test_record_then_replay(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with StandIn() as stand_in:
+                recorded = self.lookup_in_mode("record", tmp)
+                self.assertEqual(stand_in.calls["/maps/api/geocode/json"], 1)
+            output = os.path.join(tmp, "upstreams.jsonl.gz")
+            self.assertEqual(recording.compact(tmp, output), 3)
+
+            # the stand-in is gone: replay must not touch the network
+            with StandIn() as stand_in:
+                replayed = self.lookup_in_mode("replay", output)
+                self.assertEqual(stand_in.calls, {})
+
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(recorded, TestAsyncLookup.EXPECTED)
+
+    def test_replay_miss_fails(self):
+        with tempfile.TemporaryDirectory() as tmp, StandIn():
+            with self.assertRaises(Exception):
+                self.lookup_in_mode("replay", tmp)
+
+
+@unittest.skipUnless(httpx, "requires requirements-async.txt")
+class TestAsyncLookup(unittest.TestCase):
+    EXPECTED = {'address': '4444 WEBER RD, ST LOUIS, MO 63123',
+                'county': 'St. Louis County',
+                'library': 'St. Louis County',
+                'geo_code': 'St Louis County',
+                'patron_code': 'Resident'}
+
+    def test_matches_sync_pipeline(self):
+        with StandIn():
+            sync = main.AddressDetails().address_lookup("4444 Weber Rd",
+                                                        "63123")
+        for fan_out in (False, True):
+            with StandIn():
+                result = asyncio.run(async_lookup.address_lookup(
+                    "4444 Weber Rd", "63123", fan_out=fan_out))
+            self.assertEqual(result, sync)
+            self.assertEqual(result, self.EXPECTED)
+
+    def test_concurrent_lookups(self):
+        async def run_all():
+            # distinct addresses, so the geocode cache doesn't help
+            return await asyncio.gather(*[
+                async_lookup.address_lookup(f"{n} Weber Rd", "63123")
+                for n in range(50)])
+
+        with StandIn(latency=0.2) as stand_in:
+            start = time.monotonic()
+            results = asyncio.run(run_all())
+            elapsed = time.monotonic() - start
+
+        self.assertEqual(len(results), 50)
+        self.assertEqual(stand_in.calls["/maps/api/geocode/json"], 50)
+        # serially this would take 50 * 3 * 0.2 = 30 seconds
+        self.assertLess(elapsed, 5)
+
+    def test_concurrent_identical_lookups(self):
+        async def run_all():
+            return await asyncio.gather(*[
+                async_lookup.lookup("4444 Weber Rd", "63123")
+                for _ in range(5)])
+
+        with StandIn(latency=0.1) as stand_in:
+            results = asyncio.run(run_all())
+        self.assertEqual(results, [self.EXPECTED] * 5)
+        self.assertEqual(stand_in.calls["/maps/api/geocode/json"], 1)
+
+    def test_rate_limits_apply(self):
+        async def run_all():
+            return await asyncio.gather(*[
+                async_lookup.address_lookup(f"{n} Weber Rd", "63123")
+                for n in range(5)])
+
+        clients.set_rate_limit("google", 10)
+        self.addCleanup(clients.set_rate_limit, "google", None)
+        with StandIn(), \
+                mock.patch.dict(os.environ, {"BREAKER_SLOW_CALL": "0.2"}):
+            resilience.reset_breakers()
+            start = time.monotonic()
+            results = asyncio.run(run_all())
+            elapsed = time.monotonic() - start
+        self.assertEqual(results, [self.EXPECTED] * 5)
+        self.assertGreaterEqual(elapsed, 0.35)
+        self.assertEqual(resilience.breaker("google").snapshot()["slow_calls"],
+                         0)
+        resilience.reset_breakers()
+
+    def test_shared_between_workers(self):
+        calls = []
+
+        async def slow(value):
+            calls.append(value)
+            await asyncio.sleep(0.3)
+            if value == "bad":
+                raise main.AddressNotFound()
+            return value
+
+        async def run_all(workers, value):
+            return await asyncio.gather(
+                *[w.do_async(value, slow, value) for w in workers],
+                return_exceptions=True)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "c.sqlite3")
+            workers = [singleflight.SharedFlights(path) for _ in range(3)]
+            self.assertEqual(asyncio.run(run_all(workers, "ok")), ["ok"] * 3)
+            errors = asyncio.run(run_all(workers, "bad"))
+        self.assertEqual(calls, ["ok", "bad"])
+        self.assertEqual([type(e) for e in errors],
+                         [main.AddressNotFound] * 3)
+
+    def test_asgi_lookup(self):
+        async def post():
+            transport = httpx.ASGITransport(app=asgi.app)
+            async with httpx.AsyncClient(transport=transport,
+                                         base_url="http://test") as c:
+                found = await c.post("/lookup", data={
+                    "streetAddress": "4444 Weber Rd", "ZIPCode": "63123"})
+                invalid = await c.post("/lookup", data={
+                    "streetAddress": "4444 Weber Rd", "ZIPCode": "6312"})
+                index = await c.get("/")
+            return found, invalid, index
+
+        with StandIn():
+            found, invalid, index = asyncio.run(post())
+        self.assertEqual(found.status_code, 200)
+        self.assertIn("St Louis County", found.text)
+        self.assertEqual(invalid.status_code, 500)
+        self.assertEqual(index.status_code, 200)
+
+    def test_asgi_lookup_events(self):
+        async def get():
+            transport = httpx.ASGITransport(app=asgi.app)
+            async with httpx.AsyncClient(transport=transport,
+                                         base_url="http://test") as c:
+                return await c.get("/lookup/events", params={
+                    "streetAddress": "4444 Weber Rd", "ZIPCode": "63123"})
+
+        with StandIn():
+            response = asyncio.run(get())
+        events = parse_events(response.text)
+        self.assertEqual([e for e, _ in events],
+                         ["address", "county", "result"])
+        self.assertEqual(events[2][1], self.EXPECTED)
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
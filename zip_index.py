@@ -0,0 +1,194 @@
+"""
+ZIP-level eligibility index.
+
+Many ZIPs lie entirely in one county (and library or school district), so
+every address in them gets the same answer. The index maps those ZIPs (or
+ZIP+4s) to their answer, and main.lookup answers from it before any
+upstream call; only ZIPs that straddle a boundary still spend geocoding and
+ArcGIS quota and latency. ZIPs whose 3-digit prefix is outside Illinois and
+Missouri (where all eligible counties are) are always Ineligible.
+
+The index is built offline from sample lookups, read from a CSV like the
+ones /batch takes:
+    python zip_index.py build addresses.csv -o data/zip_index.json
+
+A ZIP is resolved when at least MIN_SAMPLES sample addresses in it got the
+same answer and Google placed every one of them in that ZIP; all other ZIPs
+are left out and get the full lookup. Answers from the index are not
+checked against Google, so they have no "address" and carry
+"zip_index": True.
+
+Settings:
+    ZIP_INDEX_PATH   index file (default data/zip_index.json, "" to turn off)
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR: str = os.path.dirname(os.path.abspath(__file__))
+INDEX_PATH: str = os.getenv("ZIP_INDEX_PATH",
+                            os.path.join(BASE_DIR, "data", "zip_index.json"))
+
+# 3-digit ZIP prefixes of Illinois (600-629) and Missouri (630-658)
+REGION_ZIP3: tuple = (600, 658)
+MIN_SAMPLES: int = 5
+# answer fields kept in the index
+OUTCOME_FIELDS: tuple = ("county", "library", "school", "geo_code",
+                         "patron_code")
+
+INELIGIBLE: dict = {"geo_code": "Ineligible", "patron_code": "Ineligible"}
+
+
+class ZipIndex:
+    """ZIP (or ZIP+4) -> answer, for the ZIPs that have a single one."""
+
+    def __init__(self, zips: dict, version: str = "", mtime: float = 0.0):
+        self.zips = zips
+        self.version = version
+        self.mtime = mtime
+
+    @classmethod
+    def load(cls, path: str = INDEX_PATH) -> "ZipIndex":
+        with open(path, encoding="utf-8") as f:
+            data: dict = json.load(f)
+        index = cls(data["zips"], data.get("version", ""),
+                    os.path.getmtime(path))
+        logger.info("Loaded %s resolved ZIPs from %s", len(index.zips), path)
+        return index
+
+    def outcome(self, zip: str) -> dict | None:
+        """
+        The answer for every address in `zip`, or None when it needs the
+        full lookup. A ZIP+4 is looked up first, then its ZIP.
+        """
+        zip = zip.strip()
+        for key in (zip, zip[:5]):
+            if key in self.zips:
+                return self.zips[key]
+        if zip[:3].isdigit() and not (
+                REGION_ZIP3[0] <= int(zip[:3]) <= REGION_ZIP3[1]):
+            return INELIGIBLE
+        return None
+
+
+_index: ZipIndex | None = None
+_loaded: bool = False
+_lock = threading.Lock()
+
+
+def index() -> ZipIndex | None:
+    """The per-process index, loaded on first use; None without a file."""
+    global _index, _loaded
+    if _loaded:
+        return _index
+
+    with _lock:
+        if not _loaded:
+            if INDEX_PATH and os.path.exists(INDEX_PATH):
+                try:
+                    _index = ZipIndex.load(INDEX_PATH)
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning("ZIP index not loaded: %s", e)
+            _loaded = True
+    return _index
+
+
+def version() -> str | None:
+    """Identifies the loaded index, None without one."""
+    i = index()
+    return None if i is None else i.version
+
+
+def resolve(zip: str) -> dict | None:
+    """
+    Answer for an address in `zip` from the index (a new dict with
+    "zip_index": True), or None when the full lookup is needed.
+    """
+    i = index()
+    if i is None:
+        return None
+    outcome: dict | None = i.outcome(zip)
+    if outcome is None:
+        return None
+    return dict(outcome, zip_index=True)
+
+
+def build(samples, concurrency: int = 4,
+          min_samples: int = MIN_SAMPLES) -> dict:
+    """
+    Run the full lookup for each (street, zip) sample and keep the ZIPs
+    whose samples all got one answer. Returns the index file contents.
+    """
+    # imported here: serving only needs the index file
+    from main import AddressDetails
+
+    def run(sample: tuple) -> tuple:
+        street, zip = sample
+        try:
+            result: dict = AddressDetails().address_lookup(street, zip)
+        except Exception as e:
+            logger.info("Sample %s, %s failed: %s", street, zip, e)
+            return zip, None
+        # an answer from expired cache entries doesn't count
+        return zip, None if result.get("stale") else result
+
+    answers: dict = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for zip, result in executor.map(run, samples):
+            answers.setdefault(zip, []).append(result)
+
+    zips: dict = {}
+    for zip, results in sorted(answers.items()):
+        outcomes = {json.dumps(outcome_of(r), sort_keys=True)
+                    for r in results}
+        if (len(results) >= min_samples and len(outcomes) == 1
+                and None not in results
+                and all(r["address"].endswith(" " + zip[:5])
+                        for r in results)):
+            zips[zip] = json.loads(outcomes.pop())
+    logger.info("%s of %s sampled ZIPs resolved", len(zips), len(answers))
+    return {"version": time.strftime("%Y%m%d%H%M%S"), "zips": zips}
+
+
+def outcome_of(result: dict | None) -> dict | None:
+    """The answer fields of a lookup result."""
+    if result is None:
+        return None
+    return {k: result[k] for k in OUTCOME_FIELDS if k in result}
+
+
+def write(data: dict, path: str = INDEX_PATH) -> None:
+    """Write the index file atomically."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ZIP eligibility index")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("input", help="CSV of sample addresses "
+                                      "(street and ZIP columns)")
+    parser.add_argument("-o", "--out", default=INDEX_PATH)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--min-samples", type=int, default=MIN_SAMPLES)
+    args = parser.parse_args()
+
+    import batch
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.input, newline="", encoding="utf-8-sig") as f:
+        samples = [(street, zip) for street, zip in batch.read_rows(f)
+                   if batch.validate(street, zip) is None]
+    write(build(samples, args.concurrency, args.min_samples), args.out)
+    sys.exit(0)